@@ -1,13 +1,11 @@
 import time
 import numpy as np
-import scipy
-from dateutil import parser
 
 from .module import FigureModule
 from .module import Menu
 from .module import BetterAxisItem
 
-from ..widgets.plot_widget import Plot, get_value_log
+from ..widgets.plot_widget import Plot, get_aligned_log
 from ..widgets.base_control_widgets import addCrossHairs
 
 class PlotModule(FigureModule):
@@ -116,45 +114,35 @@ class PlotModule(FigureModule):
         now = time.time()
         end = self.settings.x_end
         if end < 0:
-            end = now + 3600
+            end = now
         last = self.settings.x_start
         if last < 0:
             last = now + last
 
-        _, x_data = get_value_log(x_value, since=last, until=end)
-        if len(x_data) == 0:
+        # All of the keys are fetched together, binned into time_bin on the server
+        keys = [x_value, y_value]
+        shifts = [0, self.settings.y_phase]
+        if y_2_value is not None:
+            keys.append(y_2_value)
+            shifts.append(self.settings.y_2_phase)
+        valid, columns = get_aligned_log(keys, since=last, until=end, shifts=shifts, step=self.settings.time_bin)
+        if not valid:
             return
 
-        x_times = np.array([parser.parse(val[0]).timestamp() for val in x_data])
-        x_values = np.array([val[1] for val in x_data])
-
-        _, y_data = get_value_log(y_value, since=last + self.settings.y_phase, until=end + self.settings.y_phase)
-        y_times = np.array([parser.parse(val[0]).timestamp() - self.settings.y_phase for val in y_data])
-        y_values = np.array([val[1] for val in y_data])
-
-        t_min = np.ceil(max(x_times[0], y_times[0]))
-        t_max = np.floor(min(x_times[-1], y_times[-1]))
+        means_x = columns[1]
+        means_y = columns[2]
 
         self.plot_widget.set_axis_label("x", x_value)
         self.plot_widget.set_axis_label("y", y_value)
-        
-        if y_2_value is not None:
-            _, y_2_data = get_value_log(y_2_value, since=last + self.settings.y_2_phase, until=end + self.settings.y_2_phase)
-            y_2_times = np.array([parser.parse(val[0]).timestamp() - self.settings.y_2_phase for val in y_2_data])
-            y_2_values = np.array([val[1] for val in y_2_data])
-
-            t_min = np.ceil(max(t_min, y_2_times[0]))
-            t_max = np.floor(min(t_max, y_2_times[-1]))
-
-        bins = np.arange(t_min, t_max, self.settings.time_bin)
-        means_x, _, _ = scipy.stats.binned_statistic(x_times, x_values, bins=bins)
-        means_y, _, _ = scipy.stats.binned_statistic(y_times, y_values, bins=bins)
 
-        self.plots["y_value"] = [means_x, means_y, means_y, True, 0]
+        # Only the bins with values for both are plotted
+        found = np.isfinite(means_x) & np.isfinite(means_y)
+        self.plots["y_value"] = [means_x[found], means_y[found], means_y[found], True, 0]
 
         if y_2_value is not None:
-            means_y2,_ ,_ = scipy.stats.binned_statistic(y_2_times, y_2_values, bins=bins)
-            self.plots["y_2_value"] = [means_x, means_y2, means_y2, True, 0]
+            means_y2 = columns[3]
+            found = np.isfinite(means_x) & np.isfinite(means_y2)
+            self.plots["y_2_value"] = [means_x[found], means_y2[found], means_y2[found], True, 0]
             self.plot_widget.set_axis_label("y_2", y_2_value)
         self.plot_widget._has_value = True
 
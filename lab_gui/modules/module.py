@@ -582,6 +582,14 @@ class ClientWrapper(BaseDataClient):
         if ClientWrapper.SET_WRAPPER is not None:
             return ClientWrapper.SET_WRAPPER.get_value(key)
         return super().get_value(key)
+    def get_many(self, keys):
+        if ClientWrapper.SET_WRAPPER is not None:
+            return {key: ClientWrapper.SET_WRAPPER.get_value(key) for key in keys}
+        return super().get_many(keys)
+    def set_many(self, values):
+        if ClientWrapper.SET_WRAPPER is not None:
+            return {key: ClientWrapper.SET_WRAPPER.set_value(key, value, timestamp) for key, (timestamp, value) in values.items()}
+        return super().set_many(values)
 
 class MQTTClient(BaseDataClient):
     LAST_ALL_CHECK = 0
@@ -612,6 +620,14 @@ class MQTTClient(BaseDataClient):
     def get_value(self, key):
         from ..widgets import base_control_widgets
         return base_control_widgets.callbacks.get_value(key)
+
+    def get_many(self, keys):
+        # Values are all local from the callbacks, so no need to batch these
+        return {key: self.get_value(key) for key in keys}
+
+    def set_many(self, values):
+        # Each value is its own MQTT publish anyway
+        return {key: self.set_value(key, value, timestamp) for key, (timestamp, value) in values.items()}
     
     def get_all(self):
         now = time.time()
@@ -816,9 +832,7 @@ class ValueListener(DataCallbackServer):
         self.values[key] = value
 
     def register_listener(self, key):
-        client = BaseDataClient()
-        client.register_callback_server(key, self.port)
-        client.close()
+        self.subscribe(key)
 
     def get_value(self, key):
         if key in self.values:
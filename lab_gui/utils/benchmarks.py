@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+'''
+Benchmarks for the data server.
+
+usage: py -m lab_gui.utils.benchmarks [-c clients] [-n requests] [-p processes] [--one-shot] [--addr host:port] [--decode]
+
+If no address is given, a local server is started in this process. Clients are
+spread over several processes, so that they do not share the GIL with the server.
+
+--decode instead runs the value decoding micro-benchmark, comparing against the 
+previous decoder, which tried unpickling every value first.
+'''
+
+import time
+import threading
+import multiprocessing
+import pickle
+import struct
+from datetime import datetime
+
+try:
+    from . import data_client
+    from . import data_server
+except ImportError:
+    import data_client
+    import data_server
+
+def percentile(values, pct):
+    '''Returns the pct percentile of values, values should be sorted'''
+    if not len(values):
+        return 0
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+def run_clients(addr, clients, requests, session, set_every):
+    '''Runs clients threads, each doing requests GET/SETs against addr.
+    Returns a list of the latencies in seconds, and the number of failed requests'''
+    latencies = []
+    failures = [0]
+    lock = threading.Lock()
+    start_event = threading.Event()
+
+    def run(index):
+        client = data_client.BaseDataClient(addr, session=session)
+        key = f'bench_{index % 16}'
+        client.set_float(key, 0.0)
+        _latencies = []
+        _failures = 0
+        start_event.wait()
+        for i in range(requests):
+            start = time.perf_counter()
+            if set_every > 0 and i % set_every == 0:
+                ok = client.set_float(key, float(i))
+            else:
+                ok = client.get_value(key) is not None
+            _latencies.append(time.perf_counter() - start)
+            if not ok:
+                _failures += 1
+        client.close()
+        with lock:
+            latencies.extend(_latencies)
+            failures[0] += _failures
+
+    threads = [threading.Thread(target=run, args=(i,), daemon=True) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    start_event.set()
+    for thread in threads:
+        thread.join()
+    return latencies, failures[0]
+
+def _run_clients(args):
+    return run_clients(*args)
+
+def start_server():
+    '''Starts a tcp data server on this machine, without a DataSaver, so the 
+    benchmark's values are not written to the logs. Returns (server, thread)'''
+    server = data_server.BaseDataServer(tcp=True, addr=("127.0.0.1", 0))
+    loop = data_server.ServerLoop()
+    loop.add_server(server)
+    thread = loop.make_thread()
+    thread.start()
+    return server, thread
+
+def stop_server(server, thread):
+    server._running_ = False
+    thread.join()
+    server.close()
+
+def bench_server(addr=None, clients=128, requests=200, processes=4, session=True, set_every=10):
+    '''Measures request throughput and latency with many concurrent clients.
+
+    Args:
+        addr (tuple): (host, port) of a running tcp data server, if None one is started here
+        clients (int): total number of concurrent clients
+        requests (int): number of requests each client makes
+        processes (int): number of processes to spread the clients over
+        session (bool): whether the clients use persistent sessions
+        set_every (int): every set_every'th request is a SET rather than a GET
+
+    Returns:
+        dict: summary of the results
+    '''
+    server = None
+    if addr is None:
+        server, thread = start_server()
+        addr = ("127.0.0.1", server.port)
+        time.sleep(0.1)
+
+    processes = max(1, min(processes, clients))
+    per_process = [clients // processes + (1 if i < clients % processes else 0) for i in range(processes)]
+    jobs = [(addr, n, requests, session, set_every) for n in per_process]
+
+    try:
+        start = time.perf_counter()
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(_run_clients, jobs)
+        elapsed = time.perf_counter() - start
+    finally:
+        if server is not None:
+            stop_server(server, thread)
+
+    latencies = []
+    failures = 0
+    for _latencies, _failures in results:
+        latencies.extend(_latencies)
+        failures += _failures
+    latencies.sort()
+
+    return {
+        'clients': clients,
+        'requests': len(latencies),
+        'failures': failures,
+        'seconds': elapsed,
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1e3,
+        'p99_ms': percentile(latencies, 99) * 1e3,
+        'max_ms': latencies[-1] * 1e3 if len(latencies) else 0,
+    }
+
+def legacy_unpack_value(bytes):
+    '''The previous version of data_client.unpack_value, for comparison only'''
+    DALIM = data_client.DALIM
+    args = bytes.split(DALIM)
+    if args[0] == data_client.SUCCESS:
+        return False, args[0], data_client.ALL
+    key = args[0][2:].decode('utf-8')
+    data = args[1]
+    for i in range(2, len(args)):
+        data = data + DALIM + args[i]
+    try:
+        try:
+            value = pickle.loads(data)
+            return True, key, value
+        except Exception:
+            id = data[0]
+            fmt = ["<bdd", "<bdi", "<bd?"][id - 1] if id < 4 else f"<bdh{len(data) - 12}s"
+            unpacked = struct.unpack(fmt, data if id < 4 else data[0:-1])
+            value = (datetime.fromtimestamp(unpacked[1]), unpacked[-1])
+        return True, key, value
+    except Exception:
+        return False, key, data_client.UNPACK_ERR
+
+def make_values(keys):
+    '''Makes a get_all style response of keys values, mostly floats, as well as some of the other types'''
+    now = datetime.now()
+    records = []
+    for i in range(keys):
+        value = [float(i)] * 5 + [i, i % 2 == 0, f'value {i}']
+        value = value[i % len(value)]
+        records.append(data_client.pack_set(f'key_{i}', now, value))
+    return b''.join(records) + data_client.ALLSUCCESS
+
+def bench_decode(keys=2000, repeats=20):
+    '''Measures decoding a get_all response of keys values, and the same values one at a time as for callbacks.
+
+    Returns:
+        dict: the time per value in us for each of the decoders
+    '''
+    msg = make_values(keys)
+    records = data_client.split_values(msg)
+
+    def timed(fn):
+        start = time.perf_counter()
+        for _ in range(repeats):
+            fn()
+        return (time.perf_counter() - start) / (repeats * keys) * 1e6
+
+    results = {}
+    results['get_all legacy'] = timed(lambda: {key: value for success, key, value in 
+                                              [legacy_unpack_value(record) for record in data_client.split_values(msg)] if success})
+    results['get_all batched'] = timed(lambda: dict(data_client.unpack_values(msg)))
+    results['callback legacy'] = timed(lambda: [legacy_unpack_value(record) for record in records])
+    results['callback'] = timed(lambda: [data_client.unpack_value(record) for record in records])
+    return results
+
+def print_results(name, results):
+    print(f"{name}: {results['clients']} clients, {results['requests']} requests in {results['seconds']:.2f}s")
+    print(f"    throughput: {results['throughput']:.0f} req/s, failures: {results['failures']}")
+    print(f"    latency p50: {results['p50_ms']:.3f} ms, p99: {results['p99_ms']:.3f} ms, max: {results['max_ms']:.3f} ms")
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='Data Server Benchmarks',
+        description='Measures throughput and latency of the LabGUI data server')
+
+    parser.add_argument('-c', '--clients', type=int, default=128)
+    parser.add_argument('-n', '--requests', type=int, default=200)
+    parser.add_argument('-p', '--processes', type=int, default=4)
+    parser.add_argument('-a', '--addr')
+    parser.add_argument('--one-shot', action='store_true')
+    parser.add_argument('--decode', action='store_true')
+
+    args = parser.parse_args()
+
+    if args.decode:
+        for name, us in bench_decode().items():
+            print(f"{name}: {us:.3f} us per value")
+        exit()
+
+    addr = None
+    if args.addr:
+        host, port = args.addr.split(':')
+        addr = (host, int(port))
+
+    results = bench_server(addr, args.clients, args.requests, args.processes, session=not args.one_shot)
+    print_results('one-shot' if args.one_shot else 'session', results)
@@ -5,21 +5,32 @@ import struct
 import threading
 import time
 
+import numpy as np
+
 # Adds prints if things go wrong
 DEBUG = False
 
 class DoubleValue:
     '''Implementation of a value containing a 64 bit floating point number'''
+    STRUCT = struct.Struct("<bdd")
+    # Layout of a packed value, for decoding many at once
+    DTYPE = np.dtype([('id', '<u1'), ('time', '<f8'), ('value', '<f8')])
+
     def __init__(self) -> None:
         self.id = 1
         self.time = 0.0
         self.value = 0.0
 
     def pack(self):
-        return struct.pack("<bdd", self.id, self.time, self.value)
+        return DoubleValue.STRUCT.pack(self.id, self.time, self.value)
 
     def unpack(self, bytes):
-        self.id, self.time, self.value = struct.unpack("<bdd", bytes)
+        self.id, self.time, self.value = DoubleValue.STRUCT.unpack(bytes)
+
+    def decode(bytes, offset=0):
+        '''Returns the time and value packed at offset in bytes'''
+        _, time, value = DoubleValue.STRUCT.unpack_from(bytes, offset)
+        return time, value
 
     def size(self):
         return 17 # 1 + 8 + 8
@@ -29,16 +40,24 @@ class DoubleValue:
 
 class IntegerValue:
     '''Implementation of a value containing a 32 bit integer'''
+    STRUCT = struct.Struct("<bdi")
+    DTYPE = np.dtype([('id', '<u1'), ('time', '<f8'), ('value', '<i4')])
+
     def __init__(self) -> None:
         self.id = 2
         self.time = 0.0
         self.value = 0
 
     def pack(self):
-        return struct.pack("<bdi", self.id, self.time, self.value)
+        return IntegerValue.STRUCT.pack(self.id, self.time, self.value)
 
     def unpack(self, bytes):
-        self.id, self.time, self.value = struct.unpack("<bdi", bytes)
+        self.id, self.time, self.value = IntegerValue.STRUCT.unpack(bytes)
+
+    def decode(bytes, offset=0):
+        '''Returns the time and value packed at offset in bytes'''
+        _, time, value = IntegerValue.STRUCT.unpack_from(bytes, offset)
+        return time, value
 
     def size(self):
         return 13 # 1 + 8 + 4
@@ -48,16 +67,24 @@ class IntegerValue:
 
 class BooleanValue:
     '''Implementation of a value containing a boolean as an 8-bit value'''
+    STRUCT = struct.Struct("<bd?")
+    DTYPE = np.dtype([('id', '<u1'), ('time', '<f8'), ('value', '?')])
+
     def __init__(self) -> None:
         self.id = 3
         self.time = 0.0
         self.value = False
 
     def pack(self):
-        return struct.pack("<bd?", self.id, self.time, self.value)
+        return BooleanValue.STRUCT.pack(self.id, self.time, self.value)
 
     def unpack(self, bytes):
-        self.id, self.time, self.value = struct.unpack("<bd?", bytes)
+        self.id, self.time, self.value = BooleanValue.STRUCT.unpack(bytes)
+
+    def decode(bytes, offset=0):
+        '''Returns the time and value packed at offset in bytes'''
+        _, time, value = BooleanValue.STRUCT.unpack_from(bytes, offset)
+        return time, value
 
     def size(self):
         return 10 # 1 + 8 + 1
@@ -67,30 +94,108 @@ class BooleanValue:
 
 class StringValue:
     '''Implementation of a value containing a C compatible string'''
+    # The size here includes the null terminator
+    HEADER = struct.Struct("<bdh")
+    # Longest encoded string which fits in the size, longer ones are pickled instead
+    MAX_LENGTH = 32766
+
     def __init__(self) -> None:
         self.id = 4
         self.time = 0.0
         self.value = ""
 
     def pack(self):
-        size = len(self.value)
-        extra = f"{size}s"
-        fmt = "<bdh"+extra
-        return struct.pack(fmt, self.id, self.time, size + 1, self.value.encode())+b'\0'
+        encoded = self.value.encode()
+        return StringValue.HEADER.pack(self.id, self.time, len(encoded) + 1) + encoded + b'\0'
 
     def unpack(self, bytes):
-        _, _, size = struct.unpack("<bdh", bytes[0:11])
-        extra = f"{size - 1}s"
-        fmt = "<bdh"+extra
-        self.id, self.time, _, self.value = struct.unpack(fmt, bytes[0:-1])
-        self.value = self.value.decode('utf-8')
+        self.id, self.time, _ = StringValue.HEADER.unpack_from(bytes)
+        self.value = StringValue.decode(bytes)[1]
+
+    def decode(bytes, offset=0):
+        '''Returns the time and value packed at offset in bytes'''
+        _, time, size = StringValue.HEADER.unpack_from(bytes, offset)
+        start = offset + StringValue.HEADER.size
+        return time, bytes[start:start + size - 1].decode('utf-8')
 
     def size(self):
-        size = len(self.value) + 1 # 1 for null terminator
+        size = len(self.value.encode()) + 1 # 1 for null terminator
         return 11 + size # 1 + 8 + 2 + length of string
 
     def valid_value(value):
-        return isinstance(value, str)
+        if not isinstance(value, str):
+            return False
+        # utf-8 is at most 4 bytes per character, so only encode if it might not fit
+        return len(value) * 4 <= StringValue.MAX_LENGTH or len(value.encode()) <= StringValue.MAX_LENGTH
+
+class ArrayValue:
+    '''Implementation of a value containing a numeric numpy array.
+    
+    This is packed as a header of the id, time, dtype and shape, followed by the raw 
+    buffer of the array. Unpacking makes an array which views the packed bytes.'''
+
+    # id, time, dtype as a numpy type string, ie b'<f8', number of dimensions
+    HEADER = struct.Struct("<bd4sB")
+    DIM = struct.Struct("<I")
+
+    def __init__(self) -> None:
+        self.id = 5
+        self.time = 0.0
+        self.value = np.zeros(0)
+
+    def pack(self):
+        array = self.value
+        if not array.flags.c_contiguous:
+            array = np.ascontiguousarray(array)
+        header = ArrayValue.HEADER.pack(self.id, self.time, array.dtype.str.encode(), array.ndim)
+        shape = struct.pack(f"<{array.ndim}I", *array.shape)
+        # The array's buffer is joined directly, rather than via tobytes()
+        return b''.join([header, shape, array.reshape(-1).view(np.uint8)])
+
+    def unpack(self, bytes):
+        self.id, self.time, dtype, ndim = ArrayValue.HEADER.unpack_from(bytes)
+        offset = ArrayValue.HEADER.size
+        shape = struct.unpack_from(f"<{ndim}I", bytes, offset)
+        offset += ndim * ArrayValue.DIM.size
+        dtype = np.dtype(dtype.rstrip(b'\0').decode())
+        count = int(np.prod(shape))
+        self.value = np.frombuffer(bytes, dtype=dtype, count=count, offset=offset).reshape(shape)
+
+    def decode(bytes, offset=0):
+        '''Returns the time and value packed at offset in bytes'''
+        var = ArrayValue()
+        var.unpack(memoryview(bytes)[offset:])
+        return var.time, var.value
+
+    def size(self):
+        return ArrayValue.HEADER.size + self.value.ndim * ArrayValue.DIM.size + self.value.nbytes
+
+    def packed_size(bytes, offset=0):
+        '''Returns the size of the packed array starting at offset in bytes, from its header'''
+        _, _, dtype, ndim = ArrayValue.HEADER.unpack_from(bytes, offset)
+        shape = struct.unpack_from(f"<{ndim}I", bytes, offset + ArrayValue.HEADER.size)
+        itemsize = np.dtype(dtype.rstrip(b'\0').decode()).itemsize
+        return ArrayValue.HEADER.size + ndim * ArrayValue.DIM.size + int(np.prod(shape)) * itemsize
+
+    def valid_value(value):
+        # Only numeric types, which can be re-made from the dtype string
+        return isinstance(value, np.ndarray) and value.dtype.kind in 'biufc' and len(value.dtype.str) <= 4
+
+def unpack_arrays(bytes):
+    '''Unpacks consecutive packed ArrayValues, such as in a log file. 
+    Returns a list of the times and a list of the arrays'''
+    times = []
+    values = []
+    offset = 0
+    view = memoryview(bytes)
+    while offset < len(bytes):
+        size = ArrayValue.packed_size(bytes, offset)
+        var = ArrayValue()
+        var.unpack(view[offset:offset + size])
+        times.append(var.time)
+        values.append(var.value)
+        offset += size
+    return times, values
 
 # Order of value types for lookup by index
 TYPES = [   
@@ -98,6 +203,7 @@ TYPES = [
             IntegerValue, # index here is id - 1
             BooleanValue, 
             StringValue,
+            ArrayValue,
         ]
 
 # Order of value types for automatic type detection for packing
@@ -106,8 +212,24 @@ PACK = [
             IntegerValue,
             DoubleValue, 
             StringValue,
+            ArrayValue,
         ]
 
+# Pickled values are (timestamp, value) tuples, and start with this byte, the pickle PROTO opcode
+PICKLE_TAG = 0x80
+
+# Functions to decode the time and value by the leading type byte
+DECODERS = {i + 1: TYPES[i].decode for i in range(len(TYPES))}
+
+def decode_value(bytes, offset=0, end=None):
+    '''Decodes the value packed at offset in bytes, returns (timestamp, value). 
+    end is only needed for pickled values. Raises KeyError for unknown types'''
+    tag = bytes[offset]
+    if tag == PICKLE_TAG:
+        return pickle.loads(bytes[offset:end])
+    time, value = DECODERS[tag](bytes, offset)
+    return datetime.fromtimestamp(time), value
+
 def pack_data(timestamp, value):
     '''Packs the given value as the appropriate value type, returns none if no types match'''
     for _type in PACK:
@@ -141,8 +263,27 @@ MODE_ERR = b'mode_err!'
 UNPACK_ERR = b'unpack_err'
 SUCCESS = b'success!'
 CALLBACK = b'callback'
+SESSION = b'session'
+STREAM = b'stream'
+MGET = b'mget'
+MSET = b'mset'
+CHANGES = b'changes'
+RECENT = b'recent'
+FULL = b'full'
+DELTA = b'delta'
 FILLER = b"??"
 BUFSIZE = 1024
+# Largest UDP datagram we read, values larger than this need TCP
+UDP_BUFSIZE = 65536
+
+# Sizes under SMALL_SIZE are packed into two bytes of 5 bits each, larger sizes are
+# packed as LARGE_SIZE followed by the size as a 32 bit unsigned int.
+SMALL_SIZE = 1024
+LARGE_SIZE = 0xff
+LARGE_HEADER = struct.Struct("<BI")
+
+# Session frames are prefixed by their length as a 32 bit unsigned int
+FRAME_HEADER = struct.Struct("<I")
 
 # Server -> client messages
 SETSUCCESS = SUCCESS + DALIM + SET
@@ -151,22 +292,87 @@ MODE_ERR_MSG = MODE_ERR + DALIM + MODE_ERR
 KEY_ERR_MSG = KEY_ERR + DALIM + KEY_ERR
 HELLO_FROM_SERVER = HELLO + DALIM + HELLO
 CLOSED = SUCCESS + DALIM + CLOSE
+SESSION_OK = SUCCESS + DALIM + SESSION
+STREAM_OK = SUCCESS + DALIM + STREAM
+MSETSUCCESS = SUCCESS + DALIM + MSET
+CHANGESSUCCESS = SUCCESS + DALIM + CHANGES
 
 # Client -> server messages
 _open_cmd = OPEN + DELIM + FILLER + OPEN
 _close_cmd = CLOSE + DELIM + FILLER + CLOSE
 _hello = HELLO + DELIM + HELLO
+_session_cmd = SESSION + DELIM + FILLER + SESSION
+_stream_cmd = STREAM + DELIM + FILLER + STREAM
 all_request = ALL + DELIM + FILLER + ALL
 
+def pack_size(s):
+    '''Packs the size header which prefixes values'''
+    if s < SMALL_SIZE:
+        return struct.pack("<bb", int(s&31), int(s>>5))
+    return LARGE_HEADER.pack(LARGE_SIZE, s)
+
+def unpack_size(data, offset=0):
+    '''Unpacks the size header at offset in data, returns the size, and the length of the header'''
+    if data[offset] == LARGE_SIZE:
+        return LARGE_HEADER.unpack_from(data, offset)[1], LARGE_HEADER.size
+    return (data[offset]&31) + ((data[offset + 1]&31) << 5), 2
+
+def pack_frame(msg):
+    '''Prefixes msg with its length, this is how messages are sent over a session'''
+    return FRAME_HEADER.pack(len(msg)) + msg
+
+class PartialFrame(TimeoutError):
+    '''Timed out part way through reading something, so the stream is no longer in step'''
+    pass
+
+def recv_exact(connection, size):
+    '''Reads exactly size bytes from the connection, raises ConnectionError if it closes early,
+    and PartialFrame if it times out after some were read'''
+    data = bytearray(size)
+    view = memoryview(data)
+    read = 0
+    while read < size:
+        try:
+            n = connection.recv_into(view[read:])
+        except TimeoutError as err:
+            if read > 0:
+                raise PartialFrame(f"Timed out after {read} of {size} bytes") from err
+            raise
+        if n == 0:
+            raise ConnectionError("Connection closed by peer")
+        read += n
+    return bytes(data)
+
+def recv_all(connection):
+    '''Reads from the connection until the other end closes it'''
+    chunks = []
+    data = connection.recv(65536)
+    while data != b'':
+        chunks.append(data)
+        data = connection.recv(65536)
+    return b''.join(chunks)
+
+def recv_frame(connection):
+    '''Reads a single length-prefixed frame from a session connection'''
+    size = FRAME_HEADER.unpack(recv_exact(connection, FRAME_HEADER.size))[0]
+    if size == 0:
+        return b''
+    try:
+        return recv_exact(connection, size)
+    except TimeoutError as err:
+        if isinstance(err, PartialFrame):
+            raise
+        raise PartialFrame(f"Timed out after the header of a {size} byte frame") from err
+
 def callback_request(key, port, closing=False, rate = 100):
+    '''Packs a request for the server to send values of key to port, 
+    rate is the maximum number of updates per second we want for key'''
     if closing:
         msg = f'{key}{DALIM.decode()}x{port}\0{DALIM.decode()}{rate}\0'.encode()
     else:
         msg = f'{key}{DALIM.decode()}{port}\0{DALIM.decode()}{rate}\0'.encode()
-    s = len(msg)
     # We encode size in along with the message
-    size = struct.pack("<bb", int(s&31), int(s>>5))
-    return CALLBACK + DELIM + size + msg
+    return CALLBACK + DELIM + pack_size(len(msg)) + msg
 
 def pack_value(timestamp, value):
     '''Packs the given value, if it doesn't use a standard type, it pickles it instead'''
@@ -176,66 +382,131 @@ def pack_value(timestamp, value):
         return packed
     return pickle.dumps(pack)
 
+def unpack_record(msg, offset, end):
+    '''Unpacks the size-prefixed value at offset in msg, which ends at end. 
+    Returns if it did unpack, the key, and what unpacked'''
+    _, header = unpack_size(msg, offset)
+    split = msg.find(DALIM, offset + header, end)
+    if split < 0:
+        return False, msg[offset:end], UNPACK_ERR
+    key = msg[offset + header:split].decode('utf-8')
+    start = split + len(DALIM)
+    # Values are all longer than these, so only compare short ones
+    if end - start <= len(MODE_ERR):
+        data = msg[start:end]
+        # If data was "ALL", then it means it was an end of ALL message, so return that
+        if data == ALL:
+            return False, key, ALL
+        # Otherwise if data was key error, return that
+        if data == KEY_ERR:
+            return False, key, KEY_ERR
+        # Same for mode error
+        elif data == MODE_ERR:
+            return False, key, MODE_ERR
+    try:
+        return True, key, decode_value(msg, start, end)
+    except Exception as err:
+        # Otherwise print error and return unpack error
+        print(f'Error unpacking value {key}: {err}, {msg[offset:min(end, offset + 64)]}')
+        return False, key, UNPACK_ERR
+
 def unpack_value(bytes):
     '''Unpacks a value from the bytes, returns if it did unpack, the key, and what unpacked'''
-    # messages from server are split by DALIM
-    args = bytes.split(DALIM)
     # If it said success, that means it wasn't a value response!
-    if args[0] == SUCCESS:
+    if bytes.startswith(SUCCESS + DALIM):
+        args = bytes.split(DALIM)
         # All success can occur for different reason, so return ALL here
         if args[1] == ALL:
             return False, args[0], ALL
         # Otherwise was an unpack error
         return False, args[0], UNPACK_ERR
-    # Server appends the size of the expected object to the front
-    # so args[0][0:2] is the packaged expected size.
-    key = args[0][2:].decode('utf-8')
-    # If key wasn't correct/found, return that
-    if key == KEY_ERR:
-        return False, key, KEY_ERR
-    data = args[1]
-    for i in range(2, len(args)):
-        data = data + DALIM + args[i]
-    # If data was "ALL", then it means it was an end of ALL message, so return that
-    if data == ALL:
-        return False, key, ALL
-    # Otherwise if data was key error, return that
-    if data == KEY_ERR:
-        return False, key, KEY_ERR
-    # Same for mode error
-    elif data == MODE_ERR:
-        return False, key, MODE_ERR
-    # Finally try to unpack things
-    try:
-        try:
-            # Try unpickling first
-            value = pickle.loads(data)
-            return True, key, value
-        except Exception:
-            # Not a pickle thing, lets try custom values
-            unpacked = unpack_data(data)
-            timestamp = datetime.fromtimestamp(unpacked.time)
-            value = (timestamp, unpacked.value)
-        return True, key, value
-    except Exception as err:
-        # Otherwise print error and return unpack error
-        print(f'Error unpacking value {key}: {err}, {args}')
-        return False, key, UNPACK_ERR
+    # Server appends the size of the expected object to the front, 
+    # and then the key and data are split by DALIM
+    return unpack_record(bytes, 0, len(bytes))
+
+def unpack_values(msg):
+    '''Unpacks a message of size-prefixed values, such as from get_all or pushed over a stream, 
+    in a single pass. Returns a list of (key, value) for those which unpacked'''
+    values = []
+    decoders = DECODERS
+    fromtimestamp = datetime.fromtimestamp
+    i = 0
+    n = len(msg)
+    while i + 2 <= n:
+        # Size header, as in unpack_size, anything else is the SUCCESS at the end
+        first = msg[i]
+        if first == LARGE_SIZE:
+            size, header = LARGE_HEADER.unpack_from(msg, i)[1], LARGE_HEADER.size
+        elif first < 32:
+            size, header = first + ((msg[i + 1]&31) << 5), 2
+        else:
+            break
+        end = i + header + size
+        # Fast path for the standard types
+        split = msg.find(DALIM, i + header, end)
+        start = split + len(DALIM)
+        if split >= 0 and end - start > len(MODE_ERR) and msg[start] in decoders:
+            try:
+                time, value = decoders[msg[start]](msg, start)
+                values.append((msg[i + header:split].decode('utf-8'), (fromtimestamp(time), value)))
+                i = end
+                continue
+            except Exception:
+                pass
+        # Otherwise pickles, errors, etc
+        success, key, unpacked = unpack_record(msg, i, end)
+        if success:
+            values.append((key, unpacked))
+        i = end
+    return values
+
+def split_values(msg):
+    '''Splits a message of size-prefixed values, such as pushed over a stream, into a list 
+    of the individual values, each of which can then be passed to unpack_value'''
+    values = []
+    i = 0
+    while i + 2 <= len(msg):
+        if msg[i:i + len(SUCCESS)] == SUCCESS:
+            break
+        size, header = unpack_size(msg, i)
+        values.append(msg[i:i + size + header])
+        i += size + header
+    return values
+
+def pack_set(key, timestamp, value):
+    '''Packs the key, value and timestamp, prefixed by the size'''
+    packed = str.encode(key) + DALIM + pack_value(timestamp, value)
+    # We encode size in along with the message
+    return pack_size(len(packed)) + packed
 
 def set_msg(key, timestamp, value):
     '''Packs the key, value and timestamp into a message for server'''
-    packed = str.encode(key) + DALIM + pack_value(timestamp, value)
-    s = len(packed)
-    # We encode size in along with the message
-    size = struct.pack("<bb", int(s&31), int(s>>5))
-    msg = SET + DELIM + size + packed
-    return msg
+    return SET + DELIM + pack_set(key, timestamp, value)
+
+def mset_msg(packed):
+    '''Makes a message setting several values, packed is a list of outputs of pack_set'''
+    packed = b''.join(packed)
+    return MSET + DELIM + pack_size(len(packed)) + packed
 
 def get_msg(key):
     '''Packs key for a get query'''
     # Server doesn't presently use the size bytes here, hence FILLER
     return GET + DELIM + FILLER + str.encode(key)
 
+def mget_msg(keys):
+    '''Packs keys for a multiple get query'''
+    return MGET + DELIM + FILLER + DALIM.join([str.encode(key) for key in keys])
+
+def changes_msg(epoch, sequence):
+    '''Packs a query for all values changed since sequence in epoch'''
+    return CHANGES + DELIM + FILLER + epoch + DALIM + str(sequence).encode()
+
+def recent_msg(key, since=None, count=None):
+    '''Packs a query for the recent history of key'''
+    since = b'' if since is None else repr(float(since)).encode()
+    count = b'' if count is None else str(int(count)).encode()
+    return RECENT + DELIM + FILLER + DALIM.join([str.encode(key), since, count])
+
 def find_server(server_key, server_type='tcp', default_addr=None, target_ip=None):
     is_log = server_type == 'log'
     if default_addr == None:
@@ -350,8 +621,22 @@ class ServerFinder:
         self.connection.close()
 
 class DataCallbackServer:
-    def __init__(self, port = 0, client_addr = None) -> None:
-        '''addr is address/port tuple, custom_port would call select() if true'''
+    '''Receives values pushed from the server for keys we listen to.
+
+    By default this keeps a single persistent stream open to the server, which the 
+    server pushes frames of values down, and re-connects it if it drops. If the server
+    does not support streams, it instead registers our port, and the server connects
+    to us for each value.'''
+
+    # Whether to try using a persistent stream to the server for callbacks
+    USE_STREAMS = True
+
+    # How long to wait on a quiet stream before checking the server is still there
+    STREAM_TIMEOUT = 5
+
+    def __init__(self, port = 0, client_addr = None, rate = 100) -> None:
+        '''port is the port to listen on for non-stream callbacks, client_addr is the data server,
+        rate is the default maximum updates per second for keys'''
         if client_addr is None:
             client_addr = BaseDataClient.ADDR
         self.connection = None
@@ -367,19 +652,32 @@ class DataCallbackServer:
         self.listeners = {}
         self.last_heard_times = {}
 
-        self._running_ = False
+        self.rate = rate
+        self.rates = {}
+        self.stream = None
+        self.stream_lock = threading.Lock()
+        self.streaming = DataCallbackServer.USE_STREAMS
+
+        self._running_ = True
         self._dummy_ = False
         self.thread = threading.Thread(target=self.run, daemon=True)
         self.thread.start()
 
-        self.alive_thread = threading.Thread(target=self.check_alive, daemon=True)
-        self.alive_thread.start()
+        if self.streaming:
+            self.stream_thread = threading.Thread(target=self.run_stream, daemon=True)
+            self.stream_thread.start()
+        else:
+            self.alive_thread = threading.Thread(target=self.check_alive, daemon=True)
+            self.alive_thread.start()
 
     def __del__(self):
         self.close()
 
     def close(self):
-        if not self._dummy_:
+        if not self._dummy_ and self.streaming:
+            self._running_ = False
+            self.close_stream()
+        elif not self._dummy_:
             try:
                 if BaseDataClient.DATA_SERVER_KEY is not None:
                     addr = find_server(BaseDataClient.DATA_SERVER_KEY, 'tcp')
@@ -409,11 +707,33 @@ class DataCallbackServer:
         with self.alive_lock:
             self.last_heard_times[key] = 0
         listeners = self.listeners[key]
+        if not key in self.rates and self.streaming:
+            self.subscribe(key)
         if not listener in listeners:
             listeners.append(listener)
             return True
         return False
 
+    def subscribe(self, key, rate=None):
+        '''Asks the server to send us values for key, at most rate times per second'''
+        if rate is None:
+            rate = self.rates.get(key, self.rate)
+        self.rates[key] = rate
+        if not self.streaming:
+            client = BaseDataClient(self.client_addr)
+            client.register_callback_server(key, self.port, rate=rate)
+            client.close()
+            return
+        with self.stream_lock:
+            if self.stream is None:
+                # Will be subscribed when the stream connects
+                return
+            try:
+                self.stream.sendall(pack_frame(callback_request(key, 0, rate=rate)))
+            except Exception as err:
+                if DEBUG:
+                    print(f"Error subscribing to {key}: {err}")
+
     def handle_msg(self, message):
         success, key, unpacked = unpack_value(message)
         with self.alive_lock:
@@ -422,14 +742,20 @@ class DataCallbackServer:
             for listener in self.listeners[key]:
                 listener(key, unpacked)
 
+    def handle_value(self, key, value):
+        '''Passes an already unpacked value for key to the listeners'''
+        if key in self.listeners:
+            for listener in self.listeners[key]:
+                listener(key, value)
+
     def run(self):
         '''run loop entry point for the server, probably best to run via a separate thread'''
-        self._running_ = True
         message = b''
         while(self._running_):
             try:
                 conn, _ = self.connection.accept()
-                message = conn.recv(BUFSIZE)
+                conn.settimeout(1)
+                message = recv_all(conn)
                 conn.close()
                 if message == b'':
                     continue
@@ -438,9 +764,94 @@ class DataCallbackServer:
                 if self._running_:
                     print(err, message)
 
+    def open_stream(self):
+        '''Connects a stream to the server, and subscribes to all of our keys on it.
+        Returns False if the server does not support streams.'''
+        addr = self.client_addr
+        if BaseDataClient.DATA_SERVER_KEY is not None:
+            addr = find_server(BaseDataClient.DATA_SERVER_KEY, 'tcp', default_addr=addr)
+        if addr is None:
+            raise ConnectionError("No server found")
+        self.client_addr = addr
+        stream = socket.socket()
+        stream.settimeout(DataCallbackServer.STREAM_TIMEOUT)
+        stream.connect(addr)
+        stream.sendall(_stream_cmd)
+        resp = b''
+        try:
+            resp = recv_exact(stream, len(STREAM_OK))
+        except (ConnectionError, TimeoutError):
+            pass
+        if resp != STREAM_OK:
+            stream.close()
+            return False
+        stream.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.stream_lock:
+            self.stream = stream
+            keys = list(self.rates.items())
+            frames = [pack_frame(callback_request(key, 0, rate=rate)) for key, rate in keys]
+            if len(frames):
+                stream.sendall(b''.join(frames))
+        return True
+
+    def close_stream(self):
+        with self.stream_lock:
+            if self.stream is not None:
+                try:
+                    self.stream.shutdown(socket.SHUT_RDWR)
+                except Exception:
+                    pass
+                self.stream.close()
+            self.stream = None
+
+    def read_stream(self):
+        '''Reads frames of values from the stream until it drops'''
+        quiet = 0
+        while self._running_:
+            try:
+                frame = recv_frame(self.stream)
+            except PartialFrame as err:
+                # Part of a frame was lost, so start over with a new stream
+                raise ConnectionError(f"Stream out of step: {err}") from err
+            except TimeoutError:
+                # Nothing heard for a while, so check the server is still there
+                quiet += 1
+                if quiet > 2:
+                    raise ConnectionError("Stream timed out")
+                with self.stream_lock:
+                    self.stream.sendall(pack_frame(_hello))
+                continue
+            quiet = 0
+            if frame == HELLO_FROM_SERVER:
+                continue
+            for key, value in unpack_values(frame):
+                self.handle_value(key, value)
+
+    def run_stream(self):
+        '''Keeps a stream open to the server, re-connecting if it drops'''
+        delay = 0.25
+        while self._running_:
+            try:
+                if not self.open_stream():
+                    # Server does not know about streams, so fall back to registering our port
+                    # check_alive then registers all of our keys.
+                    print("Server does not support streams, using callback port instead")
+                    self.streaming = False
+                    self.check_alive()
+                    return
+                delay = 0.25
+                self.read_stream()
+            except Exception as err:
+                if self._running_ and DEBUG:
+                    print(f"Callback stream dropped: {err}")
+            self.close_stream()
+            if not self._running_:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, 5)
+
     def check_alive(self):
-        '''Every so often check that server still knows about us'''
-        self._running_ = True
+        '''Every so often check that server still knows about us, this is only used if not streaming'''
         while self._running_:
             time.sleep(1)
             keys = []
@@ -459,11 +870,22 @@ class DataCallbackServer:
                         client.init_connection()
                         for key in keys:
                             self.last_heard_times[key] = now
-                            client.register_callback_server(key, self.port)
+                            client.register_callback_server(key, self.port, rate=self.rates.get(key, self.rate))
                         client.close()
                     except Exception as err:
                         print(f"Error in check alive: {err}")
 
+class ValueMirror:
+    '''Local copy of the values on a server, this is kept up to date by only fetching 
+    the values which changed since the last update, see BaseDataServer.on_changes'''
+    def __init__(self) -> None:
+        self.epoch = b''
+        self.sequence = 0
+        self.values = {}
+        # Set False if the server does not know about CHANGES
+        self.supported = True
+        self.lock = threading.Lock()
+
 class BaseDataClient:
 
     # Address to use, ensure that you set this in your implementation!
@@ -475,13 +897,25 @@ class BaseDataClient:
     # Key for automatic server lookup
     DATA_SERVER_KEY = None
 
+    # If true, TCP clients keep a single persistent session with the server,
+    # rather than making a new connection for every message.
+    USE_SESSIONS = True
+
+    # Mirrors of server values for get_all, by server address. These are shared
+    # between clients, as clients are often made just for a single call.
+    MIRRORS = {}
+    mirrors_lock = threading.Lock()
+
     '''Python client implementation'''
-    def __init__(self, addr=None, custom_port=False) -> None:
-        '''addr is address/port tuple, custom_port would call select() if true'''
+    def __init__(self, addr=None, custom_port=False, session=None) -> None:
+        '''addr is address/port tuple, custom_port would call select() if true, 
+        session overrides USE_SESSIONS if not None'''
         if addr is None:
             addr = BaseDataClient.ADDR
         self.connection = None
         self.tcp = True
+        self.session = BaseDataClient.USE_SESSIONS if session is None else session
+        self.in_session = False
         self.addr = addr
         self.io_lock = threading.Lock()
         self.custom_port = -1
@@ -522,14 +956,39 @@ class BaseDataClient:
             self.connection = socket.socket()
             self.connection.connect(self.addr)
             self.connection.settimeout(0.5)
+            if self.session:
+                self.open_session()
         else:
             self.connection = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
             self.connection.settimeout(0.1)
 
+    def open_session(self):
+        '''Asks the server to keep our connection open as a session, if the server 
+        does not support sessions, we fall back to a new connection per message.'''
+        try:
+            self.connection.sendall(_session_cmd)
+            resp = self.connection.recv(BUFSIZE)
+        except Exception as err:
+            resp = b''
+            if DEBUG:
+                print(f'error opening session? {err}')
+        if resp == SESSION_OK:
+            self.in_session = True
+            return True
+        # Old servers close the connection on unknown modes, so reconnect without a session
+        self.session = False
+        self.connection.close()
+        self.connection = socket.socket()
+        self.connection.connect(self.addr)
+        self.connection.settimeout(0.5)
+        return False
+
     def close(self, on_fail=False):
+        in_session = self.in_session
+        self.in_session = False
         if self.connection is not None:
             try:
-                if self.addr[1] != self.root_port:
+                if self.addr[1] != self.root_port and not in_session:
                     self.connection.sendto(_close_cmd, self.addr)
                 self.connection.close()
                 self.connection = None
@@ -554,11 +1013,54 @@ class BaseDataClient:
 
     def send_msg(self, msg):
         with self.io_lock:
-            if self.connection == None or self.tcp:
+            if self.tcp and self.session and not self.in_session:
+                self.init_connection()
+            if self.in_session:
+                return self.send_frames([msg])[0], self.addr
+            return self.send_one_shot(msg)
+
+    def send_one_shot(self, msg):
+        '''Sends msg over the present connection, without a session. Should be called with io_lock held.
+        Over TCP the server closes the connection once it has responded, so we read until then.'''
+        if self.connection == None or self.tcp:
+            self.init_connection()
+        if self.tcp:
+            self.connection.sendall(msg)
+            return recv_all(self.connection), self.addr
+        self.connection.sendto(msg, self.addr)
+        return self.connection.recvfrom(UDP_BUFSIZE)
+
+    def send_msgs(self, msgs):
+        '''Sends all of msgs, and returns a list of the responses in the same order.
+        In a session these are all sent together, and then the responses read back.'''
+        with self.io_lock:
+            if self.tcp and self.session and not self.in_session:
+                self.init_connection()
+            if self.in_session:
+                return self.send_frames(msgs)
+        return [self.send_msg(msg)[0] for msg in msgs]
+
+    def send_frames(self, msgs):
+        '''Writes msgs as frames to the session, and reads a response frame for each.
+        Should be called with io_lock held. If the session was dropped by the server, 
+        we reconnect and try once more.'''
+        data = b''.join([pack_frame(msg) for msg in msgs])
+        for attempt in range(2):
+            try:
+                self.connection.sendall(data)
+                return [recv_frame(self.connection) for _ in msgs]
+            except (ConnectionError, BrokenPipeError) as err:
+                # Stale session, possibly the server restarted.
+                self.close()
+                if attempt or not self.session:
+                    raise err
                 self.init_connection()
-            self.connection.sendto(msg, self.addr)
-            msgFromServer = self.connection.recvfrom(BUFSIZE)
-        return msgFromServer
+                if not self.in_session:
+                    return [self.send_one_shot(msg)[0] for msg in msgs]
+            except Exception as err:
+                # Anything else, ie timeouts, leaves the stream in an unknown state
+                self.close()
+                raise err
 
     def select(self):
         '''This is the Python equivalent of the "connect" function in C++ version, it also ensures a new port'''
@@ -647,6 +1149,26 @@ class BaseDataClient:
             print(f'failed to get! {key} {unpacked}')
         return None
 
+    def get_recent(self, key, since=None, count=None):
+        '''Requests the recent history of `key` which the server keeps in memory.
+        since is a timestamp to get values after, and count the maximum number of values.
+        Returns a (2, n) array of the times and values, or None if the server has no history for it.
+        If there are values before since, the first is the newest of those.'''
+        if not self.tcp:
+            return None
+        try:
+            resp = self.send_msg(recent_msg(key, since, count))[0]
+        except Exception as err:
+            msg = f'Error getting recent values for {key}! {err}'
+            if DEBUG and not 'timed out' in msg:
+                print(msg)
+            self.close(True)
+            return None
+        success, _, unpacked = unpack_value(resp)
+        if not success:
+            return None
+        return unpacked[1]
+
     def get_var(self, key, default=0):
         '''Attempts to get value from server, if not present, returns default and now'''
         resp = self.get_value(key)
@@ -712,8 +1234,8 @@ class BaseDataClient:
             timestamp = datetime.now()
         # Package the key value pair and timestamp for server
         bytesToSend = set_msg(key, timestamp, value)
-        # Ensure is in packet size range
-        if(len(bytesToSend) > BUFSIZE):
+        # Ensure is in packet size range, only UDP is limited
+        if not self.tcp and len(bytesToSend) > UDP_BUFSIZE:
             if DEBUG:
                 print('too long!')
             return False
@@ -732,48 +1254,168 @@ class BaseDataClient:
             pass
         return False
 
+    def get_many(self, keys):
+        '''Requests the values for all of `keys` from the server in a single message. 
+        Returns a map of key to value, where the value is None if it was not found.'''
+        keys = list(keys)
+        values = {key: None for key in keys}
+        if not len(keys):
+            return values
+        if not self.tcp:
+            # The response may not fit in a single packet, so get each instead
+            for key in keys:
+                values[key] = self.get_value(key)
+            return values
+        try:
+            with self.io_lock:
+                if self.session and not self.in_session:
+                    self.init_connection()
+                if self.in_session:
+                    resp = self.send_frames([mget_msg(keys)])[0]
+                else:
+                    resp = self.send_one_shot(mget_msg(keys))[0]
+        except Exception as err:
+            msg = f'Error getting values for {keys}! {err}'
+            if DEBUG and not 'timed out' in msg:
+                print(msg)
+            self.close(True)
+            return values
+        if resp.startswith(MODE_ERR):
+            # Server is too old to know about MGET
+            for key in keys:
+                values[key] = self.get_value(key)
+            return values
+        for key, unpacked in unpack_values(resp):
+            if key in values:
+                values[key] = unpacked
+        return values
+
+    def set_many(self, values):
+        '''Sends all of `values`, a map of key to (timestamp, value), to the server in a single message.
+        timestamp can be None, in which case datetime.now() is used. 
+        Returns a map of key to whether it was set successfully.'''
+        results = {key: False for key in values}
+        packed = []
+        keys = []
+        now = datetime.now()
+        for key, (timestamp, value) in values.items():
+            msg = pack_set(key, now if timestamp is None else timestamp, value)
+            # Ensure is in packet size range, only UDP is limited
+            if not self.tcp and len(msg) > UDP_BUFSIZE:
+                if DEBUG:
+                    print(f'too long! {key}')
+                continue
+            packed.append(msg)
+            keys.append(key)
+        if not len(packed):
+            return results
+        if not self.tcp:
+            for key in keys:
+                timestamp, value = values[key]
+                results[key] = self.set_value(key, value, timestamp)
+            return results
+        try:
+            with self.io_lock:
+                if self.session and not self.in_session:
+                    self.init_connection()
+                if self.in_session:
+                    resp = self.send_frames([mset_msg(packed)])[0]
+                else:
+                    resp = self.send_one_shot(mset_msg(packed))[0]
+        except Exception as err:
+            print(f"Error on set: {err}, {self.connection}, {self.tcp}")
+            self.close(True)
+            return results
+        if resp.startswith(MODE_ERR):
+            # Server is too old to know about MSET
+            for key in keys:
+                timestamp, value = values[key]
+                results[key] = self.set_value(key, value, timestamp)
+            return results
+        flags = resp[len(MSETSUCCESS) + len(DALIM):]
+        for i in range(min(len(flags), len(keys))):
+            results[keys[i]] = flags[i] == 1
+        return results
+
+    def get_mirror(self):
+        '''Returns the ValueMirror for our server'''
+        if self.addr is None:
+            self.init_connection()
+        with BaseDataClient.mirrors_lock:
+            if not self.addr in BaseDataClient.MIRRORS:
+                BaseDataClient.MIRRORS[self.addr] = ValueMirror()
+            return BaseDataClient.MIRRORS[self.addr]
+
+    def update_mirror(self, mirror):
+        '''Fetches the values changed since the last update of mirror, returns False if 
+        the server does not support this. Should be called with mirror.lock held.'''
+        msg = changes_msg(mirror.epoch, mirror.sequence)
+        with self.io_lock:
+            if self.session and not self.in_session:
+                self.init_connection()
+            if self.in_session:
+                resp = self.send_frames([msg])[0]
+            else:
+                resp = self.send_one_shot(msg)[0]
+        if resp.startswith(MODE_ERR):
+            mirror.supported = False
+            return False
+        # The tail is at the end, so is the last place this is found
+        tail = resp[resp.rfind(CHANGESSUCCESS):].split(DALIM)
+        if len(tail) != 5 or DALIM.join(tail[0:2]) != CHANGESSUCCESS:
+            raise ValueError(f"Invalid response to changes: {tail}")
+        values = {} if tail[4] == FULL else mirror.values
+        values.update(unpack_values(resp))
+        mirror.values = values
+        mirror.epoch = tail[2]
+        mirror.sequence = int(tail[3].decode())
+        return True
+
     def get_all(self):
+        '''Requests all values from server, returns a map of all found values. 
+        If the server supports it, this only transfers the values which changed since 
+        the last call, otherwise see get_all_values.'''
+        if self.tcp:
+            try:
+                mirror = self.get_mirror()
+                if mirror.supported:
+                    with mirror.lock:
+                        if self.update_mirror(mirror):
+                            self.values = dict(mirror.values)
+                            return self.values
+            except Exception as err:
+                msg = f'Error getting changed values! {err}'
+                if DEBUG and not 'timed out' in msg:
+                    print(msg)
+                self.close(True)
+        return self.get_all_values()
+
+    def get_all_values(self):
         '''Requests all values from server, returns a map of all found values. This map may be incomplete due to lost packets.'''
         with self.io_lock:
             self.values = {}
-            if self.connection == None or self.tcp:
+            if self.tcp and self.session and not self.in_session:
                 self.init_connection()
-            self.connection.sendto(all_request, self.addr)
+            if not self.in_session:
+                if self.connection == None or self.tcp:
+                    self.init_connection()
+                self.connection.sendto(all_request, self.addr)
 
             msg = b''
             if self.tcp:
                 try:
-                    _msg = self.connection.recvfrom(BUFSIZE)[0]
-                    msg = _msg
-
-                    while _msg != b'':
-                        _msg = self.connection.recvfrom(BUFSIZE)[0]
-                        msg = msg + _msg
-                    
-                    done = False
-                    while not done:
-                        next_dalim = msg.index(DALIM)
-                        key = msg[0:next_dalim]
-                        if key[2:] != b'success!':
-                            if key == b'':
-                                break
-                            size = (key[0]&31) + ((key[1]&31) << 5)
-                            value = msg[0: size + 2]
-                            data = value
-                            msg = msg[size + 2:]
-                            success, key, unpacked = unpack_value(data)
-                            if success:
-                                self.values[key] = unpacked
-                        else:
-                            done = True
-                        done = done or msg == b''
+                    if self.in_session:
+                        # In a session the entire response is a single frame
+                        msg = self.send_frames([all_request])[0]
+                    else:
+                        msg = recv_all(self.connection)
+
+                    self.values.update(unpack_values(msg))
                 except KeyboardInterrupt:
                     pass
                 except Exception as err:
-                    _msg = f'Error getting all value! {err}, {msg}'
-                    if 'timed out' in _msg:
-                        done = True
-                    elif DEBUG:
+                    _msg = f'Error getting all value! {err}'
+                    if DEBUG and not 'timed out' in _msg:
                         print(_msg)
                     self.close(True)
             return self.values
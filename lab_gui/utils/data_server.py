@@ -1,16 +1,34 @@
 #!/usr/bin/env python3
 
 import socket
+import selectors
+import queue
+import collections
+import itertools
+import heapq
 import threading
 import time
 import struct
 import os
 import json
+import zlib
+import bisect
+import fnmatch
+import re
+import shutil
+import concurrent.futures
 
 import numpy as np
 import datetime
 from dateutil import parser
 
+try:
+    from .data_client import pack_frame, split_values, pack_size, unpack_size, unpack_arrays, ArrayValue
+    from .data_client import FRAME_HEADER, LARGE_SIZE, LARGE_HEADER, DECODERS, TYPES
+except ImportError:
+    from data_client import pack_frame, split_values, pack_size, unpack_size, unpack_arrays, ArrayValue
+    from data_client import FRAME_HEADER, LARGE_SIZE, LARGE_HEADER, DECODERS, TYPES
+
 # Some standard message components
 DELIM = b'\x1e\x1e'
 DALIM = b'\x1d\x1d'
@@ -26,13 +44,70 @@ MODE_ERR = b'mode_err!'
 UNPACK_ERR = b'unpack_err'
 SUCCESS = b'success!'
 CALLBACK = b'callback'
+SESSION = b'session'
+STREAM = b'stream'
+MGET = b'mget'
+MSET = b'mset'
+CHANGES = b'changes'
+RECENT = b'recent'
+FULL = b'full'
+DELTA = b'delta'
 FILLER = b"??"
 BUFSIZE = 1024
+UDP_BUFSIZE = 65536
+
+# Messages larger than this are read into a buffer allocated for them, rather than accumulated
+LARGE_MESSAGE = 65536
+# Connections sending messages larger than this are dropped
+MAX_MESSAGE = 256*1024*1024
+
+# Modes whose data starts with a size header, rather than FILLER
+SIZED_MODES = (SET, CALLBACK, MSET)
 
 SAVE_DIR = "./_data_cache/"
 BACK_DIR = "./_data_cache_old/"
 MAX_FILESIZE = 20*1024*1024
 
+# Numeric values are also saved aggregated into buckets of these widths in seconds, 
+# for long time range queries, see LevelBuilder
+LEVEL_DIR = "./_data_cache_levels/"
+LEVELS = (1, 10, 60, 600)
+
+# How long the logs are kept, by fnmatch pattern of the key, the first which matches is used.
+# Each is a list of [width, days], width 0 is the raw values, the others are of LEVELS, and days 
+# of None is forever. Levels not listed are kept as long as the widest listed one narrower than them.
+# eg {'*': [[0, 7], [1, 90], [60, None]]} keeps the raw values for 7 days, the 1s and 10s levels 
+# for 90 days, and the 60s and 600s levels forever. See LogCompactor.
+RETENTION = {'*': [[0, None]]}
+
+# Old log segments are compressed, these are the codecs for that by file suffix.
+# zlib is always available, zstd or lz4 are preferred if they are installed.
+LOG_CODECS = {'.dat_z': (zlib.compress, zlib.decompress)}
+LOG_CODEC = '.dat_z'
+try:
+    import lz4.frame
+    LOG_CODECS['.dat_lz4'] = (lz4.frame.compress, lz4.frame.decompress)
+    LOG_CODEC = '.dat_lz4'
+except ImportError:
+    pass
+try:
+    import zstandard
+    # The zstd (de)compressors aren't thread safe, so a new one is made for each segment
+    LOG_CODECS['.dat_zst'] = (lambda data: zstandard.ZstdCompressor().compress(data), 
+                              lambda data: zstandard.ZstdDecompressor().decompress(data))
+    LOG_CODEC = '.dat_zst'
+except ImportError:
+    pass
+
+def log_suffix(filename):
+    '''Returns the suffix of the log file, ie .dat or one of the LOG_CODECS, or None if not a log file'''
+    if filename.endswith('.dat'):
+        return '.dat'
+    for suffix in LOG_CODECS:
+        if filename.endswith(suffix):
+            return suffix
+    return None
+
 # Server -> client messages
 SETSUCCESS = SUCCESS + DALIM + SET
 ALLSUCCESS = SUCCESS + DALIM + ALL
@@ -41,6 +116,13 @@ KEY_ERR_MSG = KEY_ERR + DALIM + KEY_ERR
 HELLO_FROM_SERVER = HELLO + DALIM + HELLO
 CLOSED = SUCCESS + DALIM + CLOSE
 CALLBACK_SUCCESS = CALLBACK + DALIM + SUCCESS
+SESSION_OK = SUCCESS + DALIM + SESSION
+STREAM_OK = SUCCESS + DALIM + STREAM
+MSETSUCCESS = SUCCESS + DALIM + MSET
+CHANGESSUCCESS = SUCCESS + DALIM + CHANGES
+
+# Adds prints if things go wrong
+DEBUG = False
 
 ADDR = ("0.0.0.0", 0)
 LOG_ADDR = ("0.0.0.0", 0)
@@ -107,14 +189,677 @@ class ServerProvider:
             except Exception as err:
                 print(f"Error sending info: {err}")
 
+def pack_get(key, value):
+    '''Packs key and value as a response to a GET, this is prefixed by the size'''
+    msg = key+DALIM+value
+    return pack_size(len(msg)) + msg
+
+def message_size(message):
+    '''Returns the full length of message, based on its size header, None if it does not 
+    have one, or -1 if we have not yet got all of the size header.'''
+    mode, sep, data = message.partition(DELIM)
+    if not sep or not mode in SIZED_MODES:
+        return None
+    if len(data) < 2 or (data[0] == LARGE_SIZE and len(data) < LARGE_HEADER.size):
+        return -1
+    size, header = unpack_size(data)
+    return len(mode) + len(DELIM) + header + size
+
+class HistoryRing:
+    '''Ring buffer of the recent times and values for a key, 
+    these are stored as the rows of a single (2, size) float64 array'''
+    def __init__(self, size) -> None:
+        self.data = np.empty((2, size))
+        self.start = 0
+        self.count = 0
+
+    def size(self):
+        return self.data.shape[1]
+
+    def append(self, time, value):
+        size = self.data.shape[1]
+        i = self.start + self.count
+        if i >= size:
+            i -= size
+        self.data[0, i] = time
+        self.data[1, i] = value
+        if self.count < size:
+            self.count += 1
+        else:
+            self.start = self.start + 1 if self.start + 1 < size else 0
+
+    def grow(self, size):
+        '''Re-allocates to size, keeping the present values'''
+        data = np.empty((2, size))
+        data[:, :self.count] = self.window()
+        self.data = data
+        self.start = 0
+
+    def window(self, since=None, count=None, seconds=None):
+        '''Returns the values in time order, as a (2, n) array of times and values. 
+        The values are those after since, and within seconds of the newest value, and then 
+        at most the count newest. If there are values before since, the newest of those is 
+        also included, this lets the caller know the window is complete.'''
+        size = self.data.shape[1]
+        end = self.start + self.count
+        if end <= size:
+            data = self.data[:, self.start:end]
+        else:
+            data = np.concatenate((self.data[:, self.start:], self.data[:, :end - size]), axis=1)
+        if seconds is not None and data.shape[1]:
+            data = data[:, np.searchsorted(data[0], data[0, -1] - seconds):]
+        if since is not None:
+            data = data[:, max(0, np.searchsorted(data[0], since, side='right') - 1):]
+        if count is not None:
+            data = data[:, -count:]
+        return data
+
+class RecentHistory:
+    '''The recent history for each numeric key on the server, kept in memory.
+    
+    Each key has a HistoryRing, which starts small and grows as values are added, up to 
+    length values. Once budget bytes are used in total, rings stop growing, and just wrap. 
+    If seconds is not None, values older than that are not returned.'''
+
+    def __init__(self, length=65536, seconds=None, budget=256*1024**2, initial=1024) -> None:
+        self.length = length
+        self.seconds = seconds
+        self.budget = budget
+        self.initial = initial
+        self.used = 0
+        self.rings = {}
+        self.lock = threading.Lock()
+
+    def add(self, key, value):
+        '''Adds the packed value for key, only the numeric types are kept'''
+        id = value[0]
+        if id > 3 or not id in DECODERS:
+            return
+        time, value = DECODERS[id](value)
+        with self.lock:
+            if key in self.rings:
+                ring = self.rings[key]
+            else:
+                size = min(self.initial, self.length)
+                if self.used + size * 16 > self.budget:
+                    return
+                ring = HistoryRing(size)
+                self.rings[key] = ring
+                self.used += size * 16
+            size = ring.size()
+            if ring.count == size and size < self.length:
+                new_size = min(size * 2, self.length)
+                if self.used + (new_size - size) * 16 <= self.budget:
+                    ring.grow(new_size)
+                    self.used += (new_size - size) * 16
+            ring.append(time, value)
+
+    def window(self, key, since=None, count=None):
+        '''Returns a copy of the window for key from HistoryRing.window, or None if we have no history for it'''
+        with self.lock:
+            if not key in self.rings:
+                return None
+            return np.array(self.rings[key].window(since, count, self.seconds))
+
+    def clear(self):
+        with self.lock:
+            self.rings.clear()
+            self.used = 0
+
+class CallbackTarget:
+    '''A client registered for callbacks. This holds only the latest value pending 
+    for each key, and when each key was last sent, for rate limiting.'''
+
+    def __init__(self, addr) -> None:
+        self.addr = addr
+        # Maximum updates per second for each key, 0 for no limit
+        self.rates = {}
+        self.pending = collections.OrderedDict()
+        self.last_sent = {}
+        self.timeouts = 0
+        # Whether we are in the dispatcher's schedule, or being sent by a worker
+        self.scheduled = False
+        self.busy = False
+
+    def interval(self, key):
+        rate = self.rates.get(key, 0)
+        return 1.0 / rate if rate > 0 else 0
+
+    def offer(self, key, value, max_pending):
+        '''Sets the pending value for key, replacing any value not yet sent'''
+        if key in self.pending:
+            self.pending[key] = value
+            return
+        if len(self.pending) >= max_pending:
+            # Drop the oldest pending key to stay bounded
+            self.pending.popitem(last=False)
+        self.pending[key] = value
+
+    def next_due(self):
+        '''Returns the earliest time one of the pending values may be sent'''
+        return min([self.last_sent.get(key, 0) + self.interval(key) for key in self.pending])
+
+    def take_due(self, now):
+        '''Removes and returns the pending (key, value) pairs which the rate limits allow sending now'''
+        due = []
+        for key, value in self.pending.items():
+            if now >= self.last_sent.get(key, 0) + self.interval(key):
+                due.append((key, value))
+        for key, _ in due:
+            del self.pending[key]
+            self.last_sent[key] = now
+        return due
+
+    def restore(self, dispatcher, items):
+        '''Puts back items which were not sent, unless newer values arrived meanwhile'''
+        with dispatcher.cond:
+            for key, value in items:
+                if not key in self.pending:
+                    self.offer(key, value, dispatcher.max_pending)
+
+    def send(self, dispatcher, items):
+        '''Sends items by connecting to our address for each value, 
+        returns how long to wait before trying us again'''
+        for n, (key, value) in enumerate(items):
+            msg = pack_get(key, value)
+            connection = socket.socket()
+            connection.settimeout(dispatcher.timeout)
+            try:
+                connection.connect(self.addr)
+                connection.sendall(msg)
+                self.timeouts = 0
+            except TimeoutError:
+                # Timeout could just mean latency on client end, so don't cleanup here
+                self.timeouts += 1
+                if self.timeouts > dispatcher.max_timeouts:
+                    print(f"Removing {self.addr} due to timeout")
+                    dispatcher.remove_target(self.addr)
+                    return 0
+                self.restore(dispatcher, items[n:])
+                return dispatcher.timeout * self.timeouts
+            except Exception as err:
+                # Other errors we can remove the client.
+                print(f"Removing {self.addr} due to error {err}")
+                dispatcher.remove_target(self.addr)
+                return 0
+            finally:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except Exception:
+                    pass
+                connection.close()
+        return 0
+
+class StreamTarget(CallbackTarget):
+    '''A client receiving callbacks over a persistent stream, here addr is the 
+    LoopConnection of the stream. Values due at the same time are sent together 
+    as a single frame.'''
+
+    # If the client has this much unread, we hold off on sending more
+    MAX_BACKLOG = 1024*1024
+
+    def send(self, dispatcher, items):
+        conn = self.addr
+        if conn.closed:
+            dispatcher.remove_target(conn)
+            return 0
+        if len(conn.outbuf) > StreamTarget.MAX_BACKLOG:
+            # Slow reader, keep the latest values pending until it catches up
+            self.restore(dispatcher, items)
+            return dispatcher.timeout
+        if len(items):
+            conn.write(pack_frame(b''.join([pack_get(key, value) for key, value in items])))
+        return 0
+
+class CallbackDispatcher:
+    '''Pushes new values to the registered callback targets on worker threads.
+
+    submit() only records the latest value for the key, so SETs do not wait on 
+    any targets. The workers then hand the values to each target listening for 
+    the key, where only the latest value per key is kept pending, and send them 
+    no faster than the rate the target asked for. Targets which stop responding 
+    are removed.'''
+
+    def __init__(self, workers=4, max_pending=1024, max_timeouts=10, timeout=0.1) -> None:
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_timeouts = max_timeouts
+        self.timeout = timeout
+        self.targets = {}
+        self.updates = {}
+        self.schedule = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.threads = []
+
+    def add_target(self, key, addr, rate=100):
+        '''Registers addr to receive values for key, at most rate times per second'''
+        with self.cond:
+            targets = callback_targets.setdefault(key, [])
+            for pair in targets:
+                if pair[0] == addr:
+                    targets.remove(pair)
+                    break
+            targets.append((addr, rate))
+            if not addr in self.targets:
+                if isinstance(addr, LoopConnection):
+                    self.targets[addr] = StreamTarget(addr)
+                else:
+                    self.targets[addr] = CallbackTarget(addr)
+            self.targets[addr].rates[key] = rate
+            self.start()
+
+    def remove_target(self, addr):
+        '''Removes addr from all keys in callback_targets'''
+        with self.cond:
+            for key, targets in list(callback_targets.items()):
+                for pair in list(targets):
+                    if pair[0] == addr:
+                        targets.remove(pair)
+                if len(targets) == 0:
+                    del callback_targets[key]
+            target = self.targets.pop(addr, None)
+            if target is not None:
+                target.pending.clear()
+
+    def submit(self, key, value):
+        '''Queues value to be sent to anything listening for key'''
+        if not key in callback_targets:
+            return
+        with self.cond:
+            self.updates[key] = value
+            self.cond.notify()
+
+    def start(self):
+        '''Starts the worker threads if not already running, should be called with cond held'''
+        if len(self.threads):
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.run, daemon=True, name=f"Callback Dispatcher {i}")
+            self.threads.append(thread)
+            thread.start()
+
+    def _schedule(self, target, due):
+        '''Adds target to the schedule, should be called with cond held'''
+        target.scheduled = True
+        heapq.heappush(self.schedule, (due, next(self.counter), target))
+        self.cond.notify()
+
+    def _distribute(self):
+        '''Hands the submitted values to the targets for their keys, should be called with cond held'''
+        updates = self.updates
+        self.updates = {}
+        for key, value in updates.items():
+            for addr, _ in callback_targets.get(key, []):
+                target = self.targets.get(addr)
+                if target is None:
+                    continue
+                target.offer(key, value, self.max_pending)
+                if not target.scheduled and not target.busy:
+                    self._schedule(target, target.next_due())
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if len(self.updates):
+                        self._distribute()
+                    now = time.time()
+                    if len(self.schedule) and self.schedule[0][0] <= now:
+                        break
+                    wait = self.schedule[0][0] - now if len(self.schedule) else None
+                    self.cond.wait(wait)
+                _, _, target = heapq.heappop(self.schedule)
+                target.scheduled = False
+                if not target.addr in self.targets:
+                    continue
+                target.busy = True
+                items = target.take_due(now)
+            retry = 0
+            try:
+                retry = target.send(self, items)
+            except Exception as err:
+                print(f"Error pushing callbacks to {target.addr}: {err}")
+            with self.cond:
+                target.busy = False
+                if not target.addr in self.targets:
+                    continue
+                if len(target.pending):
+                    self._schedule(target, max(target.next_due(), time.time() + retry))
+
+class LoopConnection:
+    '''A TCP client of a BaseDataServer, handled by a ServerLoop. 
+    
+    Handlers send to this the same as a socket, the data is buffered and written
+    as the socket allows. A connection starts out as a one-shot connection, where 
+    it is closed after responding to a single message. If it receives a SESSION 
+    command, it is instead kept open and read as length-prefixed frames.'''
+
+    def __init__(self, loop, server, sock, address) -> None:
+        self.loop = loop
+        self.server = server
+        self.sock = sock
+        self.address = address
+        self.session = False
+        # Streams are sessions which values are pushed to, see BaseDataServer.on_stream
+        self.stream = False
+        self.closing = False
+        self.closed = False
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.pending = []
+        # Large messages are read straight into a buffer of their size, see expect()
+        self.large = None
+        self.filled = 0
+        self.lock = threading.Lock()
+
+    def send(self, data):
+        '''Adds data to the response for the message presently being handled'''
+        self.pending.append(data)
+        return len(data)
+
+    def sendto(self, data, _=None):
+        return self.send(data)
+
+    def write(self, data):
+        '''Writes data to the socket, anything the socket does not take immediately is 
+        sent by the loop later. This can be called from any thread.'''
+        with self.lock:
+            if self.closed:
+                return False
+            self.outbuf += data
+            self._flush()
+            waiting = len(self.outbuf) > 0
+        if waiting or self.closing:
+            self.loop.call_soon(self.update_events)
+        return True
+
+    def _flush(self):
+        '''Sends as much of outbuf as we can without blocking, should be called with lock held'''
+        try:
+            while len(self.outbuf):
+                n = self.sock.send(self.outbuf)
+                del self.outbuf[:n]
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as err:
+            if DEBUG:
+                print(f"Error writing to {self.address}: {err}")
+            self.outbuf.clear()
+            self.closing = True
+
+    def dispatch(self, message):
+        '''Runs the handler for the message, and then writes the response'''
+        framed = self.session
+        try:
+            self.server.handle_message(message, self.address, self)
+        except Exception as err:
+            print(f"Error handling message from {self.address}: {err}")
+        resp = b''.join(self.pending)
+        self.pending.clear()
+        if framed and (len(resp) or not self.stream):
+            resp = pack_frame(resp)
+        elif not self.session:
+            # One-shot connections get closed once the response is sent
+            self.closing = True
+        if len(resp):
+            self.write(resp)
+        elif self.closing:
+            self.loop.call_soon(self.update_events)
+
+    def expect(self, size):
+        '''Allocates the buffer for a message of size, the start of which is in inbuf'''
+        if size > MAX_MESSAGE:
+            print(f"Message from {self.address} too large: {size}")
+            self.close()
+            return
+        self.large = bytearray(size)
+        self.filled = len(self.inbuf)
+        self.large[0:self.filled] = self.inbuf
+        self.inbuf.clear()
+
+    def read_large(self):
+        '''Reads into the buffer from expect(), and dispatches it once full'''
+        try:
+            n = self.sock.recv_into(memoryview(self.large)[self.filled:])
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            n = 0
+        if n == 0:
+            self.close()
+            return
+        self.filled += n
+        if self.filled == len(self.large):
+            message = bytes(self.large)
+            self.large = None
+            self.dispatch(message)
+
+    def on_readable(self):
+        if self.large is not None:
+            self.read_large()
+            return
+        try:
+            data = self.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if data == b'':
+            self.close()
+            return
+        self.inbuf += data
+        if not self.session:
+            if self.closing:
+                # Already responded, so nothing more to read
+                self.inbuf.clear()
+                return
+            size = message_size(self.inbuf)
+            if size is None or (size >= 0 and len(self.inbuf) >= size):
+                message = bytes(self.inbuf)
+                self.inbuf.clear()
+                self.dispatch(message)
+            elif size > 0:
+                self.expect(size)
+            return
+        header = FRAME_HEADER.size
+        while len(self.inbuf) >= header:
+            size = FRAME_HEADER.unpack_from(self.inbuf)[0]
+            if len(self.inbuf) < header + size:
+                if size > LARGE_MESSAGE:
+                    del self.inbuf[:header]
+                    self.expect(size)
+                break
+            message = bytes(self.inbuf[header:header + size])
+            del self.inbuf[:header + size]
+            self.dispatch(message)
+
+    def on_writable(self):
+        with self.lock:
+            self._flush()
+        self.update_events()
+
+    def update_events(self):
+        '''Selects for writing if we have things to send, or closes if we are done'''
+        if self.closed:
+            return
+        with self.lock:
+            waiting = len(self.outbuf) > 0
+        if waiting:
+            self.loop.modify(self.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, self)
+        elif self.closing:
+            self.close()
+        else:
+            self.loop.modify(self.sock, selectors.EVENT_READ, self)
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        if self.stream:
+            self.server.dispatcher.remove_target(self)
+        self.loop.unregister(self.sock)
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+
+class ServerLoop:
+    '''Event loop which multiplexes the sockets of BaseDataServers on a single thread.
+
+    This handles accepting TCP connections, reading messages from TCP and UDP 
+    sockets, and dispatching them to the server's functions, without blocking on 
+    any single client.'''
+
+    def __init__(self) -> None:
+        self.selector = selectors.DefaultSelector()
+        self.servers = []
+        self.connections = {}
+        self._running_ = False
+        self.loop_thread = None
+        self.call_lock = threading.Lock()
+        self.calls = collections.deque()
+        # Used to wake the select call when other threads want things done
+        self.waker_r, self.waker_w = socket.socketpair()
+        self.waker_r.setblocking(False)
+        self.waker_w.setblocking(False)
+        self.selector.register(self.waker_r, selectors.EVENT_READ, None)
+
+    def add_server(self, server):
+        '''Adds the socket of server to the loop'''
+        server.loop = self
+        server.connection.setblocking(False)
+        self.servers.append(server)
+        self.selector.register(server.connection, selectors.EVENT_READ, server)
+
+    def call_soon(self, fn):
+        '''Runs fn on the loop thread, this can be called from any thread'''
+        if threading.current_thread() is self.loop_thread:
+            fn()
+            return
+        with self.call_lock:
+            self.calls.append(fn)
+        try:
+            self.waker_w.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def modify(self, sock, events, data):
+        try:
+            self.selector.modify(sock, events, data)
+        except (KeyError, ValueError):
+            pass
+
+    def unregister(self, sock):
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        self.connections.pop(sock, None)
+
+    def accept(self, server):
+        while True:
+            try:
+                sock, address = server.connection.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = LoopConnection(self, server, sock, address)
+            self.connections[sock] = conn
+            self.selector.register(sock, selectors.EVENT_READ, conn)
+
+    def read_udp(self, server):
+        # Limit how many we read at once, so that TCP clients still get a turn
+        for _ in range(64):
+            try:
+                message, address = server.connection.recvfrom(UDP_BUFSIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            if message == b'':
+                continue
+            try:
+                server.handle_message(message, address, None)
+            except Exception as err:
+                print(f"Error in udp message from {address}: {err}")
+
+    def run_calls(self):
+        try:
+            while self.waker_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        with self.call_lock:
+            calls = list(self.calls)
+            self.calls.clear()
+        for fn in calls:
+            try:
+                fn()
+            except Exception as err:
+                print(f"Error in server loop call: {err}")
+
+    def running(self):
+        return self._running_ and any([server._running_ for server in self.servers])
+
+    def run(self):
+        '''run loop entry point, probably best to run via a separate thread'''
+        self._running_ = True
+        self.loop_thread = threading.current_thread()
+        for server in self.servers:
+            server._running_ = True
+        while self.running():
+            try:
+                events = self.selector.select(timeout=0.25)
+            except OSError as err:
+                # Can happen if a server socket was closed on us
+                if self.running():
+                    print(f"Error in server loop select: {err}")
+                    time.sleep(0.01)
+                continue
+            for key, mask in events:
+                handler = key.data
+                try:
+                    if handler is None:
+                        self.run_calls()
+                    elif isinstance(handler, LoopConnection):
+                        if mask & selectors.EVENT_WRITE:
+                            handler.on_writable()
+                        if mask & selectors.EVENT_READ and not handler.closed:
+                            handler.on_readable()
+                    elif handler.tcp:
+                        self.accept(handler)
+                    else:
+                        self.read_udp(handler)
+                except Exception as err:
+                    print(f"Error in server loop: {err}")
+        for conn in list(self.connections.values()):
+            conn.close()
+        self._running_ = False
+
+    def make_thread(self):
+        '''Makes a daemon thread that runs our run loop when started'''
+        thread = threading.Thread(target=self.run, daemon=True)
+        return thread
+
 class BaseDataServer:
     '''Python server implementation'''
 
     values = {}
     pending_save = {}
     save_lock = threading.Lock()
+
+    # Every store bumps sequence, and changes holds the sequence each key was last 
+    # stored at, oldest first. epoch changes if the sequence numbers are no longer
+    # comparable, ie on restart or on CLEAR, and clients then fetch everything again.
+    sequence = 0
+    changes = collections.OrderedDict()
+    epoch = str(time.time_ns()).encode()
+    changes_lock = threading.Lock()
     provider_server = ServerProvider()
     provider_thread = threading.Thread(target=provider_server.run, daemon=True)
+    dispatcher = CallbackDispatcher()
+    history = RecentHistory()
 
     def __init__(self, addr=ADDR, tcp=False) -> None:
         self.tcp = tcp
@@ -136,7 +881,8 @@ class BaseDataServer:
     
         self._running_ = False
 
-        self.cb_timeouts = {}
+        # The ServerLoop handling our socket, made in run() if not assigned before.
+        self.loop = None
 
         # These are what are done on recieving messages
         # Adding extra things here can be used to make things
@@ -150,9 +896,17 @@ class BaseDataServer:
             OPEN: self.on_open,
             HELLO: self.on_hello,
             CALLBACK: self.on_callback,
+            SESSION: self.on_session,
+            STREAM: self.on_stream,
+            MGET: self.on_get_many,
+            MSET: self.on_set_many,
+            CHANGES: self.on_changes,
+            RECENT: self.on_recent,
         }
 
     def close(self):
+        if self.loop is not None and self.connection is not None:
+            self.loop.unregister(self.connection)
         if self.connection is not None:
             try:
                 self.connection.shutdown(socket.SHUT_RDWR)
@@ -168,35 +922,33 @@ class BaseDataServer:
         '''run loop entry point for the server, probably best to run via a separate thread'''
         self._running_ = True
         print(f'Starting Data Server! {self.port}')
-        while(self._running_):
-            self.run_loop()
+        if self.loop is None:
+            ServerLoop().add_server(self)
+        self.loop.run()
 
     def on_callback(self, address, data, conn):
+        '''processes the CALLBACK command, this registers the port to be sent values 
+        of the key. If sent over a stream, the values are instead sent on the stream.'''
+        stream = isinstance(conn, LoopConnection) and conn.stream
         try:
-            args = data.split(DALIM)
-            key = args[0][2:]
+            args = data[unpack_size(data)[1]:].split(DALIM)
+            key = args[0]
             port_arg = args[1]
 
             if(port_arg[0] == b'x'[0]):
                 port = int(args[1][1:].decode().replace('\x00', ''))
-                addr = (address[0], port)
-                for _, targets in callback_targets.items():
-                    if addr in targets:
-                        targets.remove(addr)
+                addr = conn if stream else (address[0], port)
+                BaseDataServer.dispatcher.remove_target(addr)
             else:
                 port = int(args[1].decode().replace('\x00', ''))
                 rate = int(args[2].decode().replace('\x00', '')) if len(args) > 2 else 100
-                targets = []
-                if key in callback_targets:
-                    targets = callback_targets[key]
-                else:
-                    callback_targets[key] = targets
-                addr = (address[0], port)
-                if not addr in targets:
-                    # print(f"New Callback: {key} {addr}")
-                    targets.append((addr, rate))
+                addr = conn if stream else (address[0], port)
+                BaseDataServer.dispatcher.add_target(key, addr, rate)
         except Exception as err:
             print(f"Error with callback set {err}")
+        if stream:
+            # Streams only receive values
+            return
         resp = CALLBACK_SUCCESS
         if conn != None:
             conn.send(resp)
@@ -205,7 +957,6 @@ class BaseDataServer:
 
     def on_open(self, address, _, conn):
         '''processes the OPEN comand, presently doesn't do anything'''
-        # TODO Decide if we want multiple threads for python version?
         resp = OPEN+DALIM+str(self.addr[1]).encode()
         if conn != None:
             conn.send(resp)
@@ -214,7 +965,6 @@ class BaseDataServer:
 
     def on_close(self, address, _, conn):
         '''processes the CLOSE comand, presently doesn't do anything'''
-        # TODO Decide if we want multiple threads for python version?
         resp = CLOSED
         if conn != None:
             conn.send(resp)
@@ -223,7 +973,39 @@ class BaseDataServer:
 
     def on_clear(self, address, _, conn):
         '''processes the CLEAR command, and clears the values map'''
-        BaseDataServer.values.clear()
+        with BaseDataServer.changes_lock:
+            BaseDataServer.values.clear()
+            BaseDataServer.changes.clear()
+            BaseDataServer.epoch = str(time.time_ns()).encode()
+        BaseDataServer.history.clear()
+
+    def on_session(self, address, _, conn):
+        '''processes the SESSION command, the connection is then kept open, 
+        and read as length-prefixed frames until the client disconnects'''
+        if not isinstance(conn, LoopConnection) or conn.session:
+            resp = MODE_ERR_MSG
+            if conn != None:
+                conn.send(resp)
+            else:
+                self.connection.sendto(resp, address)
+            return
+        conn.session = True
+        conn.send(SESSION_OK)
+
+    def on_stream(self, address, _, conn):
+        '''processes the STREAM command, the connection is then kept open, and the client
+        subscribes to keys by sending CALLBACK messages as frames. Values for those keys 
+        are then pushed as frames, each of which can contain several values.'''
+        if not isinstance(conn, LoopConnection) or conn.session:
+            resp = MODE_ERR_MSG
+            if conn != None:
+                conn.send(resp)
+            else:
+                self.connection.sendto(resp, address)
+            return
+        conn.session = True
+        conn.stream = True
+        conn.send(STREAM_OK)
 
     def on_hello(self, address, _, conn):
         '''processes the HELLO command and responds with a pong'''
@@ -234,11 +1016,7 @@ class BaseDataServer:
             self.connection.sendto(resp, address)
 
     def pack_get(self, key, value):        
-        msg = key+DALIM+value
-        size = len(msg)
-        var = struct.pack('<bb', size&31, size >> 5)
-        msg = var + msg
-        return msg
+        return pack_get(key, value)
 
     def on_get(self, address, data, conn):
         '''processes the GET command, and responds with the value in the map, or KEY_ERR'''
@@ -257,215 +1035,1026 @@ class BaseDataServer:
         if not self.tcp or conn == None:
             self.connection.sendto(MODE_ERR_MSG, address)
             return
-        resp = b''
-        for key in BaseDataServer.values.keys():
-            value = BaseDataServer.values[key] if key in BaseDataServer.values else KEY_ERR
-            msg = key+DALIM+value
-            size = len(msg)
-            var = struct.pack('<bb', size&31, size >> 5)
-            msg = var + msg
-            if len(msg) + len(resp) > BUFSIZE:
-                conn.send(resp)
-                resp = b''
-            resp = resp + msg
-        msg = ALLSUCCESS
-        if len(msg) + len(resp) > BUFSIZE:
-            conn.send(resp)
-            resp = msg
-        resp = resp + msg
-        conn.send(resp)
+        values = BaseDataServer.values
+        resp = [pack_get(key, value) for key, value in list(values.items())]
+        resp.append(ALLSUCCESS)
+        conn.send(b''.join(resp))
+
+    def store_value(self, key, value):
+        '''Stores value for key, and queues it for saving and callbacks.
+        Returns False if the value type does not match the existing one for key.'''
+        if key in BaseDataServer.values and BaseDataServer.values[key][0] != value[0]:
+            return False
+
+        if DEBUG and DataSaver.get_value_len(value) != len(value):
+            print(f"Value size mismatch for {key}: {value}")
+
+        with BaseDataServer.changes_lock:
+            BaseDataServer.values[key] = value
+            BaseDataServer.sequence += 1
+            BaseDataServer.changes[key] = BaseDataServer.sequence
+            BaseDataServer.changes.move_to_end(key)
+        BaseDataServer.history.add(key, value)
+        with BaseDataServer.save_lock:
+            to_log = []
+            if key in BaseDataServer.pending_save:
+                to_log = BaseDataServer.pending_save[key]
+            else:
+                BaseDataServer.pending_save[key] = to_log
+            to_log.append(value)
+
+        # Pushing to callbacks is done by the dispatcher's thread
+        BaseDataServer.dispatcher.submit(key, value)
+        return True
 
     def on_set(self, address, data, conn):
         '''processes the SET command, and responds with SETSUCCESS'''
-        s_args = data.split(DALIM)
-        had = False
         try:
-            key = s_args[0][2:]
-            value = s_args[1]
+            size, header = unpack_size(data)
+            key, _, value = data[header:header + size].partition(DALIM)
             resp = SETSUCCESS
             if key in BaseDataServer.values and BaseDataServer.values[key][0] != value[0]:
+                # Type changed, so reject the set
                 resp = KEY_ERR_MSG
+            if conn != None:
+                conn.send(resp)
             else:
-
-                if DataSaver.get_value_len(value) != len(value):
-                    time.sleep(0.1)
-                    print("???", value, conn.recv(64))
-                    
-                if conn != None:
-                    conn.send(resp)
-                else:
-                    self.connection.sendto(resp, address)
-
-                BaseDataServer.values[key] = value
-                with BaseDataServer.save_lock:
-                    to_log = []
-                    if key in BaseDataServer.pending_save:
-                        to_log = BaseDataServer.pending_save[key]
-                    else:
-                        BaseDataServer.pending_save[key] = to_log
-                    to_log.append(value)
-                    
-                if key in callback_targets:
-                    targets = callback_targets[key]
-                    for pair in targets:
-                        addr, _ = pair
-                        # TODO rate throttle the callbacks using _ above
-                        connection = socket.socket()
-                        connection.settimeout(0.1)
-                        try:
-                            connection.connect(addr)
-                            msg = self.pack_get(key, value)
-                            connection.sendto(msg, addr)
-                            self.cb_timeouts[addr] = 0
-                        except TimeoutError:
-                            # Timeout could just mean latency on client end, so don't cleanup here
-                            if addr in self.cb_timeouts:
-                                self.cb_timeouts[addr] += 1
-                            else:
-                                self.cb_timeouts[addr] = 1
-                            if self.cb_timeouts[addr] > 10:
-                                print(f"Removing {addr} due to timeout")
-                                targets.remove(pair)
-                                for key2, list in callback_targets.items():
-                                    if key != key2 and addr in list:
-                                        list.remove(addr)
-                        except Exception as err:
-                            # Other errors we can remove the client.
-                            print(f"Removing {addr} due to error {err}")
-                            targets.remove(pair)
-                            for key2, list in callback_targets.items():
-                                if key != key2 and addr in list:
-                                    list.remove(addr)
-                        try:
-                            connection.shutdown(socket.SHUT_RDWR)
-                            connection.close()
-                        except Exception:
-                            pass
-                    if len(targets) == 0:
-                        del callback_targets[key]
+                self.connection.sendto(resp, address)
+            if resp == SETSUCCESS:
+                self.store_value(key, value)
         except Exception as err:
             print(f'error setting value {err}')
-        if had:
-            print(f"Finished Set {key}")
 
-    def run_loop(self):
-        '''The contents of the run loop, this waits for messages and responds to them accordingly'''
+    def on_get_many(self, address, data, conn):
+        '''processes the MGET command, the keys are separated by DALIM, and the response is 
+        the values for each, packed as for GET, in the same order'''
+        keys = data[2:].split(DALIM)
+        values = BaseDataServer.values
+        resp = b''.join([pack_get(key, values[key] if key in values else KEY_ERR) for key in keys])
+        if conn != None:
+            conn.send(resp)
+        else:
+            self.connection.sendto(resp, address)
 
-        args = []
-        address = ''
+    def on_changes(self, address, data, conn):
+        '''processes the CHANGES command, data is the epoch and sequence number from the last 
+        response the client got. Responds with the values changed since then, packed as for GET, 
+        followed by CHANGESSUCCESS, the present epoch and sequence, and whether this was a FULL 
+        response of all values, or a DELTA of only the changes.'''
+        if not self.tcp or conn == None:
+            self.connection.sendto(MODE_ERR_MSG, address)
+            return
         try:
-            if self.tcp:
-                conn, address = self.connection.accept()
-                message = conn.recv(BUFSIZE)
+            epoch, _, since = data[2:].partition(DALIM)
+            since = int(since.decode())
+        except Exception:
+            epoch, since = b'', 0
+        values = BaseDataServer.values
+        changes = BaseDataServer.changes
+        with BaseDataServer.changes_lock:
+            sequence = BaseDataServer.sequence
+            full = epoch != BaseDataServer.epoch or since > sequence
+            if full:
+                keys = list(values.keys())
             else:
-                conn = None
-                bytesAddressPair = self.connection.recvfrom(BUFSIZE)
-                message = bytesAddressPair[0]
-                address = bytesAddressPair[1]
-            if message == b'':
-                return
+                # Newest are at the end, so walk back until we reach what the client has
+                keys = []
+                for key in reversed(changes):
+                    if changes[key] <= since:
+                        break
+                    keys.append(key)
+            resp = [pack_get(key, values[key]) for key in keys]
+            resp.append(DALIM.join([CHANGESSUCCESS, BaseDataServer.epoch, str(sequence).encode(), FULL if full else DELTA]))
+        conn.send(b''.join(resp))
+
+    def on_recent(self, address, data, conn):
+        '''processes the RECENT command, data is the key, and optionally the time since and the 
+        maximum number of values, separated by DALIM. Responds as for GET, with the value being
+        an array of the times and values, see HistoryRing.window, or KEY_ERR if we have no history.'''
+        args = data[2:].split(DALIM)
+        key = args[0]
+        since = None
+        count = None
+        try:
+            if len(args) > 1 and len(args[1]):
+                since = float(args[1].decode())
+            if len(args) > 2 and len(args[2]):
+                count = int(args[2].decode())
+        except Exception as err:
+            print(f"Error in recent request {err}")
+        window = BaseDataServer.history.window(key, since, count)
+        if window is None:
+            resp = pack_get(key, KEY_ERR)
+        else:
+            var = ArrayValue()
+            var.time = time.time()
+            var.value = window
+            resp = pack_get(key, var.pack())
+        if conn != None:
+            conn.send(resp)
+        else:
+            self.connection.sendto(resp, address)
 
-            args = message.split(DELIM)
-            mode = args[0]
-            if len(args) > 1:
-                data = args[1]
-            else:
-                data = b''
+    def on_set_many(self, address, data, conn):
+        '''processes the MSET command, data is several values packed as for SET, one after another.
+        Responds with MSETSUCCESS followed by a byte for each value, 1 if it was set, 0 if not.'''
+        flags = []
+        try:
+            size, header = unpack_size(data)
+            for record in split_values(data[header:header + size]):
+                key, _, value = record[unpack_size(record)[1]:].partition(DALIM)
+                flags.append(len(value) > 0 and self.store_value(key, value))
+        except Exception as err:
+            print(f'error setting values {err}')
+        resp = MSETSUCCESS + DALIM + bytes(flags)
+        if conn != None:
+            conn.send(resp)
+        else:
+            self.connection.sendto(resp, address)
 
-            if mode in self.functions:
-                self.functions[mode](address, data, conn)
-            else:
-                self.connection.sendto(MODE_ERR, address, conn)
+    def handle_message(self, message, address, conn):
+        '''Runs the function associated with the mode of the message, returns the split message'''
+        # Only the first DELIM separates the mode, as binary values may contain it too
+        mode, _, data = message.partition(DELIM)
+        args = [mode, data]
 
-        except Exception as err:
-            if self._running_:
-                print(f"Error in server run loop: {err}, {args}, {address}")
+        if mode in self.functions:
+            self.functions[mode](address, data, conn)
+        elif conn != None:
+            conn.send(MODE_ERR_MSG)
+        else:
+            self.connection.sendto(MODE_ERR_MSG, address)
+        return args
 
-    def make_thread(self):
-        '''Makes a daemon thread that runs our run loop when started'''
-        thread = threading.Thread(target=self.run, daemon=True)
+    def register_provider(self):
+        '''Lets the provider server know about us, so that clients can find us'''
         if self.tcp:
             BaseDataServer.provider_server.server_tcp = self
         else:
             BaseDataServer.provider_server.server_udp = self
+
+    def make_thread(self):
+        '''Makes a daemon thread that runs our run loop when started'''
+        thread = threading.Thread(target=self.run, daemon=True)
+        self.register_provider()
         return thread
     
 class DataSaver:
+    '''Writes the values in BaseDataServer.pending_save to the log files.
+
+    Each pass swaps out the pending values under save_lock, and then writes each key's 
+    values with a single write, so SETs are not blocked by the disk. File handles are kept 
+    open, up to max_open of them, with the least recently used being closed first.
+
+    If flush, files are flushed after each pass, so that the LogServer can read the values.
+    fsync_interval is how often (in seconds) the files are also fsynced, None to leave that
+    to the OS, or 0 to fsync after every pass.'''
+
+    # Size of each of the fixed size types, by id
+    SIZES = {TYPE().id: TYPE().size() for TYPE in TYPES if not hasattr(TYPE, 'packed_size')}
 
     def get_value_len(value):  
-        try:
-            from .data_client import TYPES
-        except:
-            from data_client import TYPES      
         id = value[0]
-        TYPE = TYPES[id - 1]
-        tst = TYPE()
-        length = tst.size()
-        return length
-
-    def __init__(self) -> None:
-        self.save_delay = 0.25
+        if id < 1 or id > len(TYPES):
+            # Not a fixed size type, ie pickled, these are not saved
+            return -1
+        if id in DataSaver.SIZES:
+            return DataSaver.SIZES[id]
+        # Variable sized, but the size is in the header
+        return TYPES[id - 1].packed_size(value)
+
+    # Notified after each pass, see LogServer.tail_loop
+    saved = threading.Condition()
+
+    def __init__(self, save_delay=0.25, max_open=256, flush=True, fsync_interval=None) -> None:
+        self.save_delay = save_delay
+        self.max_open = max_open
+        self.flush = flush
+        self.fsync_interval = fsync_interval
+        self.last_fsync = time.time()
         self._running_ = False
+        # key -> open file, least recently used first
+        self.files = collections.OrderedDict()
+        # key -> size of the file, so we don't need to stat them
+        self.sizes = {}
+        # key -> LevelBuilder for the numeric keys
+        self.levels = {}
         if not os.path.exists(SAVE_DIR):
             os.makedirs(SAVE_DIR)
         if not os.path.exists(BACK_DIR):
             os.makedirs(BACK_DIR)
+        if not os.path.exists(LEVEL_DIR):
+            os.makedirs(LEVEL_DIR)
+
+    def get_file(self, key, filename=None):
+        '''Returns the open file for key, opening it if needed, the default filename is the log for key'''
+        if key in self.files:
+            self.files.move_to_end(key)
+            return self.files[key]
+        while len(self.files) >= self.max_open:
+            _, file = self.files.popitem(last=False)
+            file.close()
+        if filename is None:
+            filename = SAVE_DIR + key + ".dat"
+        file = open(filename, 'ab')
+        self.files[key] = file
+        self.sizes[key] = file.tell()
+        return file
+
+    def close_file(self, key):
+        if key in self.files:
+            self.files.pop(key).close()
+
+    def check_values(self, key, values):
+        '''Returns the values which are the correct size to be saved'''
+        size = DataSaver.SIZES.get(values[0][0], 0)
+        if size > 0:
+            good = [value for value in values if len(value) == size]
+        else:
+            good = [value for value in values if DataSaver.get_value_len(value) == len(value)]
+        if len(good) != len(values):
+            value = values[0]
+            size = DataSaver.get_value_len(value)
+            if size > 0 or DEBUG:
+                print(f"Value size error? {size} != {len(value)}, {key}, {value[0:64]}")
+        return good
+
+    def save(self, pending):
+        '''Writes the values in pending, a map of key to list of values'''
+        for key, values in pending.items():
+            if not len(values):
+                continue
+            key = key.decode()
+            try:
+                values = self.check_values(key, values)
+                if not len(values):
+                    continue
+                data = b''.join(values)
+                file = self.get_file(key)
+                file.write(data)
+                self.sizes[key] += len(data)
+                if self.sizes[key] > MAX_FILESIZE:
+                    self.rotate(key)
+                self.save_levels(key, data)
+            except Exception as err:
+                print(f"Error while saving value: {err}")
+
+        now = time.time()
+        fsync = self.fsync_interval is not None and now - self.last_fsync >= self.fsync_interval
+        if not self.flush and not fsync:
+            return
+        for file in self.files.values():
+            try:
+                file.flush()
+                if fsync:
+                    os.fsync(file.fileno())
+            except Exception as err:
+                print(f"Error while flushing log: {err}")
+        if fsync:
+            self.last_fsync = now
+
+    def save_levels(self, key, data):
+        '''Adds the values in data to the levels for key, and writes the buckets completed'''
+        dtype = record_dtype(data[0])
+        if dtype is None:
+            return
+        if not key in self.levels:
+            self.levels[key] = LevelBuilder()
+        records = np.frombuffer(data, dtype=dtype)
+        self.write_levels(key, self.levels[key].add(records['time'], records['value']))
+
+    def write_levels(self, key, done):
+        for width, buckets in done.items():
+            if len(buckets):
+                self.get_file((key, width), level_filename(key, width)).write(buckets.tobytes())
+
+    def rotate(self, key):
+        '''Moves the file for key over to BACK_DIR, a new one is then started'''
+        self.close_file(key)
+        self.sizes.pop(key, None)
+        filename = SAVE_DIR + key + ".dat"
+        filename_bak = BACK_DIR + key + ".dat"
+        print("Moving file ", filename, filename_bak)
+        # process_old_dir indexes it, when it adds it to the catalog
+        # The levels so far go along with it, before it, so they are there once it is
+        for width in LEVELS:
+            self.close_file((key, width))
+            try:
+                os.replace(level_filename(key, width), f"{BACK_DIR}{key}_{width}.lvl")
+            except FileNotFoundError:
+                pass
+        os.replace(filename, filename_bak)
+
+    def take_pending(self):
+        '''Swaps out the pending values, and returns the old ones'''
+        with BaseDataServer.save_lock:
+            pending = BaseDataServer.pending_save
+            BaseDataServer.pending_save = {}
+        return pending
+
+    def close(self):
+        '''Saves anything still pending, and closes the files'''
+        self.save(self.take_pending())
+        for key, levels in self.levels.items():
+            try:
+                self.write_levels(key, levels.close())
+            except Exception as err:
+                print(f"Error while saving levels: {err}")
+        self.levels.clear()
+        for file in self.files.values():
+            file.close()
+        self.files.clear()
 
     def run(self):
         self._running_ = True
         while self._running_:
             time.sleep(self.save_delay)
-            values = []
-            with BaseDataServer.save_lock:
-                for key, values in BaseDataServer.pending_save.items():
-                    if not len(values):
-                        continue
-                    key = key.decode()
-                    filename = SAVE_DIR + key + ".dat"
-                    try:
-                        file = open(filename, 'ab')
-                        while(len(values)):
-                            value = values.pop(0)
-                            # Ensure lenghth is correct
-                            size = DataSaver.get_value_len(value)
-                            if size != len(value):
-                                print(f"Value size error? {size} != {len(value)}, {key}, {value}")
-                                continue
-                            file.write(value)
-                        file.close()
-                        file_stats = os.stat(filename)
-                        if file_stats.st_size > MAX_FILESIZE:
-                            filename_bak = BACK_DIR + key + ".dat"
-                            print("Moving file ", filename, filename_bak)
-                            if os.path.exists(filename_bak):
-                                os.replace(filename, filename_bak)
-                            else:
-                                os.rename(filename, filename_bak)
-                            os.remove(filename)
-                    except Exception as err:
-                        print(f"Error while saving value: {err}")
-                        pass
+            self.save(self.take_pending())
+            # Wakes any LogTails in this process
+            with DataSaver.saved:
+                DataSaver.saved.notify_all()
+        self.close()
 
     def make_thread(self):
         '''Makes a daemon thread that runs our run loop when started'''
         thread = threading.Thread(target=self.run, daemon=True)
         return thread
     
+class LogCompressor:
+    '''Compresses the old log segments in dir (ie BACK_DIR/<key>/) using the codec for suffix, 
+    on a pool of workers threads. Each is verified by decompressing the result, and it then 
+    replaces the original segment.'''
+
+    def __init__(self, dir=BACK_DIR, suffix=LOG_CODEC, workers=2) -> None:
+        self.dir = dir
+        self.suffix = suffix
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.saved = 0
+
+    def find_segments(self):
+        '''Returns the uncompressed segments in our key folders'''
+        segments = []
+        for key in os.listdir(self.dir):
+            save_dir = os.path.join(self.dir, key)
+            if not os.path.isdir(save_dir):
+                continue
+            for file in os.listdir(save_dir):
+                if file.endswith('.dat'):
+                    segments.append(os.path.join(save_dir, file))
+        return segments
+
+    def compress(self, filename):
+        '''Compresses filename, returns the number of bytes saved'''
+        compress, decompress = LOG_CODECS[self.suffix]
+        target = filename.removesuffix('.dat') + self.suffix
+        tmp = target + '.tmp'
+        try:
+            with open(filename, 'rb') as file:
+                data = file.read()
+            packed = compress(data)
+            with open(tmp, 'wb') as file:
+                file.write(packed)
+                file.flush()
+                os.fsync(file.fileno())
+            with open(tmp, 'rb') as file:
+                if decompress(file.read()) != data:
+                    raise RuntimeError("Verification failed")
+            # Held by the LogCompactor and LogLoaders while they change the segments, 
+            # which may have removed this one while we were compressing it
+            key = os.path.basename(os.path.dirname(filename))
+            with LogLoader.locks[key]:
+                if not os.path.exists(filename):
+                    os.remove(tmp)
+                    return 0
+                os.replace(tmp, target)
+                os.remove(filename)
+            return len(data) - len(packed)
+        except Exception as err:
+            print(f"Error compressing log {filename}: {err}")
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return 0
+
+    def _compress(self, filename):
+        saved = self.compress(filename)
+        with self.lock:
+            self.saved += saved
+            self.pending.discard(filename)
+
+    def submit_all(self):
+        '''Queues any segments not yet compressed, returns the number queued'''
+        queued = 0
+        for filename in self.find_segments():
+            with self.lock:
+                if filename in self.pending:
+                    continue
+                self.pending.add(filename)
+            self.pool.submit(self._compress, filename)
+            queued += 1
+        return queued
+
+    def wait(self):
+        '''Waits for the queued segments to be done'''
+        while True:
+            with self.lock:
+                if not self.pending:
+                    return
+            time.sleep(0.05)
+
+class LogCompactor:
+    '''Applies the retention policy (see RETENTION) to the old log segments in dir, on a pool
+    of worker threads. Raw values past their time are removed, after making any level archives
+    which are kept longer that the segment did not already have, and then so are old levels.'''
+
+    def __init__(self, dir=BACK_DIR, policy=None, workers=1) -> None:
+        self.dir = dir
+        self.policy = RETENTION if policy is None else policy
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.removed = 0
+
+    def compact(self, key):
+        '''Applies the policy to the segments of key, returns the number of files removed'''
+        keep = retention_for(key, self.policy)
+        if all(seconds is None for seconds in keep.values()):
+            return 0
+        log = LogLoader(key, SAVE_DIR, self.dir)
+        now = time.time()
+        removed = 0
+        with log.lock:
+            log.catalog.update()
+            for name, entry in log.catalog.find(-np.inf, np.inf):
+                age = now - entry['last']
+                try:
+                    if entry.get('raw', True) and keep[0] is not None and age > keep[0]:
+                        # Only those which are still to be kept
+                        widths = [width for width in LEVELS if keep[width] is None or keep[width] > age]
+                        log.archive(name, entry, widths)
+                        log.drop_raw(name)
+                        removed += 1
+                    for width in entry.get('levels', []):
+                        if keep[width] is not None and age > keep[width]:
+                            log.drop_archive(name, width)
+                            removed += 1
+                except Exception as err:
+                    print(f"Error compacting log {name}: {err}")
+            if removed:
+                log.catalog.update(force=True)
+        return removed
+
+    def _compact(self, key):
+        try:
+            removed = self.compact(key)
+        except Exception as err:
+            print(f"Error compacting logs for {key}: {err}")
+            removed = 0
+        with self.lock:
+            self.removed += removed
+            self.pending.discard(key)
+
+    def submit_all(self):
+        '''Queues each key with old segments, which is not already, returns the number queued'''
+        queued = 0
+        for key in os.listdir(self.dir):
+            if not os.path.isdir(os.path.join(self.dir, key)):
+                continue
+            with self.lock:
+                if key in self.pending:
+                    continue
+                self.pending.add(key)
+            self.pool.submit(self._compact, key)
+            queued += 1
+        return queued
+
+    def wait(self):
+        '''Waits for the queued keys to be done'''
+        while True:
+            with self.lock:
+                if not self.pending:
+                    return
+            time.sleep(0.05)
+
+def record_dtype(id):
+    '''Returns the structured dtype of the records of type id in the logs, or None if they are not fixed size'''
+    if id < 1 or id > len(TYPES):
+        return None
+    return getattr(TYPES[id - 1], 'DTYPE', None)
+
+def decode_records(vars):
+    '''Decodes the records in vars, the contents of a log file, returns arrays of (times, values).
+    Arrays are returned as an array of objects, as the shapes can differ.'''
+    if not len(vars):
+        return np.empty(0), np.empty(0)
+    id = vars[0]
+    if id == ArrayValue().id:
+        times, values = unpack_arrays(vars)
+        _values = np.empty(len(values), dtype=object)
+        for i in range(len(values)):
+            _values[i] = values[i]
+        return np.asarray(times, dtype=np.float64), _values
+    dtype = record_dtype(id)
+    if dtype is None:
+        raise RuntimeWarning(f"Unsupported type in file! {id}")
+    if len(vars) % dtype.itemsize:
+        raise RuntimeWarning("Wrong size in file!")
+    # Each record is a row of the structured array, so decode the lot at once
+    records = np.frombuffer(vars, dtype=dtype)
+    return records['time'].copy(), records['value'].copy()
+
+def complete_records(vars):
+    '''Returns the number of bytes of whole records at the start of vars, ie leaving off a record
+    still being written, or None if the records can't be split up'''
+    if not len(vars):
+        return 0
+    id = vars[0]
+    dtype = record_dtype(id)
+    if dtype is not None:
+        return len(vars) - len(vars) % dtype.itemsize
+    if id != ArrayValue().id:
+        return None
+    offset = 0
+    while offset + ArrayValue.HEADER.size <= len(vars):
+        try:
+            size = ArrayValue.packed_size(vars, offset)
+        except struct.error:
+            break
+        if offset + size > len(vars):
+            break
+        offset += size
+    return offset
+
+def index_records(vars, block=4096):
+    '''Returns the index entry for the records in vars, the contents of a log file. This has the 
+    first and last times, the number of records, and the time and byte offset of every block records.'''
+    if not len(vars):
+        return None
+    id = vars[0]
+    dtype = record_dtype(id)
+    if dtype is not None:
+        count = len(vars) // dtype.itemsize
+        times = np.frombuffer(vars, dtype=dtype, count=count)['time']
+        offsets = np.arange(0, count, block)
+        blocks = [list(block) for block in zip(times[offsets].tolist(), (offsets * dtype.itemsize).tolist())]
+        first, last = times[0], times[-1]
+    elif id == ArrayValue().id:
+        offset = 0
+        count = 0
+        blocks = []
+        while offset < len(vars):
+            _, _time, _, _ = ArrayValue.HEADER.unpack_from(vars, offset)
+            if count % block == 0:
+                blocks.append([_time, offset])
+            if count == 0:
+                first = _time
+            last = _time
+            offset += ArrayValue.packed_size(vars, offset)
+            count += 1
+    else:
+        return None
+    return {'first': float(first), 'last': float(last), 'count': int(count), 'id': int(id), 'size': len(vars), 'blocks': blocks}
+
+def level_filename(key, width):
+    return f"{LEVEL_DIR}{key}_{width}.lvl"
+
+def archive_filename(save_dir, name, width):
+    '''The levels of width for the old segment name, these are moved along with it'''
+    return f"{save_dir}/{name}_{width}.lvl"
+
+def retention_for(key, policy=None):
+    '''Returns a map of width (0 for the raw values, or one of LEVELS) to how many seconds it is
+    kept for key, None for forever, from policy, see RETENTION'''
+    if policy is None:
+        policy = RETENTION
+    tiers = []
+    for pattern, _tiers in policy.items():
+        if fnmatch.fnmatchcase(key, pattern):
+            tiers = sorted(_tiers, key=lambda tier: tier[0])
+            break
+    keep = {}
+    for width in (0,) + LEVELS:
+        days = None
+        for _width, _days in tiers:
+            if _width <= width:
+                days = _days
+        keep[width] = None if days is None else days * 86400
+    return keep
+
+def read_buckets(filename, width, start, end):
+    '''Returns the buckets of width in filename from the one containing start, to before end'''
+    try:
+        with open(filename, 'rb') as file:
+            count = os.fstat(file.fileno()).st_size // LevelBuilder.DTYPE.itemsize
+            if count == 0:
+                return np.empty(0, dtype=LevelBuilder.DTYPE)
+            buckets = np.memmap(file, dtype=LevelBuilder.DTYPE, mode='r', shape=(count,))
+    except FileNotFoundError:
+        return np.empty(0, dtype=LevelBuilder.DTYPE)
+    [i, j] = np.searchsorted(buckets['time'], [np.floor(start / width) * width, end])
+    return np.array(buckets[i:j])
+
+def merge_buckets(buckets):
+    '''Returns buckets sorted by time, with any for the same time combined, ie from either side 
+    of where a segment was split'''
+    if not len(buckets):
+        return buckets
+    buckets = buckets[np.argsort(buckets['time'], kind='stable')]
+    times = buckets['time']
+    starts = np.flatnonzero(np.concatenate(([True], times[1:] != times[:-1])))
+    if len(starts) == len(buckets):
+        return buckets
+    counts = buckets['count'].astype(np.float64)
+    return LevelBuilder.make_buckets(1, times[starts], np.minimum.reduceat(buckets['min'], starts), 
+                                     np.maximum.reduceat(buckets['max'], starts), 
+                                     np.add.reduceat(buckets['mean'] * counts, starts), np.add.reduceat(counts, starts))
+
+class LevelBuilder:
+    '''Aggregates the values of a key into buckets of each of the LEVELS widths, with the min, 
+    max, mean and count of the values in each. A bucket is done once a value for a later one 
+    is added, until then it is kept here.'''
+
+    # time is the start of the bucket
+    DTYPE = np.dtype([('time', '<f8'), ('min', '<f8'), ('max', '<f8'), ('mean', '<f8'), ('count', '<u4')])
+
+    def __init__(self, widths=LEVELS) -> None:
+        self.widths = widths
+        # width -> [index, min, max, sum, count] of the bucket being filled
+        self.open = {}
+
+    def make_buckets(width, index, mins, maxs, sums, counts):
+        buckets = np.empty(len(index), dtype=LevelBuilder.DTYPE)
+        buckets['time'] = index * width
+        buckets['min'] = mins
+        buckets['max'] = maxs
+        buckets['mean'] = sums / counts
+        buckets['count'] = counts
+        return buckets
+
+    def add(self, times, values):
+        '''Adds the times and values, which should be in time order. 
+        Returns a map of width to an array of the buckets done, as DTYPE'''
+        done = {}
+        if not len(times):
+            return done
+        values = np.asarray(values, dtype=np.float64)
+        for width in self.widths:
+            index = np.floor(times / width)
+            # Start of each run of values in the same bucket
+            starts = np.flatnonzero(np.concatenate(([True], index[1:] != index[:-1])))
+            index = index[starts]
+            mins = np.minimum.reduceat(values, starts)
+            maxs = np.maximum.reduceat(values, starts)
+            sums = np.add.reduceat(values, starts)
+            counts = np.diff(np.append(starts, len(values)))
+            if width in self.open:
+                _index, _min, _max, _sum, _count = self.open[width]
+                if _index == index[0]:
+                    mins[0] = min(mins[0], _min)
+                    maxs[0] = max(maxs[0], _max)
+                    sums[0] += _sum
+                    counts[0] += _count
+                else:
+                    index = np.insert(index, 0, _index)
+                    mins = np.insert(mins, 0, _min)
+                    maxs = np.insert(maxs, 0, _max)
+                    sums = np.insert(sums, 0, _sum)
+                    counts = np.insert(counts, 0, _count)
+            # The last one may still get more values
+            self.open[width] = [index[-1], mins[-1], maxs[-1], sums[-1], counts[-1]]
+            done[width] = LevelBuilder.make_buckets(width, index[:-1], mins[:-1], maxs[:-1], sums[:-1], counts[:-1])
+        return done
+
+    def close(self):
+        '''Returns the buckets still open as done, as for add'''
+        done = {}
+        for width, (index, _min, _max, _sum, _count) in self.open.items():
+            done[width] = LevelBuilder.make_buckets(width, np.array([index]), [_min], [_max], np.array([_sum]), np.array([_count]))
+        self.open.clear()
+        return done
+
+def aggregate(times, values, width):
+    '''Returns the buckets of width for the given times and values, as LevelBuilder.DTYPE'''
+    builder = LevelBuilder((width,))
+    done = builder.add(times, values)
+    if not len(done):
+        return np.empty(0, dtype=LevelBuilder.DTYPE)
+    return np.concatenate((done[width], builder.close()[width]))
+
+# Statistics bin_statistics can make
+STATISTICS = ('mean', 'min', 'max', 'std', 'count', 'sum', 'first', 'last')
+
+def bin_statistics(times, values, edges, stats=('mean',)):
+    '''Returns a map of each of stats to an array of that statistic of the values in each bin 
+    between edges, these are NaN for empty bins, other than count and sum which are 0. 
+    times should be sorted.'''
+    bins = len(edges) - 1
+    index = np.searchsorted(edges, times, side='right') - 1
+    valid = (index >= 0) & (index < bins)
+    index = index[valid]
+    values = np.asarray(values, dtype=np.float64)[valid]
+
+    counts = np.bincount(index, minlength=bins)
+    sums = np.bincount(index, weights=values, minlength=bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+    # Start of the values in each bin which has any, as times are sorted
+    starts = np.flatnonzero(np.concatenate(([True], index[1:] != index[:-1]))) if len(index) else index
+    found = index[starts]
+
+    def per_bin(reduced):
+        result = np.full(bins, np.nan)
+        result[found] = reduced
+        return result
+
+    results = {}
+    for stat in stats:
+        if stat == 'mean':
+            results[stat] = means
+        elif stat == 'count':
+            results[stat] = counts.astype(np.float64)
+        elif stat == 'sum':
+            results[stat] = sums
+        elif stat == 'min':
+            results[stat] = per_bin(np.minimum.reduceat(values, starts) if len(starts) else [])
+        elif stat == 'max':
+            results[stat] = per_bin(np.maximum.reduceat(values, starts) if len(starts) else [])
+        elif stat == 'first':
+            results[stat] = per_bin(values[starts])
+        elif stat == 'last':
+            results[stat] = per_bin(values[np.append(starts[1:], len(values)) - 1] if len(starts) else [])
+        elif stat == 'std':
+            # Two passes, as the sum of squares loses precision
+            squares = np.bincount(index, weights=(values - means[index]) ** 2, minlength=bins)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                results[stat] = np.sqrt(squares / counts)
+        else:
+            raise ValueError(f"Unknown statistic {stat}")
+    return results
+
+def align_asof(times, key_times, key_values):
+    '''Returns key_values as of each of times, ie the last value at or before, NaN if none'''
+    index = np.searchsorted(key_times, times, side='right') - 1
+    aligned = np.full(len(times), np.nan)
+    found = index >= 0
+    aligned[found] = key_values[index[found]]
+    return aligned
+
+def write_json(filename, value):
+    '''Writes value to filename as json, via a temporary file so readers never see part of it'''
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as file:
+        json.dump(value, file)
+    os.replace(tmp, filename)
+
+class LogSegment:
+    '''A single log file for a key. Uncompressed files of fixed size records are memory-mapped 
+    as a structured array, and the times binary searched, so only the pages needed are read.
+    Compressed files and arrays have to be read whole.
+
+    start is the time of the first value, if known, this is from the name of old segments.
+    entry is the segment's index from the SegmentCatalog, if it has one, in which case only
+    the blocks covering the range are read.'''
+
+    def __init__(self, filename, start=None, entry=None) -> None:
+        self.filename = filename
+        self.start = start
+        self.entry = entry
+
+    def block_range(self, start, end):
+        '''Returns the byte offsets (begin, end) of the blocks in our entry covering start to end'''
+        blocks = self.entry['blocks']
+        times = [block[0] for block in blocks]
+        i = max(0, bisect.bisect_right(times, start) - 1)
+        j = bisect.bisect_left(times, end)
+        return blocks[i][1], blocks[j][1] if j < len(blocks) else self.entry['size']
+
+    def decompress(self, decoded=None):
+        '''Returns the contents of this compressed segment, via decoded(filename) if given, ie a cache'''
+        if decoded is not None:
+            return decoded(self.filename)
+        with open(self.filename, 'rb') as file:
+            return LOG_CODECS[log_suffix(self.filename)][1](file.read())
+
+    def read(self, start, end, decoded=None):
+        '''Returns arrays of (times, values) in this segment, for start <= time < end.
+        decoded is passed to decompress for compressed segments.'''
+        suffix = log_suffix(self.filename)
+        try:
+            if self.entry is not None and len(self.entry['blocks']):
+                begin, stop = self.block_range(start, end)
+                if suffix in LOG_CODECS:
+                    # Compressed as a whole, but we only need to decode the blocks
+                    vars = self.decompress(decoded)[begin:stop]
+                else:
+                    with open(self.filename, 'rb') as file:
+                        file.seek(begin)
+                        vars = file.read(stop - begin)
+                return LogSegment.select(*decode_records(vars), start, end)
+            if suffix in LOG_CODECS:
+                return LogSegment.select(*decode_records(self.decompress(decoded)), start, end)
+            with open(self.filename, 'rb') as file:
+                header = file.read(1)
+                dtype = record_dtype(header[0]) if len(header) else None
+                if dtype is None:
+                    file.seek(0)
+                    return LogSegment.select(*decode_records(file.read()), start, end)
+                # Any partly written record at the end is left off
+                count = os.fstat(file.fileno()).st_size // dtype.itemsize
+                if count == 0:
+                    return np.empty(0), np.empty(0, dtype=dtype['value'])
+                records = np.memmap(file, dtype=dtype, mode='r', shape=(count,))
+        except FileNotFoundError:
+            # It may have just been compressed
+            for suffix in LOG_CODECS:
+                filename = self.filename.removesuffix('.dat') + suffix
+                if os.path.exists(filename):
+                    return LogSegment(filename, self.start, self.entry).read(start, end, decoded)
+            raise
+        return LogSegment.select(records['time'], records['value'], start, end)
+
+    def select(times, values, start, end):
+        '''Returns copies of the times and values within start <= time < end, times must be sorted'''
+        [i, j] = np.searchsorted(times, [start, end])
+        return np.array(times[i:j]), np.array(values[i:j])
+
+class SegmentCatalog:
+    '''The index of the old segments of a key, kept as index.json in their folder, old_dir/key/. 
+    Entries are from index_records, and are by the name of the segment without the suffix, so 
+    they stay valid when the segment is compressed. Entries also have 'levels', the widths of the 
+    level archives of the segment, and 'raw', whether the segment itself is still there, as the
+    LogCompactor removes them.'''
+
+    FILENAME = 'index.json'
+    # name_width.lvl, see archive_filename
+    ARCHIVE = re.compile(r'^(.*)_(\d+)\.lvl$')
+    lock = threading.Lock()
+
+    def __init__(self, save_dir) -> None:
+        self.save_dir = save_dir
+        self.filename = os.path.join(save_dir, SegmentCatalog.FILENAME)
+        self.entries = {}
+        self.mtime = None
+        self.dir_mtime = None
+
+    def read(self):
+        '''Re-reads the catalog if the file changed, returns the entries by name'''
+        try:
+            mtime = os.stat(self.filename).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self.mtime:
+            entries = {}
+            if mtime is not None:
+                with open(self.filename, 'r') as file:
+                    entries = json.load(file)
+            self.entries = entries
+            self.mtime = mtime
+        return self.entries
+
+    def write(self):
+        write_json(self.filename, self.entries)
+        self.mtime = os.stat(self.filename).st_mtime_ns
+
+    def add(self, name, entry):
+        with SegmentCatalog.lock:
+            self.read()
+            self.entries[name] = entry
+            self.write()
+
+    def remove(self, name):
+        with SegmentCatalog.lock:
+            self.read()
+            if self.entries.pop(name, None) is not None:
+                self.write()
+
+    def update(self, force=False):
+        '''Indexes any segments in the folder not yet in the catalog, and drops those no longer there.
+        This only lists the folder if it changed since the last time, unless force.'''
+        if not os.path.isdir(self.save_dir):
+            return
+        dir_mtime = os.stat(self.save_dir).st_mtime_ns
+        if dir_mtime == self.dir_mtime and not force:
+            return
+        with SegmentCatalog.lock:
+            entries = self.read()
+            names = {}
+            archives = {}
+            for file in os.listdir(self.save_dir):
+                suffix = log_suffix(file)
+                if suffix is not None:
+                    names.setdefault(file.removesuffix(suffix), file)
+                    continue
+                match = SegmentCatalog.ARCHIVE.match(file)
+                if match is not None:
+                    archives.setdefault(match[1], []).append(int(match[2]))
+            changed = False
+            for name in list(entries.keys()):
+                if not name in names and not name in archives:
+                    del entries[name]
+                    changed = True
+                    continue
+                entry = entries[name]
+                levels = sorted(archives.get(name, []))
+                if entry.get('levels', []) != levels or entry.get('raw', True) != (name in names):
+                    entry['levels'] = levels
+                    entry['raw'] = name in names
+                    changed = True
+            for name, widths in archives.items():
+                if name in entries or name in names:
+                    continue
+                # Only the levels are left, so the times are from those
+                width = min(widths)
+                buckets = read_buckets(archive_filename(self.save_dir, name, width), width, -np.inf, np.inf)
+                if not len(buckets):
+                    continue
+                entries[name] = {'first': float(buckets['time'][0]), 'last': float(buckets['time'][-1] + width), 
+                                 'count': 0, 'id': 0, 'size': 0, 'blocks': [], 'levels': sorted(widths), 'raw': False}
+                changed = True
+            for name, file in names.items():
+                if name in entries:
+                    continue
+                try:
+                    filename = os.path.join(self.save_dir, file)
+                    with open(filename, 'rb') as _file:
+                        vars = _file.read()
+                    suffix = log_suffix(file)
+                    if suffix in LOG_CODECS:
+                        vars = LOG_CODECS[suffix][1](vars)
+                    entry = index_records(vars)
+                except Exception as err:
+                    print(f"Error indexing {file}: {err}")
+                    continue
+                if entry is not None:
+                    entry['levels'] = sorted(archives.get(name, []))
+                    entry['raw'] = True
+                    entries[name] = entry
+                    changed = True
+            if changed:
+                self.write()
+            self.dir_mtime = dir_mtime
+
+    def find(self, start, end):
+        '''Returns the (name, entry) of the segments overlapping start <= time < end, oldest first'''
+        found = [(name, entry) for name, entry in self.read().items() if entry['last'] >= start and entry['first'] < end]
+        found.sort(key=lambda x: x[1]['first'])
+        return found
+
 class LogLoader:
+    '''Loads the logged values for a key, from the file in dir, and the old segments 
+    in old_dir/key/. Besides the catalog, only the most recently decompressed segments
+    are kept between calls to load_range, up to max_decoded bytes of them.'''
+
+    # Per key, so that loaders made again after being dropped from a LogCache still share them
+    locks = collections.defaultdict(threading.RLock)
 
-    def __init__(self, key, dir=SAVE_DIR, old_dir=BACK_DIR, max_dt=1e30, min_free_space=500*1024**2) -> None:
+    def __init__(self, key, dir=SAVE_DIR, old_dir=BACK_DIR, min_free_space=500*1024**2, max_decoded=64*1024**2) -> None:
         self.key = key
         self.new_dir = dir
         self.old_dir = old_dir
-        self.file_end = 0
-        self.values = []
-        self.times = []
-        self._np_v = None
-        self._np_t = None
-        self.max_dt = max_dt
         self.min_free_space = min_free_space
+        self.catalog = SegmentCatalog(self.old_dir + self.key)
+        # Held while changing the segments, or the catalog, the segments are then read without it
+        self.lock = LogLoader.locks[key]
+        self.max_decoded = max_decoded
+        self.decoded = collections.OrderedDict()
+        self.decoded_bytes = 0
+        self.decoded_lock = threading.Lock()
+
+    def decompress(self, filename):
+        '''Returns the decompressed contents of the segment filename, keeping the recently used ones'''
+        # The mtime is included in case it is ever re-written
+        name = (filename, os.stat(filename).st_mtime_ns)
+        with self.decoded_lock:
+            if name in self.decoded:
+                self.decoded.move_to_end(name)
+                return self.decoded[name]
+        with open(filename, 'rb') as file:
+            vars = LOG_CODECS[log_suffix(filename)][1](file.read())
+        if len(vars) > self.max_decoded:
+            return vars
+        with self.decoded_lock:
+            if not name in self.decoded:
+                self.decoded[name] = vars
+                self.decoded_bytes += len(vars)
+            while self.decoded_bytes > self.max_decoded:
+                _, old = self.decoded.popitem(last=False)
+                self.decoded_bytes -= len(old)
+        return vars
+
+    def nbytes(self):
+        '''Returns roughly how many bytes this is holding on to'''
+        # The catalog entries are python lists, so ~80 bytes per block
+        entries = self.catalog.entries
+        blocks = sum(len(entry.get('blocks', ())) for entry in entries.values())
+        return 1024 + 512 * len(entries) + 80 * blocks + self.decoded_bytes
 
     def process_old_dir(self):
+        with self.lock:
+            self._process_old_dir()
+
+    def _process_old_dir(self):
         # Check if a file was put in there.
         filename = self.old_dir + self.key + ".dat"
         save_dir = self.old_dir + self.key
@@ -480,126 +2069,332 @@ class LogLoader:
             vars = vars[1:9]
             stamp = struct.unpack("d", vars)[0]
             stamp = time.strftime('%Y-%m-%d_%H_%M_%S', time.localtime(stamp))
-            new_filename =  save_dir + f"/{self.key}_{stamp}.dat"
+            name = f"{self.key}_{stamp}"
+            new_filename =  save_dir + f"/{name}.dat"
+
+            with open(filename, 'rb') as file:
+                entry = index_records(file.read())
+            # Along with the levels from the same time, see DataSaver.rotate
+            levels = []
+            for width in LEVELS:
+                try:
+                    os.replace(f"{self.old_dir}{self.key}_{width}.lvl", archive_filename(save_dir, name, width))
+                    levels.append(width)
+                except FileNotFoundError:
+                    pass
             os.rename(filename, new_filename)
+            if entry is not None:
+                entry['levels'] = levels
+                entry['raw'] = True
+                self.catalog.add(name, entry)
 
-            import shutil
             _, _, free = shutil.disk_usage(new_filename)
             if free < self.min_free_space:
-                files = os.listdir(save_dir)
-                files.sort()
-                oldest =  os.path.join(save_dir, files[0])
-                print(f"Warning, Removed old log due to lack of disk space! {oldest}")
-                os.remove(oldest)
-
-    def _load_values(self, filename:str, file_end):
-        import numpy as np
-            
-        file = open(filename, 'rb')
-        file.seek(file_end)
-        vars = file.read()
-        file.close()
-
-        if filename.endswith('.dat_z'):
-            # These ones are compressed via zlib
-            import zlib
-            vars = zlib.decompress(vars)
-
-        self.raw_values = vars
-        id = vars[0]
-        length = DataSaver.get_value_len(vars)
-
-        number = len(vars) / length
-        if number != int(number):
-            raise RuntimeWarning("Wrong size in file!")
-
-        # numpy stuff from Tim
-        vars = np.fromiter(vars, dtype='uint8')
-        vars = np.reshape(vars, (-1, length))
-
-        _times = vars[:,1:9].copy(order="C")
-        decode_time = lambda x: struct.unpack("d", x)[0]
-
-        if id == 1:
-            _values = vars[:,9:].copy(order="C")
-            decode_value = lambda x: struct.unpack("d", x)[0]
-
-        times = [decode_time(x) for x in _times]
-        values = [decode_value(x) for x in _values]
-
-        for t in times:
-            self.times.append(t)
-        for v in values:
-            self.values.append(v)
-            
-        loaded_t = np.fromiter(times, dtype=np.float64)
-        if id == 1:
-            loaded_v = np.fromiter(values, dtype=np.float64)
-        else:
-            loaded_v = np.array(values)
+                self.free_space()
+        # Index anything which was not, ie from before there was a catalog
+        self.catalog.update()
+
+    def free_space(self):
+        '''Called when the disk is getting full, this drops the raw values of the oldest segment which 
+        still has them, keeping its levels. If there are none, then the finest of the oldest levels.'''
+        with self.lock:
+            found = self.catalog.find(-np.inf, np.inf)
+            raw = [(name, entry) for name, entry in found if entry.get('raw', True)]
+            if len(raw):
+                name, entry = raw[0]
+                print(f"Warning, Removed old log values due to lack of disk space, only levels are kept! {name}")
+                self.archive(name, entry, LEVELS)
+                self.drop_raw(name)
+            elif len(found) and len(found[0][1].get('levels', [])):
+                name, entry = found[0]
+                width = min(entry['levels'])
+                print(f"Warning, Removed old log levels due to lack of disk space! {name} {width}")
+                self.drop_archive(name, width)
+            self.catalog.update(force=True)
+
+    def archive(self, name, entry, widths):
+        '''Makes the level archives of widths for the segment name, for any it does not have already'''
+        save_dir = self.old_dir + self.key
+        widths = [width for width in widths if not width in entry.get('levels', [])]
+        if not len(widths) or not entry.get('raw', True):
+            return
+        times, values = LogSegment(f"{save_dir}/{name}.dat", entry['first'], entry).read(-np.inf, np.inf, self.decompress)
+        if not len(times) or values.dtype == object:
+            return
+        for width in widths:
+            filename = archive_filename(save_dir, name, width)
+            with open(filename + '.tmp', 'wb') as file:
+                file.write(aggregate(times, values, width).tobytes())
+            os.replace(filename + '.tmp', filename)
 
-        if self._np_t is None:
-            self._np_t = loaded_t
-            self._np_v = loaded_v
-        else:
-            self._np_t = np.hstack((self._np_t, loaded_t))
-            self._np_v = np.hstack((self._np_v, loaded_v))
+    def drop_raw(self, name):
+        save_dir = self.old_dir + self.key
+        for file in os.listdir(save_dir):
+            suffix = log_suffix(file)
+            if suffix is not None and file.removesuffix(suffix) == name:
+                os.remove(os.path.join(save_dir, file))
 
-        if len(self._np_t) > 2:
-            min_index = np.searchsorted(self._np_t, self._np_t[-1] - self.max_dt)
-            self._np_t = self._np_t[min_index:]
-            self._np_v = self._np_v[min_index:]
-            self.times = self.times[min_index:]
-            self.values = self.values[min_index:]
+    def drop_archive(self, name, width):
+        try:
+            os.remove(archive_filename(self.old_dir + self.key, name, width))
+        except FileNotFoundError:
+            pass
 
-    def load_from_old_dir(self, start_time):
+    def segments(self, start, end):
+        '''Returns the LogSegments for this key which overlap start <= time < end, oldest first'''
         save_dir = self.old_dir + self.key
-        if not os.path.exists(save_dir):
-            os.makedirs(save_dir)
-        files = os.listdir(save_dir)
-        self.values = []
-        self.times = []
-        files.sort(reverse=True)
-
-        to_load = []
-        for file in files:
-            stamp = file.replace(f"{self.key}_", "")
-            stamp = stamp.removesuffix(".dat_z")
-            stamp = stamp.removesuffix(".dat")
-            stamp = time.mktime(time.strptime(stamp, '%Y-%m-%d_%H_%M_%S'))
-            if stamp > start_time:
-                to_load.append(f"{save_dir}/{file}")
-            else:
-                to_load.append(f"{save_dir}/{file}")
-                break
-        to_load.sort()
-        for filename in to_load:
-            self._load_values(filename, 0)
+        with self.lock:
+            self.catalog.update()
+            found = self.catalog.find(start, end)
+        segments = [LogSegment(f"{save_dir}/{name}.dat", entry['first'], entry) for name, entry in found if entry.get('raw', True)]
+        filename = self.new_dir + self.key + ".dat"
+        if os.path.exists(filename):
+            segments.append(LogSegment(filename))
+        return segments
+
+    def load_range(self, start, end):
+        '''Returns arrays of the (times, values) with start <= time < end, or (None, None) if there are no logs'''
+        segments = self.segments(start, end)
+        if not len(segments) and not len(self.catalog.read()):
+            return None, None
+        times = []
+        values = []
+        for segment in segments:
+            try:
+                _times, _values = segment.read(start, end, self.decompress)
+            except FileNotFoundError:
+                # Removed since the catalog was read
+                continue
+            if len(_times):
+                times.append(_times)
+                values.append(_values)
+        if not len(times):
+            return np.empty(0), np.empty(0)
+        return np.concatenate(times), np.concatenate(values)
+
+    def read_level(self, width, start, end):
+        '''Returns the saved buckets of width from the one containing start, to before end. 
+        These are from the archives of the old segments, as well as the current levels.'''
+        save_dir = self.old_dir + self.key
+        with self.lock:
+            self.catalog.update()
+            found = self.catalog.find(start, end)
+        parts = [read_buckets(archive_filename(save_dir, name, width), width, start, end) 
+                 for name, entry in found if width in entry.get('levels', [])]
+        # Moved by the DataSaver, but not yet put in its folder
+        parts.append(read_buckets(f"{self.old_dir}{self.key}_{width}.lvl", width, start, end))
+        parts.append(read_buckets(level_filename(self.key, width), width, start, end))
+        return merge_buckets(np.concatenate(parts))
+
+    def aggregate_raw(self, start, end, width):
+        '''Returns the raw values from start to end in buckets of width'''
+        if end <= start:
+            return np.empty(0, dtype=LevelBuilder.DTYPE)
+        times, values = self.load_range(start, end)
+        if times is None or not len(times) or values.dtype == object:
+            return np.empty(0, dtype=LevelBuilder.DTYPE)
+        return aggregate(times, values, width)
+
+    def load_level(self, start, end, points):
+        '''Returns the buckets from start to end of the coarsest of the LEVELS which still has at least 
+        points buckets, as LevelBuilder.DTYPE, or None if the raw values should be used instead.
+
+        The saved buckets are used where we have them, only the times before the first, and after 
+        the last (ie the bucket still being filled) are made from the raw values.'''
+        widths = [width for width in LEVELS if (end - start) / width >= points]
+        if not len(widths):
+            return None
+        width = max(widths)
+        buckets = self.read_level(width, start, end)
+        if not len(buckets):
+            return self.aggregate_raw(start, end, width)
+        head = self.aggregate_raw(start, buckets['time'][0], width)
+        tail = self.aggregate_raw(buckets['time'][-1] + width, end, width)
+        return np.concatenate((head, buckets, tail))
 
     def load(self, start_time=None):
+        '''Returns the (times, values) since start_time, default is the last 12 hours'''
         if start_time is None:
             start_time = time.time() - (12 * 3600)
         try:
-            filename = self.new_dir + self.key + ".dat"
-            file_size = os.stat(filename).st_size
+            return self.load_range(start_time, np.inf)
+        except Exception as err:
+            print(err)
+            return None, None
 
-            if self._np_t is not None:
-                if self._np_t[0] > start_time:
-                    self.load_from_old_dir(start_time)
-                    self.file_end = 0
+class LogTail:
+    '''Follows the log file for a key in dir, as the DataSaver appends to it, for the LogServer's 
+    subscribers. The file is kept open, so when it is moved away we can still read the end of it, 
+    before starting on the new one. A file started and moved away between reads would be missed, 
+    but that needs MAX_FILESIZE of values in one DataSaver pass.'''
 
-            if self.file_end > file_size:
-                self.file_end = 0
-            elif self.file_end == file_size:
-                return self._np_t, self._np_v
+    def __init__(self, key, dir=SAVE_DIR) -> None:
+        self.key = key
+        self.filename = dir + key + ".dat"
+        self.file = None
+        # Part of a record, not yet all written
+        self.partial = b''
+        # LogSubscribers to push to
+        self.subscribers = []
+        # Number of subscribers being added, this is only kept while there are either
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.open(from_end=True)
+
+    def open(self, from_end=False):
+        try:
+            self.file = open(self.filename, 'rb')
+        except FileNotFoundError:
+            self.file = None
+            return
+        if from_end:
+            self.file.seek(0, os.SEEK_END)
+
+    def read(self):
+        '''Returns arrays of (times, values) appended since the last read, these are None if there 
+        are none, or they are not numbers'''
+        if self.file is None:
+            self.open()
+            if self.file is None:
+                return None, None
+        # Check before reading, so if it was moved, we read all of the old one
+        try:
+            moved = os.stat(self.filename).st_ino != os.fstat(self.file.fileno()).st_ino
+        except FileNotFoundError:
+            moved = True
+        vars = self.partial + self.file.read()
+        if moved:
+            self.file.close()
+            self.open()
+        size = complete_records(vars)
+        if size is None:
+            # Not something we can follow, so skip it all
+            self.partial = b''
+            return None, None
+        self.partial = vars[size:]
+        if size == 0:
+            return None, None
+        times, values = decode_records(vars[:size])
+        if values.dtype == object:
+            return None, None
+        return times, values.astype(np.float64)
 
-            self._load_values(filename, self.file_end)
-            self.file_end = file_size
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class LogSubscriber:
+    '''A connection subscribed to some LogTails. Frames for it are buffered, and sent without 
+    blocking by LogServer.tail_loop, so a slow subscriber does not hold up the others. If more 
+    than MAX_BUFFER bytes build up, it is too slow, and is dropped.'''
+
+    MAX_BUFFER = 8*1024*1024
+
+    def __init__(self, conn) -> None:
+        self.conn = conn
+        self.buffer = bytearray()
+        self.lock = threading.Lock()
+        # Nothing is sent until the catch-up values are, see LogServer.handle_subscribe
+        self.ready = False
+        self.closed = False
+
+    def push(self, frame):
+        with self.lock:
+            if self.closed:
+                return
+            # Anything still buffered means it is behind
+            if len(self.buffer) and len(self.buffer) + len(frame) > LogSubscriber.MAX_BUFFER:
+                print("Dropping log subscriber, too far behind")
+                self._close()
+                return
+            self.buffer += frame
 
-            return self._np_t, self._np_v
-        except Exception as err:
-            print(err)
-            return None, None
+    def start(self):
+        '''Called once the catch-up values are sent, the buffer is then sent by flush'''
+        with self.lock:
+            self.conn.setblocking(False)
+            self.ready = True
+
+    def flush(self):
+        '''Sends as much of the buffer as can be without blocking'''
+        with self.lock:
+            if self.closed or not self.ready or not len(self.buffer):
+                return
+            try:
+                while len(self.buffer):
+                    sent = self.conn.send(self.buffer)
+                    del self.buffer[:sent]
+            except BlockingIOError:
+                pass
+            except Exception:
+                self._close()
+
+    def _close(self):
+        self.closed = True
+        self.buffer = bytearray()
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+class LogCache:
+    '''Least recently used cache of the LogLoaders for the LogServer, keeping them to 
+    within roughly budget bytes in total, see LogLoader.nbytes. Loaders which are dropped
+    are just made again, as everything they hold can be re-read from the catalog/segments.'''
+
+    def __init__(self, budget=256*1024**2, dir=SAVE_DIR, old_dir=BACK_DIR) -> None:
+        self.budget = budget
+        self.dir = dir
+        self.old_dir = old_dir
+        self.loaders = collections.OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        '''Returns the LogLoader for key, making it if needed, and whether it was made'''
+        with self.lock:
+            if key in self.loaders:
+                self.loaders.move_to_end(key)
+                self.hits += 1
+                return self.loaders[key], False
+            self.misses += 1
+            # Each may only keep a quarter of the budget of decompressed segments
+            log = LogLoader(key, self.dir, self.old_dir, max_decoded=self.budget // 4)
+            self.loaders[key] = log
+            self.trim()
+        return log, True
+
+    def pop(self, key):
+        with self.lock:
+            self.loaders.pop(key, None)
+
+    def peek(self, key):
+        '''Returns the LogLoader for key if we have one, without counting it as a use'''
+        with self.lock:
+            return self.loaders.get(key, None)
+
+    def trim(self):
+        '''Drops the least recently used loaders until we are within budget, the newest is always kept'''
+        with self.lock:
+            total = sum(log.nbytes() for log in self.loaders.values())
+            while total > self.budget and len(self.loaders) > 1:
+                _, log = self.loaders.popitem(last=False)
+                total -= log.nbytes()
+                self.evictions += 1
+            return total
+
+    def stats(self):
+        total = self.trim()
+        with self.lock:
+            return {'loaders': len(self.loaders), 'bytes': total, 'budget': self.budget,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
 
 class LogServer:
 
@@ -607,8 +2402,51 @@ class LogServer:
     FOOTER = b'\0\0end\0\0'
     MAX_PACKET_SIZE = 32768
 
-    def make_request_message(key, start_hours=1, end_hours=0, since=None, until=None, as_timestamps=True):
+    # Binary responses are BINARY_MAGIC, then the rest of BINARY, then the columns as little-endian 
+    # float64, one after the other, zlib compressed if compressed is set
+    BINARY_MAGIC = b'LGBC'
+    BINARY = struct.Struct("<4sBBQQ") # magic, compressed, columns, rows, size of the data
+
+    # Requests only for values since less than this many seconds ago are polls, these have their 
+    # own workers, so that they are not stuck behind long historical queries
+    POLL_WINDOW = 600
+    # Requests are dropped once this many are waiting or being processed
+    MAX_PENDING = 256
+    # Connections which have not sent their request this many seconds after connecting are dropped
+    RECV_TIMEOUT = 5
+    # Responses are made and sent this many values at a time
+    STREAM_ROWS = 65536
+    # Most time bins an aligned request can have
+    MAX_BINS = 10000000
+
+    def make_aligned_message(keys, since, until=None, shifts=None, mode='grid', step=None, as_timestamps=True, 
+                             binary=True, compress=True, stat='mean'):
+        '''Makes a request for several keys aligned in time, see update_aligned'''
+        resp = {'keys':keys, 'since':since, 'mode':mode, "as_timestamps":as_timestamps, 'stat':stat}
+        if until is not None:
+            resp['until'] = until
+        if shifts is not None:
+            resp['shifts'] = shifts
+        if step is not None:
+            resp['step'] = step
+        if binary:
+            resp['format'] = 'binary'
+            resp['compress'] = compress
+        return json.dumps(resp)
+
+    def make_request_message(key, start_hours=1, end_hours=0, since=None, until=None, as_timestamps=True, points=None,
+                             binary=False, compress=True, aggregate=None):
         resp = {'key':key, "as_timestamps":as_timestamps}
+        if aggregate is not None:
+            # {'width': seconds, 'stats': [...]}, the response is then [times, stat, ...], see update_values
+            resp['aggregate'] = aggregate
+        if binary:
+            # Older servers ignore this, and send json
+            resp['format'] = 'binary'
+            resp['compress'] = compress
+        if points is not None:
+            # The response is then [times, means, mins, maxs, counts] if the values were aggregated
+            resp['points'] = points
         now = time.time()
         if since is not None:
             resp['since'] = since
@@ -620,109 +2458,405 @@ class LogServer:
             resp['until'] = now - end_hours * 3600
         return json.dumps(resp)
 
-    def __init__(self, addr=LOG_ADDR) -> None:
+    def make_subscribe_message(keys, since=None):
+        '''Request for the values of keys to be pushed as they are saved, starting with those 
+        after since, see read_tail. The connection is then kept open.'''
+        resp = {'subscribe': list(keys)}
+        if since is not None:
+            resp['since'] = since
+        return json.dumps(resp)
+
+    def pack_tail(key, times, values):
+        key = key.encode()
+        return (LogServer.TAIL.pack(LogServer.TAIL_MAGIC, len(key), len(times)) + key + 
+                np.ascontiguousarray(times, dtype='<f8').tobytes() + np.ascontiguousarray(values, dtype='<f8').tobytes())
+
+    def recv_exactly(sock, size, data=b'', stopped=None):
+        '''Reads from sock until there are size bytes in data, returns None if it closed first.
+        If stopped is given, timeouts of sock are retried until stopped() is true, when None is 
+        returned, or until nothing has been read for 3 * KEEPALIVE.'''
+        last = time.monotonic()
+        while len(data) < size:
+            try:
+                _data = sock.recv(max(size - len(data), LogServer.MAX_PACKET_SIZE))
+            except TimeoutError:
+                if stopped is None or time.monotonic() - last > 3 * LogServer.KEEPALIVE:
+                    raise
+                if stopped():
+                    return None
+                continue
+            if not _data:
+                return None
+            last = time.monotonic()
+            data += _data
+        return data
+
+    def read_tail(sock, stopped=None):
+        '''Generates (key, times, values) from the frames pushed on sock after a subscribe message,
+        key is None for the keep-alives. Ends when the connection does, or immediately if the 
+        server did not accept the subscription, ie it is an older one. If stopped is given, it 
+        also ends once stopped() is true, which is checked on each timeout of sock.'''
+        head_size = LogServer.TAIL.size
+        data = b''
+        while True:
+            data = LogServer.recv_exactly(sock, head_size, data, stopped)
+            if data is None or not data.startswith(LogServer.TAIL_MAGIC):
+                return
+            _, key_len, rows = LogServer.TAIL.unpack_from(data)
+            size = head_size + key_len + 16 * rows
+            data = LogServer.recv_exactly(sock, size, data, stopped)
+            if data is None:
+                return
+            frame, data = data[:size], data[size:]
+            if key_len == 0:
+                yield None, np.empty(0), np.empty(0)
+                continue
+            key = frame[head_size:head_size + key_len].decode()
+            columns = np.frombuffer(frame, dtype='<f8', offset=head_size + key_len).reshape(2, rows)
+            yield key, columns[0], columns[1]
+
+    def stream_columns(columns, compress=True):
+        '''Generates a binary response for the columns, equal length arrays of numbers, a chunk at a time.
+        The size in the header is 0, as it is not known in advance, the data then runs to the end.'''
+        rows = len(columns[0]) if len(columns) else 0
+        yield LogServer.BINARY.pack(LogServer.BINARY_MAGIC, compress, len(columns), rows, 0)
+        compressor = zlib.compressobj(1) if compress else None
+        for column in columns:
+            for i in range(0, rows, LogServer.STREAM_ROWS):
+                data = np.asarray(column[i:i + LogServer.STREAM_ROWS], dtype='<f8').tobytes()
+                if compressor is not None:
+                    data = compressor.compress(data)
+                if len(data):
+                    yield data
+        if compressor is not None:
+            yield compressor.flush()
+
+    def stream_json(columns):
+        '''Generates the json for columns, a list of arrays, a chunk at a time'''
+        yield b'['
+        for j in range(len(columns)):
+            column = columns[j]
+            yield b'[' if j == 0 else b', ['
+            for i in range(0, len(column), LogServer.STREAM_ROWS):
+                part = column[i:i + LogServer.STREAM_ROWS]
+                # Array values are sent as nested lists
+                part = [v.tolist() for v in part] if part.dtype == object else part.tolist()
+                yield ((', ' if i else '') + json.dumps(part)[1:-1]).encode()
+            yield b']'
+        yield b']'
+
+    def stream_rows(times, columns):
+        '''Generates the json for rows of [iso time, value, ...], a chunk at a time'''
+        yield b'['
+        for i in range(0, len(times), LogServer.STREAM_ROWS):
+            _times = [datetime.datetime.fromtimestamp(x).isoformat() for x in times[i:i + LogServer.STREAM_ROWS].tolist()]
+            parts = []
+            for column in columns:
+                part = column[i:i + LogServer.STREAM_ROWS]
+                parts.append([v.tolist() for v in part] if part.dtype == object else part.tolist())
+            rows = [list(row) for row in zip(_times, *parts)]
+            yield ((', ' if i else '') + json.dumps(rows)[1:-1]).encode()
+        yield b']'
+
+    def read_columns(sock, head):
+        '''Reads a binary response from sock, where head is what was already read, including the header.
+        The columns are decoded straight into a preallocated (columns, rows) float64 array, which is returned.'''
+        _, compressed, columns, rows, _ = LogServer.BINARY.unpack_from(head)
+        values = np.empty((columns, rows), dtype='<f8')
+        out = values.reshape(-1).view(np.uint8)
+        filled = 0
+        data = head[LogServer.BINARY.size:]
+        decompressor = zlib.decompressobj() if compressed else None
+        while True:
+            if decompressor is not None:
+                data = decompressor.decompress(data)
+            if len(data) > len(out) - filled:
+                raise RuntimeWarning("Too much data in response!")
+            out[filled:filled + len(data)] = np.frombuffer(data, dtype=np.uint8)
+            filled += len(data)
+            if decompressor is None and filled < len(out):
+                # Nothing to decompress, so read straight into the array
+                read = sock.recv_into(memoryview(out[filled:]))
+                if not read:
+                    break
+                filled += read
+                data = b''
+                continue
+            data = sock.recv(LogServer.MAX_PACKET_SIZE)
+            if not data:
+                break
+        if filled != len(out):
+            raise RuntimeWarning(f"Incomplete response! {filled} of {len(out)}")
+        return values
+
+    def read_json(sock, head):
+        '''Reads a json response from sock, decompressing it as it arrives, returns the loaded values, or None if error'''
+        data = head
+        while len(data) < len(LogServer.HEADER) and LogServer.HEADER.startswith(data):
+            read = sock.recv(LogServer.MAX_PACKET_SIZE)
+            if not read:
+                break
+            data += read
+        if not data.startswith(LogServer.HEADER):
+            return None
+        data = data[len(LogServer.HEADER):]
+        decompressor = zlib.decompressobj()
+        parts = []
+        while True:
+            parts.append(decompressor.decompress(data))
+            if decompressor.eof:
+                break
+            data = sock.recv(LogServer.MAX_PACKET_SIZE)
+            if not data:
+                return None
+        packet = b''.join(parts)
+        if packet == b'error!':
+            return None
+        return json.loads(packet.decode())
+
+    def read_response(sock):
+        '''Reads the response to a request from sock. Returns a tuple of (valid, values), 
+        values is a (columns, rows) array for binary responses, otherwise as loaded from the json.'''
+        head = b''
+        while len(head) < LogServer.BINARY.size:
+            data = sock.recv(LogServer.MAX_PACKET_SIZE)
+            if not data:
+                break
+            head += data
+        if head.startswith(LogServer.BINARY_MAGIC):
+            values = LogServer.read_columns(sock, head)
+            return values.shape[1] > 0, values
+        values = LogServer.read_json(sock, head)
+        if values is None:
+            return False, []
+        return True, values
+
+    # Header of the frames pushed to subscribers: magic, length of key, number of rows, 
+    # then the key, and the float64 times and values. An empty key is just a keep-alive.
+    TAIL_MAGIC = b'LGTL'
+    TAIL = struct.Struct("<4sHI")
+    # Longest we wait for the DataSaver between checking the tails, if it is not in this process
+    TAIL_INTERVAL = 0.25
+    KEEPALIVE = 10
+
+    def __init__(self, addr=LOG_ADDR, poll_workers=2, scan_workers=2, cache_budget=256*1024**2, retention=None) -> None:
         self.addr = addr
+        self.polls = concurrent.futures.ThreadPoolExecutor(max_workers=poll_workers)
+        self.scans = concurrent.futures.ThreadPoolExecutor(max_workers=scan_workers)
+        self.pending = 0
+        self.pending_lock = threading.Lock()
         self.connection = socket.socket()
         self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.connection.bind(addr)
         self.connection.listen(256)
         self.port = self.connection.getsockname()[1]
+        # The listening socket, and the connections which have not sent their request yet, 
+        # by when they were accepted
+        self.connection.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.connection, selectors.EVENT_READ, None)
         self._running_ = False
-        self.log_lock = threading.Lock()
-        self.logs = {}
+        self.logs = LogCache(cache_budget)
+        self.tails = {}
+        self.tail_lock = threading.Lock()
+        self.compressor = LogCompressor(BACK_DIR)
+        self.compactor = LogCompactor(BACK_DIR, retention)
 
     def split(self, resp):
-        import zlib
-        resp = zlib.compress(resp)
-        resps = []
-        PADDED_SIZE = LogServer.MAX_PACKET_SIZE - (len(LogServer.HEADER) + len(LogServer.FOOTER))
-        resps.append(LogServer.HEADER)
-        while len(resp) > PADDED_SIZE:
-            split = resp[0:PADDED_SIZE]
-            resp = resp[PADDED_SIZE:]
-            resps.append(split)
-        if len(resp) > 0:
-            resps.append(resp)
-        resps.append(LogServer.FOOTER)
-        return resps
-    
-    def update_values(self, key, last_point=None, end=None, skip_points=1, as_timestamps=True):
-        with self.log_lock:
-            if key in self.logs:
-                log = self.logs[key]
-            else:
-                log = LogLoader(key, SAVE_DIR, BACK_DIR)
-                self.logs[key] = log
-                log.process_old_dir()
-        
+        '''Generates the framed, compressed, response from resp, an iterable of chunks of json'''
+        yield LogServer.HEADER
+        compressor = zlib.compressobj()
+        for data in resp:
+            data = compressor.compress(data)
+            if len(data):
+                yield data
+        yield compressor.flush()
+        yield LogServer.FOOTER
+
+    def parse_time(value, default):
+        '''Returns value as a timestamp, it can be a number, or a string of one or of a date, default if None'''
+        if value is None:
+            return default
+        try:
+            return float(value)
+        except ValueError:
+            return parser.parse(value).timestamp()
+
+    def get_log(self, key):
+        '''Returns the LogLoader for key, from our LogCache'''
+        log, new = self.logs.get(key)
+        if new:
+            # This has its own lock, so other keys are not held up
+            log.process_old_dir()
+        return log
+
+    def update_aligned(self, keys, shifts=None, start=None, end=None, mode='grid', step=None, as_timestamps=True,
+                       binary=False, compress=True, stat='mean'):
+        '''Returns a response with the values of several keys aligned in time, as columns of
+        [times, values for keys[0], values for keys[1], ...], see update_values for the format.
+
+        shifts are added to the times when looking up each key, ie the values at time t for a key 
+        are those from t + shift. mode is either:
+            'grid': times are every step seconds from start, and the values are the stat (see bin_statistics) 
+                    of those within each step
+            'asof': times are those of the first key, and the values of the others are the last at or before those times
+        Missing values are NaN.'''
         now = time.time()
-        if end is None:
-            end = now + 1e6
-        else:
-            try:
-                _time = float(end)
-                end = _time
-            except:
-                pass
-            if isinstance(end, float):
-                end = end
-            else:
-                end = parser.parse(end).timestamp()
-        
-        start = now - 3600
-        if last_point is not None:
+        start = LogServer.parse_time(start, now - 3600)
+        end = LogServer.parse_time(end, now)
+        if shifts is None:
+            shifts = [0] * len(keys)
+
+        series = []
+        for key, shift in zip(keys, shifts):
             try:
-                _time = float(last_point)
-                last_point = _time
-            except:
-                pass
-            if isinstance(last_point, float):
-                start = last_point
-            else:
-                start = parser.parse(last_point).timestamp()
+                x, y = self.get_log(key).load_range(start + shift, end + shift)
+            except Exception as err:
+                print(err)
+                x = None
+            if x is None or y.dtype == object:
+                return [b'error!']
+            series.append((x - shift, y.astype(np.float64)))
+
+        if mode == 'asof':
+            times = series[0][0]
+            columns = [times, series[0][1]] + [align_asof(times, x, y) for x, y in series[1:]]
+        else:
+            if step is None or step <= 0:
+                step = (end - start) / 1000
+            bins = int(np.ceil((end - start) / step))
+            if bins > LogServer.MAX_BINS:
+                print(f"Too many bins requested {bins}")
+                return [b'error!']
+            edges = start + step * np.arange(bins + 1)
+            columns = [edges[:-1]] + [bin_statistics(x, y, edges, (stat,))[stat] for x, y in series]
+
+        if not as_timestamps:
+            return LogServer.stream_rows(columns[0], columns[1:])
+        if binary:
+            return LogServer.stream_columns(columns, compress)
+        return LogServer.stream_json(columns)
+
+    def aggregate_values(self, log, start, end, aggregate, as_timestamps=True, binary=False, compress=True):
+        '''Returns the response for an aggregate request, see update_values'''
+        width = float(aggregate['width'])
+        stats = aggregate.get('stats', ['mean'])
+        bins = int(np.ceil((end - start) / width)) if width > 0 else 0
+        if bins <= 0 or bins > LogServer.MAX_BINS or not all([stat in STATISTICS for stat in stats]):
+            print(f"Invalid aggregate request {aggregate}")
+            return [b'error!']
+        x, y = log.load_range(start, end)
+        if x is None or y.dtype == object:
+            return [b'error!']
+        edges = start + width * np.arange(bins + 1)
+        results = bin_statistics(x, y, edges, list(stats) + ['count'])
+        # Only the bins with values are sent
+        found = results['count'] > 0
+        columns = [edges[:-1][found]] + [results[stat][found] for stat in stats]
+        if not as_timestamps:
+            return LogServer.stream_rows(columns[0], columns[1:])
+        if binary:
+            return LogServer.stream_columns(columns, compress)
+        return LogServer.stream_json(columns)
+
+    def update_values(self, key, last_point=None, end=None, skip_points=1, as_timestamps=True, points=None,
+                      binary=False, compress=True, aggregate=None):
+        '''Returns the response with the values for key from last_point to end, as an iterable of chunks. 
+        If binary, and the values are numbers, this is from stream_columns, otherwise it is json.
+
+        If aggregate is given, it is a map with the 'width' of the time bins in seconds, and the 'stats' 
+        to make for each (see bin_statistics). The response is then [bin start times, stat, ...], for 
+        the bins which have values.'''
+        log = self.get_log(key)
         
-        def get_values_from_log():
-            x, y = log.load(start_time=start)
-            
-            if x is None:
-                return None, None
-            
-            not_found = len(x) == 0 or start < x[0] or start > x[-1]
-            if not_found:
-                # Try another pass incase we need to load older logs
-                x, y = log.load(start_time=start)
-            return x, y
-
-        x, y = get_values_from_log()
+        now = time.time()
+        end = LogServer.parse_time(end, now + 1e6)
+        start = LogServer.parse_time(last_point, now - 3600)
         
-        if x is None:
-            with self.log_lock:
-                del self.logs[key]
-            return b'error!'
+        if aggregate is not None:
+            return self.aggregate_values(log, start, min(end, now), aggregate, as_timestamps, binary, compress)
+
+        if points:
+            # Use aggregated values if that still gives enough points
+            try:
+                buckets = log.load_level(start, min(end, now), points)
+            except Exception as err:
+                print(err)
+                buckets = None
+            if buckets is not None:
+                columns = [buckets['time'], buckets['mean'], buckets['min'], buckets['max'], buckets['count']]
+                if not as_timestamps:
+                    return LogServer.stream_rows(columns[0], columns[1:])
+                if binary:
+                    return LogServer.stream_columns(columns, compress)
+                return LogServer.stream_json(columns)
 
-        [start, end] = np.searchsorted(x, [start, end])
+        try:
+            x, y = log.load_range(start, end)
+        except Exception as err:
+            print(err)
+            x = None
         
-        x = x[start:end]
-        y = y[start:end]
+        if x is None:
+            self.logs.pop(key)
+            return [b'error!']
 
         if skip_points > 1 and len(x) > skip_points:
             x = x[::skip_points]
             y = y[::skip_points]
 
-        values = []
-        if as_timestamps:
-            values = np.array([x, y]).tolist()
-        else:
-            for i in range(len(x)):
-                values.append([datetime.datetime.fromtimestamp(x[i]).isoformat(), y[i]])
-
-        return json.dumps(values).encode()
+        if not as_timestamps:
+            return LogServer.stream_rows(x, [y])
+        if binary and y.dtype != object:
+            return LogServer.stream_columns([x, y], compress)
+        if y.dtype != object:
+            # Values are sent as floats, as before
+            y = y.astype(np.float64)
+        return LogServer.stream_json([x, y])
+
+    def is_poll(self, request):
+        '''Returns whether request is a cheap poll for recent values, rather than a historical query'''
+        if request.get('stats', False) or 'subscribe' in request:
+            return True
+        if 'until' in request or 'points' in request or 'keys' in request or 'aggregate' in request or not 'since' in request:
+            return False
+        try:
+            since = request['since']
+            try:
+                since = float(since)
+            except ValueError:
+                since = parser.parse(since).timestamp()
+            return since >= time.time() - LogServer.POLL_WINDOW
+        except Exception:
+            return False
 
     def read_loop(self):
+        '''Accepts connections, and once each has sent its request, hands it to the workers. 
+        The connections wait in the selector until then, so a slow client holds up no others.'''
+        for key, _ in self.selector.select(timeout=0.25):
+            if key.fileobj is self.connection:
+                try:
+                    conn, _ = self.connection.accept()  # accept new connection
+                    conn.setblocking(False)
+                    self.selector.register(conn, selectors.EVENT_READ, time.monotonic())
+                except Exception as err:
+                    print("Error in accept?", err)
+                continue
+            self.selector.unregister(key.fileobj)
+            self.read_request(key.fileobj)
+        # Drop those which didn't send anything in time
+        now = time.monotonic()
+        for key in list(self.selector.get_map().values()):
+            if key.data is not None and now - key.data > LogServer.RECV_TIMEOUT:
+                self.selector.unregister(key.fileobj)
+                key.fileobj.close()
+
+    def read_request(self, conn):
+        '''Reads the request from conn, which is readable, and submits it to the workers'''
         try:
-            conn, _ = self.connection.accept()  # accept new connection
             # receive data stream. it won't accept data packet greater than MAX_PACKET_SIZE bytes
             data = conn.recv(LogServer.MAX_PACKET_SIZE)
+            conn.setblocking(True)
         except Exception as err:
             print("Error in recv?", err)
             conn.close()
@@ -731,16 +2865,56 @@ class LogServer:
             # if data is not received break
             conn.close()  # close the connection
             return
+        if data.startswith(HELLO):
+            conn.send(HELLO_FROM_SERVER)
+            conn.close()  # close the connection
+            return
+
         try:
+            values = json.loads(data.decode())
+            pool = self.polls if self.is_poll(values) else self.scans
+            handler = self.handle_subscribe if 'subscribe' in values else self.handle_request
+        except Exception as err:
+            print(f'Error in logs request {err}, {data}')
+            conn.send(b'error!')
+            conn.close()
+            return
 
-            if data.startswith(HELLO):
-                conn.send(HELLO_FROM_SERVER)
-                conn.close()  # close the connection
+        with self.pending_lock:
+            if self.pending >= LogServer.MAX_PENDING:
+                print(f'Too many log requests, dropping {data}')
+                conn.close()
                 return
-            
-            data = data.decode()
+            self.pending += 1
+        pool.submit(handler, conn, values)
+
+    def send_response(self, conn, resp):
+        '''Sends resp, from update_values, to conn, json is framed and compressed via split'''
+        resp = iter(resp)
+        first = next(resp)
+        if first.startswith(LogServer.BINARY_MAGIC):
+            chunks = itertools.chain([first], resp)
+        else:
+            chunks = self.split(itertools.chain([first], resp))
+        for chunk in chunks:
+            conn.sendall(chunk)
 
-            values = json.loads(data)
+    def handle_request(self, conn, values):
+        '''Processes the request in values, and sends the response to conn, this runs on our workers'''
+        try:
+            as_timestamps = True if not 'as_timestamps' in values else values['as_timestamps']
+            binary = values.get('format', None) == 'binary'
+            compress = values.get('compress', True)
+            if values.get('stats', False):
+                self.send_response(conn, [json.dumps(self.logs.stats()).encode()])
+                return
+            if 'keys' in values:
+                resp = self.update_aligned(values['keys'], values.get('shifts', None), values.get('since', None), 
+                                           values.get('until', None), mode=values.get('mode', 'grid'), 
+                                           step=values.get('step', None), as_timestamps=as_timestamps, 
+                                           binary=binary, compress=compress, stat=values.get('stat', 'mean'))
+                self.send_response(conn, resp)
+                return
 
             # Key not found exception caught below.
             key = values['key']
@@ -755,34 +2929,135 @@ class LogServer:
                 last_point = values['since']
             if 'until' in values:
                 end = values['until']
-            as_timestamps = True if not 'as_timestamps' in values else values['as_timestamps']
-            resp = self.update_values(key, last_point, end, skip_points=skip_points, as_timestamps=as_timestamps)
-
-            for resp in self.split(resp):
-                conn.send(resp)
-            else:
+            points = values.get('points', None)
+            aggregate = values.get('aggregate', None)
+            resp = self.update_values(key, last_point, end, skip_points=skip_points, as_timestamps=as_timestamps, 
+                                      points=points, binary=binary, compress=compress, aggregate=aggregate)
+            self.send_response(conn, resp)
+        except Exception as err:
+            print(f'Error in logs request {err}, {values}')
+            try:
                 conn.send(b'error!')
+            except Exception:
+                pass
+        finally:
+            conn.close()
+            with self.pending_lock:
+                self.pending -= 1
+
+    def handle_subscribe(self, conn, values):
+        '''Sends the values since the request's since for each key, and then adds conn to the 
+        subscribers of the keys' LogTails, where tail_loop pushes the new values.'''
+        subscriber = LogSubscriber(conn)
+        try:
+            keys = values['subscribe']
+            since = LogServer.parse_time(values.get('since', None), time.time())
+            conn.settimeout(LogServer.RECV_TIMEOUT)
+            catch_up = []
+            for key in keys:
+                with self.tail_lock:
+                    tail = self.tails.get(key, None)
+                    if tail is None:
+                        tail = LogTail(key, SAVE_DIR)
+                        self.tails[key] = tail
+                    tail.pending += 1
+                try:
+                    # Held so nothing is read by the tail between these, anything read 
+                    # both here and by the tail later is just sent twice
+                    with tail.lock:
+                        times, _values = self.get_log(key).load_range(since, float('inf'))
+                        if times is not None and len(times) and _values.dtype != object:
+                            catch_up.append(LogServer.pack_tail(key, times, _values.astype(np.float64)))
+                        tail.subscribers.append(subscriber)
+                finally:
+                    with self.tail_lock:
+                        tail.pending -= 1
+            # New values are buffered by the subscriber meanwhile, and sent after these
+            for frame in catch_up:
+                conn.sendall(frame)
+            subscriber.start()
         except Exception as err:
-            print(f'Error in logs request {err}, {data}')
-            conn.send(b'error!')
-        conn.close()
+            print(f'Error in logs subscription {err}, {values}')
+            try:
+                conn.send(b'error!')
+            except Exception:
+                pass
+            subscriber.close()
+        finally:
+            with self.pending_lock:
+                self.pending -= 1
+
+    def tail_loop(self):
+        '''Pushes the values saved for the keys subscribed to, so idle keys cost only a stat'''
+        self._running_ = True
+        keepalive = LogServer.TAIL.pack(LogServer.TAIL_MAGIC, 0, 0)
+        last_keepalive = time.time()
+        while self._running_:
+            with DataSaver.saved:
+                DataSaver.saved.wait(LogServer.TAIL_INTERVAL)
+            send_keepalive = time.time() - last_keepalive > LogServer.KEEPALIVE
+            if send_keepalive:
+                last_keepalive = time.time()
+            with self.tail_lock:
+                tails = list(self.tails.values())
+            subscribers = {}
+            for tail in tails:
+                with tail.lock:
+                    try:
+                        frames = []
+                        times, values = tail.read()
+                        if times is not None:
+                            frames.append(LogServer.pack_tail(tail.key, times, values))
+                        if send_keepalive:
+                            frames.append(keepalive)
+                        # Only buffered here, they are sent below, without the lock
+                        for subscriber in tail.subscribers:
+                            for frame in frames:
+                                subscriber.push(frame)
+                    except Exception as err:
+                        print(f"Error following log for {tail.key}: {err}")
+                    tail.subscribers = [subscriber for subscriber in tail.subscribers if not subscriber.closed]
+                    for subscriber in tail.subscribers:
+                        subscribers[id(subscriber)] = subscriber
+            for subscriber in subscribers.values():
+                subscriber.flush()
+            # Then stop following any which no one is subscribed to anymore
+            with self.tail_lock:
+                for tail in tails:
+                    if not len(tail.subscribers) and not tail.pending:
+                        self.tails.pop(tail.key, None)
+                        tail.close()
 
     def log_monitor_loop(self):
         self._running_ = True
         while(self._running_):
 
-            with self.log_lock:
-                files = os.listdir(BACK_DIR)
-                for file in files:
-                    if file.endswith(".dat"):
-                        key = file.replace(".dat", '')
-                    else:
-                        key = file
-                    if not key in self.logs:
-                        log = LogLoader(key, SAVE_DIR, BACK_DIR)
-                        self.logs[key] = log
-                for log in self.logs.values():
+            keys = set()
+            for file in os.listdir(BACK_DIR):
+                if file.endswith(".dat"):
+                    keys.add(file.replace(".dat", ''))
+                elif os.path.isdir(BACK_DIR + file):
+                    keys.add(file)
+            for key in keys:
+                # Keys not in the cache get a throwaway loader, so they are not all kept around
+                log = self.logs.peek(key)
+                if log is None:
+                    log = LogLoader(key, SAVE_DIR, BACK_DIR)
+                try:
                     log.process_old_dir()
+                except Exception as err:
+                    print(f"Error processing old logs for {key}: {err}")
+            self.logs.trim()
+            # Then compress the segments which were moved over
+            try:
+                self.compressor.submit_all()
+            except Exception as err:
+                print(f"Error queuing logs for compression: {err}")
+            # And apply the retention policy
+            try:
+                self.compactor.submit_all()
+            except Exception as err:
+                print(f"Error queuing logs for compaction: {err}")
 
             for _ in range(600):
                 time.sleep(0.1)
@@ -804,28 +3079,36 @@ class LogServer:
         thread = threading.Thread(target=self.run, daemon=True)
         self.thread_2 = threading.Thread(target=self.log_monitor_loop, daemon=True)
         self.thread_2.start()
+        self.thread_3 = threading.Thread(target=self.tail_loop, daemon=True)
+        self.thread_3.start()
         
         BaseDataServer.provider_server.server_log = self
         return thread
 
-def make_server_threads(addr_tcp=("0.0.0.0", 0), addr_udp=("0.0.0.0", 0)):
+def make_server_threads(addr_tcp=("0.0.0.0", 0), addr_udp=("0.0.0.0", 0), fsync_interval=None):
     server_tcp = BaseDataServer(tcp=True, addr=addr_tcp)
     server_udp = BaseDataServer(tcp=False, addr=addr_udp)
-    saver = DataSaver()
+    saver = DataSaver(fsync_interval=fsync_interval)
 
-    thread_tcp = server_tcp.make_thread()
-    thread_tcp.start()
+    # Both servers are handled on the same event loop thread
+    loop = ServerLoop()
+    loop.add_server(server_tcp)
+    loop.add_server(server_udp)
+    server_tcp.register_provider()
+    server_udp.register_provider()
+    print(f'Starting Data Servers! {server_tcp.port}, {server_udp.port}')
 
-    thread_udp = server_udp.make_thread()
-    thread_udp.start()
+    thread_tcp = loop.make_thread()
+    thread_tcp.start()
+    thread_udp = thread_tcp
 
     save_thread = saver.make_thread()
     save_thread.start()
 
     return (server_tcp, thread_tcp), (server_udp, thread_udp), (saver, save_thread)
 
-def make_log_thread(addr=("0.0.0.0", 0)):
-    server = LogServer(addr)
+def make_log_thread(addr=("0.0.0.0", 0), cache_budget=256*1024**2, retention=None):
+    server = LogServer(addr, cache_budget=cache_budget, retention=retention)
     thread = server.make_thread()
     thread.start()
     return (server, thread)
@@ -842,6 +3125,9 @@ if __name__ == "__main__":
     parser.add_argument('-l', '--log_port')
     parser.add_argument('-t', '--tcp_port')
     parser.add_argument('-u', '--udp_port')
+    parser.add_argument('-f', '--fsync', type=float, help='seconds between fsyncs of the logs, default leaves it to the OS')
+    parser.add_argument('-c', '--cache_mb', type=float, default=256, help='memory budget in MB for the log server\'s loaded logs')
+    parser.add_argument('-r', '--retention', help='json file of the log retention policy, see RETENTION')
 
     args = parser.parse_args()
 
@@ -852,11 +3138,15 @@ if __name__ == "__main__":
         ServerProvider.server_key = args.key
 
     addr_log = ("0.0.0.0", port_log)
+    retention = None
+    if args.retention:
+        with open(args.retention, 'r') as file:
+            retention = json.load(file)
     addr_tcp = ("0.0.0.0", port_tcp)
     addr_udp = ("0.0.0.0", port_udp)
 
     if args.mode == 'logs':
-        (server, thread) = make_log_thread(addr_log)
+        (server, thread) = make_log_thread(addr_log, int(args.cache_mb * 1024**2), retention)
         # Now start the provider thread who says where the server is
         if ServerProvider.server_key != "None":
             print("Starting Provider thread")
@@ -868,8 +3158,8 @@ if __name__ == "__main__":
     elif args.mode == 'tests':
         if not args.key:
             ServerProvider.server_key = 'local_test'
-        (server_tcp, _), (server_udp, _), (saver, save_thread) = make_server_threads(addr_tcp, addr_udp)
-        (server, thread) = make_log_thread(addr_log)
+        (server_tcp, _), (server_udp, _), (saver, save_thread) = make_server_threads(addr_tcp, addr_udp, args.fsync)
+        (server, thread) = make_log_thread(addr_log, int(args.cache_mb * 1024**2), retention)
         # Now start the provider thread who says where the server is
         if ServerProvider.server_key != "None":
             print("Starting Provider thread")
@@ -880,11 +3170,13 @@ if __name__ == "__main__":
         server_udp._running_ = False
         server._running_ = False
         server_tcp.close()
+        saver._running_ = False
+        save_thread.join()
         time.sleep(0.5)
     else:
         # construct a server
-        (server_tcp, _), (server_udp, _), (saver, save_thread) = make_server_threads(addr_tcp, addr_udp)
-        (server, thread) = make_log_thread(addr_log)
+        (server_tcp, _), (server_udp, _), (saver, save_thread) = make_server_threads(addr_tcp, addr_udp, args.fsync)
+        (server, thread) = make_log_thread(addr_log, int(args.cache_mb * 1024**2), retention)
         # Now start the provider thread who says where the server is
         if ServerProvider.server_key != "None":
             print("Starting Provider thread")
@@ -895,4 +3187,6 @@ if __name__ == "__main__":
         server_udp._running_ = False
         server._running_ = False
         server_tcp.close()
+        saver._running_ = False
+        save_thread.join()
         time.sleep(0.5)
\ No newline at end of file
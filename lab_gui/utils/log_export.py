@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+'''
+Exports the logged values of keys to columnar files, for offline analysis.
+
+usage: py -m lab_gui.utils.log_export key [key ...] [-s since] [-u until] [-o dir] [-f npz|parquet|hdf5] [--merge] [-p processes]
+
+keys can be globs, ie 'temp_*', matched against the keys which have logs. since and until
+are timestamps or dates, by default everything is exported.
+
+Each key is exported to <dir>/<key>.<format>, with the times and values as float64 columns,
+or with --merge, all of them to <dir>/export.<format>:
+    npz: arrays "<key>.times" and "<key>.values"
+    parquet: columns key, time and value
+    hdf5: datasets /<key>/times and /<key>/values
+npz is always available, parquet needs pyarrow, and hdf5 needs h5py.
+
+The keys are decoded on a pool of processes, a segment of the logs at a time, via temporary
+raw files next to the output, so the archive never needs to fit in memory.
+'''
+
+import os
+import fnmatch
+import time
+import zipfile
+import concurrent.futures
+
+import numpy as np
+
+try:
+    from .data_server import LogLoader, LogServer, SAVE_DIR, BACK_DIR
+except ImportError:
+    from data_server import LogLoader, LogServer, SAVE_DIR, BACK_DIR
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+FORMATS = {'npz': '.npz', 'parquet': '.parquet', 'hdf5': '.h5'}
+# Rows per block when writing the outputs
+BLOCK_ROWS = 1024*1024
+
+def available_formats():
+    formats = ['npz']
+    if pyarrow is not None:
+        formats.append('parquet')
+    if h5py is not None:
+        formats.append('hdf5')
+    return formats
+
+def find_keys(patterns, dir=SAVE_DIR, old_dir=BACK_DIR):
+    '''Returns the keys which have logs in dir or old_dir matching any of patterns, sorted'''
+    keys = set()
+    for file in os.listdir(dir) if os.path.isdir(dir) else []:
+        if file.endswith('.dat'):
+            keys.add(file.removesuffix('.dat'))
+    for file in os.listdir(old_dir) if os.path.isdir(old_dir) else []:
+        if file.endswith('.dat'):
+            keys.add(file.removesuffix('.dat'))
+        elif os.path.isdir(os.path.join(old_dir, file)):
+            keys.add(file)
+    return sorted(key for key in keys if any(fnmatch.fnmatchcase(key, pattern) for pattern in patterns))
+
+def raw_filenames(out_dir, key):
+    return os.path.join(out_dir, f'.{key}.times.tmp'), os.path.join(out_dir, f'.{key}.values.tmp')
+
+def decode_key(key, start, end, out_dir, dir=SAVE_DIR, old_dir=BACK_DIR):
+    '''Decodes the values of key from start to end into the raw float64 files from raw_filenames,
+    a segment at a time. Returns the number of values, or None if the key can't be exported, 
+    ie it is of arrays or strings, the files are then empty.'''
+    log = LogLoader(key, dir, old_dir)
+    count = 0
+    times_name, values_name = raw_filenames(out_dir, key)
+    with open(times_name, 'wb') as times_file, open(values_name, 'wb') as values_file:
+        for segment in log.segments(start, end):
+            try:
+                times, values = segment.read(start, end)
+            except FileNotFoundError:
+                # Compacted away since it was listed
+                continue
+            except Exception as err:
+                print(f"Skipping {key}, it can't be decoded: {err}")
+                values = None
+            if values is None or values.dtype == object:
+                if values is not None:
+                    print(f"Skipping {key}, arrays can't be exported")
+                times_file.truncate(0)
+                values_file.truncate(0)
+                count = None
+                break
+            times.astype('<f8').tofile(times_file)
+            values.astype('<f8').tofile(values_file)
+            count += len(times)
+    return count
+
+def load_raw(out_dir, key):
+    '''Returns the (times, values) from decode_key, memory-mapped'''
+    columns = []
+    for filename in raw_filenames(out_dir, key):
+        if os.path.getsize(filename) == 0:
+            columns.append(np.empty(0))
+        else:
+            columns.append(np.memmap(filename, dtype='<f8', mode='r'))
+    return columns
+
+def remove_raw(out_dir, key):
+    for filename in raw_filenames(out_dir, key):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+class NpzWriter:
+    '''Writes arrays to a compressed npz, each is written a block at a time, as np.savez_compressed would'''
+
+    def __init__(self, filename) -> None:
+        self.file = zipfile.ZipFile(filename, mode='w', compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+
+    def write(self, key, times, values, merged):
+        prefix = f'{key}.' if merged else ''
+        for name, array in ((f'{prefix}times', times), (f'{prefix}values', values)):
+            with self.file.open(name + '.npy', 'w', force_zip64=True) as member:
+                np.lib.format.write_array(member, array, allow_pickle=False)
+
+    def close(self):
+        self.file.close()
+
+class ParquetWriter:
+    '''Writes a parquet file of time and value columns, and with a key column if merged'''
+
+    def __init__(self, filename, merged) -> None:
+        fields = [('time', pyarrow.float64()), ('value', pyarrow.float64())]
+        if merged:
+            fields.insert(0, ('key', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())))
+        self.writer = pyarrow.parquet.ParquetWriter(filename, pyarrow.schema(fields), compression='zstd')
+
+    def write(self, key, times, values, merged):
+        for i in range(0, len(times), BLOCK_ROWS):
+            columns = {'time': np.asarray(times[i:i + BLOCK_ROWS]), 'value': np.asarray(values[i:i + BLOCK_ROWS])}
+            if merged:
+                index = pyarrow.array(np.zeros(len(columns['time']), dtype=np.int32))
+                columns = {'key': pyarrow.DictionaryArray.from_arrays(index, pyarrow.array([key])), **columns}
+            self.writer.write_table(pyarrow.table(columns, schema=self.writer.schema))
+
+    def close(self):
+        self.writer.close()
+
+class Hdf5Writer:
+    '''Writes a hdf5 file with times and values datasets, in a group per key if merged'''
+
+    def __init__(self, filename) -> None:
+        self.file = h5py.File(filename, 'w')
+
+    def write(self, key, times, values, merged):
+        group = self.file.create_group(key) if merged else self.file
+        chunks = (min(max(len(times), 1), 65536),)
+        for name, array in (('times', times), ('values', values)):
+            dataset = group.create_dataset(name, shape=(len(array),), dtype='<f8', chunks=chunks, compression='gzip')
+            for i in range(0, len(array), BLOCK_ROWS):
+                dataset[i:i + BLOCK_ROWS] = array[i:i + BLOCK_ROWS]
+
+    def close(self):
+        self.file.close()
+
+def make_writer(filename, format, merged):
+    if format == 'parquet':
+        return ParquetWriter(filename, merged)
+    if format == 'hdf5':
+        return Hdf5Writer(filename)
+    return NpzWriter(filename)
+
+def tmp_filename(filename):
+    '''Outputs are written to this first, so that they are only there once complete'''
+    return os.path.join(os.path.dirname(filename), '.' + os.path.basename(filename) + '.tmp')
+
+def write_output(filename, format, merged, keys, out_dir):
+    '''Writes the decoded keys to filename, via a temporary file'''
+    tmp = tmp_filename(filename)
+    try:
+        writer = make_writer(tmp, format, merged)
+        try:
+            for key in keys:
+                writer.write(key, *load_raw(out_dir, key), merged)
+        finally:
+            writer.close()
+        os.replace(tmp, filename)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def export_key(key, start, end, out_dir, format, dir=SAVE_DIR, old_dir=BACK_DIR):
+    '''Exports key to its own file in out_dir, this is run on the pool. 
+    Returns (key, filename, count), these are None if it was skipped'''
+    try:
+        count = decode_key(key, start, end, out_dir, dir, old_dir)
+        if count is None:
+            return key, None, None
+        filename = os.path.join(out_dir, key + FORMATS[format])
+        write_output(filename, format, False, [key], out_dir)
+        return key, filename, count
+    finally:
+        remove_raw(out_dir, key)
+
+def export_logs(patterns, since=None, until=None, out_dir='./export/', format='npz', merge=False, processes=None,
+                dir=SAVE_DIR, old_dir=BACK_DIR):
+    '''Exports the logs of the keys matching patterns between since and until (see LogServer.parse_time).
+
+    Args:
+        patterns (list): keys or globs of them
+        since, until: range of times, by default everything
+        out_dir (str): folder for the files
+        format (str): one of FORMATS, which must be in available_formats()
+        merge (bool): whether to write all keys to one file, export.<format>, rather than a file each
+        processes (int): number of processes to decode the keys on, by default the number of CPUs
+
+    Returns:
+        dict: of key to the number of values exported, None for keys which were skipped
+    '''
+    if not format in available_formats():
+        raise ValueError(f"Format {format} is not available, only {available_formats()}")
+    start = LogServer.parse_time(since, -np.inf)
+    end = LogServer.parse_time(until, np.inf)
+    keys = find_keys(patterns, dir, old_dir)
+    os.makedirs(out_dir, exist_ok=True)
+
+    counts = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+        if not merge:
+            jobs = [pool.submit(export_key, key, start, end, out_dir, format, dir, old_dir) for key in keys]
+            for job in concurrent.futures.as_completed(jobs):
+                key, filename, count = job.result()
+                counts[key] = count
+                if count is not None:
+                    print(f"Exported {count} values of {key} to {filename}")
+            return counts
+
+        # Otherwise the keys are decoded on the pool, and written here, in order. Only a few are 
+        # decoded ahead of the writing, so the temporary files don't build up. The output is only 
+        # moved into place once all are written, so a key failing doesn't leave a partial file.
+        filename = os.path.join(out_dir, 'export' + FORMATS[format])
+        tmp = tmp_filename(filename)
+        ahead = 2 * (processes or os.cpu_count() or 1)
+        jobs = {}
+        try:
+            writer = make_writer(tmp, format, True)
+            try:
+                for i, key in enumerate(keys):
+                    for _key in keys[i:i + ahead]:
+                        if not _key in jobs:
+                            jobs[_key] = pool.submit(decode_key, _key, start, end, out_dir, dir, old_dir)
+                    try:
+                        counts[key] = jobs.pop(key).result()
+                        if counts[key] is not None:
+                            writer.write(key, *load_raw(out_dir, key), True)
+                            print(f"Exported {counts[key]} values of {key}")
+                    finally:
+                        remove_raw(out_dir, key)
+            finally:
+                writer.close()
+            os.replace(tmp, filename)
+        finally:
+            for job in jobs.values():
+                job.cancel()
+            concurrent.futures.wait(jobs.values())
+            for key in keys:
+                remove_raw(out_dir, key)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    return counts
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='Log Export',
+        description='Exports the logged values of keys to columnar files')
+
+    parser.add_argument('keys', nargs='+')
+    parser.add_argument('-s', '--since')
+    parser.add_argument('-u', '--until')
+    parser.add_argument('-o', '--out', default='./export/')
+    parser.add_argument('-f', '--format', default='npz', choices=list(FORMATS.keys()))
+    parser.add_argument('-p', '--processes', type=int)
+    parser.add_argument('--merge', action='store_true')
+
+    args = parser.parse_args()
+
+    _start = time.perf_counter()
+    counts = export_logs(args.keys, args.since, args.until, args.out, args.format, args.merge, args.processes)
+    exported = [count for count in counts.values() if count is not None]
+    print(f"Exported {sum(exported)} values of {len(exported)} keys in {time.perf_counter() - _start:.2f}s")
+    skipped = [key for key, count in counts.items() if count is None]
+    if len(skipped):
+        print(f"Skipped {', '.join(skipped)}")
@@ -113,6 +113,25 @@ def get_tracked_value(key):
     callbacks.values[key] = value
     return value
 
+def get_tracked_values(keys):
+    '''Version of get_tracked_value for several keys, those not already known are requested together'''
+    values = {}
+    missing = []
+    for key in keys:
+        value = callbacks.get_value(key)
+        if value is not None:
+            values[key] = value
+        else:
+            missing.append(key)
+    if len(missing):
+        client = make_client()
+        found = client.get_many(missing)
+        client.close()
+        for key, value in found.items():
+            callbacks.values[key] = value
+            values[key] = value
+    return values
+
 def register_tracked_key(key):
     if callbacks.add_listener(key, callbacks.listener):
         callbacks.register_listener(key)
@@ -1166,9 +1185,11 @@ class TableDisplayWidget(QTableWidget):
         self.client = module.client
         if data_source is not None:
             self.get_value = data_source.get_value
+            self.get_values = lambda keys:{key:data_source.get_value(key) for key in keys}
             self.register_value = lambda *_:()
         else:
             self.get_value = get_tracked_value
+            self.get_values = get_tracked_values
             self.register_value = register_tracked_key
         self.col_headers = headers[0]
         self.row_headers = headers[1]
@@ -1223,6 +1244,12 @@ class TableDisplayWidget(QTableWidget):
         # rows format is a list of lists as follows:
         # [ "Name", valueA, fmtA, valueB, fmtB, etc]
         column_widths = [0.0 for _ in range(self.columnCount())]
+        # Fetch all of the values at once, rather than a request per cell
+        keys = [row[i] for row in self.rows for i in range(0,len(row),2)]
+        if self.init:
+            for key in keys:
+                self.register_value(key)
+        values = self.get_values(keys)
         for n in range(len(self.rows)):
             row = self.rows[n]
             m = 0
@@ -1230,10 +1257,7 @@ class TableDisplayWidget(QTableWidget):
                 key = row[i]
                 fmt = row[i + 1]
                 cell_key = f'{n},{m}'
-                var = None
-                if self.init:
-                    self.register_value(key)
-                var = self.get_value(key)
+                var = values.get(key)
                 val = None
                 if var is not None:
                     val = var
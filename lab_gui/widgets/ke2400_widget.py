@@ -82,6 +82,8 @@ class IVCurveWidget(KE2400Mode):
         self.v_0_key = f'{name}_V_0'
         self.v_1_key = f'{name}_V_1'
         self.measure_n = f'{name}_N'
+        # Finished sweeps are published here as an array of [V, I, T]
+        self.iv_key = f'{name}_IV_Curve'
 
         try_init_value(self.i_cmpl_key, 1e-1)
         try_init_value(self.v_0_key, -10)
@@ -325,6 +327,7 @@ class IVCurveWidget(KE2400Mode):
                                     V_arr = numpy.array(V_arr)
                                     I_arr = numpy.array(I_arr)
                                     self.parent.plot_data = [V_arr, I_arr, I_arr, True, 0]
+                                    self.client.set_value(self.iv_key, numpy.array([V_arr, I_arr, numpy.array(T_arr)]))
 
                                     if self.parent.do_log:
                                         try:
@@ -17,13 +17,14 @@ class MSO2012(DeviceReader):
     
     This presently displays the 2 channels for the scope. It is not yet set to save logs of the output though.
     '''
-    def __init__(self, parent, addr, channels=['ch1', 'ch2']):
+    def __init__(self, parent, addr, channels=['ch1', 'ch2'], trace_key=None):
         """_summary_
 
         Args:
             parent (FigureModule): the module we are made from
             addr (str): pyvisa address of the scope
             channels (list, optional): channels to display. Defaults to ['ch1', 'ch2'].
+            trace_key (str, optional): if given, each channel's trace is published to the data server as trace_key_channel, as an array of [times, values]. Defaults to None.
         """
 
         # Set this first as it is needed in super().__init__
@@ -33,6 +34,7 @@ class MSO2012(DeviceReader):
 
         self.plot_data = {key:[[], [], [], False, 0] for key in channels}
         self.raw_data = {key:[[],[[],[]]] for key in channels}
+        self.trace_key = trace_key
 
         self.addr = addr
         # Update settings scales so that the pA title is correct
@@ -106,6 +108,7 @@ class MSO2012(DeviceReader):
         return self.plot_data[key]
 
     def do_device_update(self):
+        traces = {}
         for channel in self.channels:
             vars, times = self.acquire(channel)
             plots = self.plot_data[channel]
@@ -113,6 +116,10 @@ class MSO2012(DeviceReader):
             plots[1] = vars
             plots[2] = vars
             plots[3] = True
+            if self.trace_key is not None and vars is not None:
+                traces[f'{self.trace_key}_{channel}'] = (None, numpy.array([times, vars]))
+        if len(traces):
+            self.client.set_many(traces)
 
     def close_device(self):
         if self.device is None:
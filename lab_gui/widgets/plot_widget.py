@@ -18,85 +18,139 @@ from ..utils.data_client import BaseDataClient
 from ..utils.data_server import LogServer
 
 from ..modules.module import BetterAxisItem, BaseSettings
-from .base_control_widgets import register_tracked_key, get_tracked_value, addCrossHairs, make_client
+from . import base_control_widgets
+from .base_control_widgets import register_tracked_key, get_tracked_value, addCrossHairs
 
 LOG_ACCESS = True
 
 def can_access_logs():
     return LOG_ACCESS and BaseDataClient.DATA_LOG_HOST != None
 
-def get_value_log(key, start=1, end=0, since=None, until=None):
-    '''
-    This asks the Logging computer for the log of values for the given key.
-
-    key is the item to obtain the log for
-    if all is true, then it will obtain values from start hours ago untill end hours ago
-    if all is false, then it will obtain the values since last, where last is a string representation
-    of a datetime
-
-    The return value is a tuple, of (valid, array), where valid is whether
-    the data was obtained
-    '''
-    
+def request_log(name, message):
+    '''Sends message to the Logging computer, returns the response as (valid, values), see LogServer.read_response'''
     try:
         client_socket = socket.socket()     # instantiate
         client_socket.settimeout(10)        # Set a longish timeout, as we can request many things
         client_socket.connect(BaseDataClient.DATA_LOG_HOST)# connect to the server
 
-        # Assemble message based on parameters
-        message = LogServer.make_request_message(key, start, end, since, until)
-
         # print(f"Sending {message}")
         # Send message to server
         client_socket.send(message.encode())
         # print(f"Sent {message}")
         
-        read = b'' # Build the response, by combining recv calls
-        data = client_socket.recv(LogServer.MAX_PACKET_SIZE)  # receive response
-        while data:
-            read += data
-            data = client_socket.recv(LogServer.MAX_PACKET_SIZE)  # receive response
-        if read.endswith(b'error!'):
-            packet = b'error!'
-        else:
-            packet = read
-            # If we are a combined packet, we have these as header and footer
-            s = read.index(LogServer.HEADER)
-            e = read.index(LogServer.FOOTER)
-            if s >= 0 and e >= 0:
-                packet = read[s + len(LogServer.HEADER):e]
-            else:
-                packet = b'error!'
-
+        # Read the response, this is decoded as it arrives
+        valid, values = LogServer.read_response(client_socket)
         client_socket.close()  # close the connection
     except Exception as err:
-        print(f'Log Update Error for {key}: {err}')
+        print(f'Log Update Error for {name}: {err}')
+        return False, []
+    return valid, values
+
+def get_aligned_log(keys, since, until=None, shifts=None, mode='grid', step=None):
+    '''
+    This asks the Logging computer for the logs of several keys, aligned in time, see LogServer.update_aligned.
+
+    shifts are the time shift for each key, mode is 'grid' for means in bins of step seconds, or 'asof'
+    for the values at the times of the first key.
+
+    The return value is a tuple, of (valid, array), where array has rows of the times, and then the values 
+    of each key
+    '''
+    message = LogServer.make_aligned_message(keys, since, until, shifts=shifts, mode=mode, step=step)
+    valid, values = request_log(keys, message)
+    if not isinstance(values, numpy.ndarray):
+        # Only older servers would send anything else
+        return False, []
+    return valid, values
+
+def get_aggregated_log(key, since, until=None, width=60, stats=('mean',)):
+    '''
+    This asks the Logging computer for statistics of the values for key, in bins of width seconds.
+    stats are any of LogServer's STATISTICS, ie mean, min, max, std, count, sum, first, last
+
+    The return value is a tuple, of (valid, array), where array has rows of the bin start times, 
+    and then each of the stats, for the bins which have values
+    '''
+    message = LogServer.make_request_message(key, since=since, until=until, binary=True,
+                                             aggregate={'width': width, 'stats': list(stats)})
+    valid, values = request_log(key, message)
+    if not isinstance(values, numpy.ndarray):
         return False, []
+    return valid, values
 
-    # If we got b'error!', then it wasn't a valid response
-    valid = packet != b'error!'
-    values = []
+def get_value_log(key, start=1, end=0, since=None, until=None, points=None):
+    '''
+    This asks the Logging computer for the log of values for the given key.
+
+    key is the item to obtain the log for
+    if all is true, then it will obtain values from start hours ago untill end hours ago
+    if all is false, then it will obtain the values since last, where last is a string representation
+    of a datetime
+    if points is given, the server may instead send aggregated values, see envelope
+
+    The return value is a tuple, of (valid, array), where valid is whether
+    the data was obtained. array is a numpy array, or lists if from an older server
+    '''
+    
+    # Assemble message based on parameters
+    message = LogServer.make_request_message(key, start, end, since, until, points=points, binary=True)
+    valid, values = request_log(key, message)
+
+    if isinstance(values, numpy.ndarray):
+        # Binary columns, which went straight into numpy
+        if valid and numpy.any(numpy.diff(values[0]) < 0):
+            values = values[:, numpy.argsort(values[0], kind='stable')]
+        return valid, values
+
+    # Otherwise we got some json to unpack values from
+    valid = valid and len(values) > 0 and len(values[0]) > 0
     if valid:
-        packet = zlib.decompress(packet)
-        valid = packet != b'error!'
-        if not valid:
-            return valid, values
-        # Otherwise we got some json to unpack values from
-        values = json.loads(packet.decode())
-        valid = len(values) > 0 and len(values[0]) > 0
-        if valid:
-            _x = values[0]
-            _y = values[1]
-            x1,y1 = zip(*sorted(zip(_x,_y)))
-            values[0] = list(x1)
-            values[1] = list(y1)
+        rows = zip(*sorted(zip(*values)))
+        values = [list(row) for row in rows]
     # print(f'Read: {len(values)} ({valid})')
     # if valid:
     #     print(values[0][0],values[1][0])
     return valid, values
 
+def get_value_recent(key, start=1, complete=True):
+    '''
+    This asks the data server for the values of key from the last start hours, which it keeps in memory.
+
+    The return value is a tuple, of (valid, array), as for get_value_log. If complete, then this is
+    only valid if the server had values from all of that time.
+    '''
+    since = time.time() - start * 3600
+    try:
+        # Looked up now, as set_MQTT replaces it, and only the data server keeps recent values
+        client = base_control_widgets.make_client()
+        if not hasattr(client, 'get_recent'):
+            client.close()
+            return False, []
+        window = client.get_recent(key, since=since)
+        client.close()
+    except Exception as err:
+        print(f'Recent Update Error for {key}: {err}')
+        return False, []
+    if window is None or window.shape[1] == 0:
+        return False, []
+    if complete and window[0, 0] > since:
+        return False, []
+    return True, window
+
+def envelope(values):
+    '''Converts the aggregated values from get_value_log, [times, means, mins, maxs, counts], to [times, values] 
+    with the min and max for each time, so that spikes are still shown. Others are returned as they are.'''
+    if len(values) != 5:
+        return values
+    times = numpy.repeat(values[0], 2)
+    _values = numpy.empty(len(times))
+    _values[0::2] = values[2]
+    _values[1::2] = values[3]
+    return [times, _values]
+
 _plots = {} # Map of the data logs
 _preload_hours = 1 # How long to default preload
+_log_points = 10000 # Number of points to request, the server aggregates longer ranges down to about this many
 _max_points = 1e6
 
 def smooth_average(array):
@@ -105,28 +159,38 @@ def smooth_average(array):
     return signal.filtfilt(b, a, array)
 
 def pre_fill(key, start, end=0):
-    plots = _plots[key]
-    # First get the all array, up to preload hours
-    valid, array = get_value_log(key, start=start, end=end)
+    # The data server keeps recent values in memory, so try that before the logs
+    valid = False
+    if end == 0:
+        valid, array = get_value_recent(key, start)
+    # Otherwise get the all array, up to preload hours
+    if not valid:
+        valid, array = get_value_log(key, start=start, end=end, points=_log_points)
+        array = envelope(array)
     if valid:
-        _array = numpy.array(array)
-        _x = _array[0]
-        _y = _array[1]
+        fill_plot(key, array)
 
-        # If we were valid, stuff the values into the array,
-        # We do have a maxiumum number of values of _max_points however
-        size = min(len(_x), _max_points)
+def fill_plot(key, array):
+    '''Fills the plot for key with array, which is [times, values]'''
+    plots = _plots[key]
+    _array = numpy.array(array)
+    _x = _array[0]
+    _y = _array[1]
+
+    # If we were valid, stuff the values into the array,
+    # We do have a maxiumum number of values of _max_points however
+    size = min(len(_x), _max_points)
 
-        times = numpy.full(int(_max_points), _x[0]) # Pre-populate array with the start values
-        values = numpy.full(int(_max_points), _y[0])
-        times[:size] = _x
-        values[:size] = _y
+    times = numpy.full(int(_max_points), _x[0]) # Pre-populate array with the start values
+    values = numpy.full(int(_max_points), _y[0])
+    times[:size] = _x
+    values[:size] = _y
 
-        plots[0] = times
-        plots[1] = values
-        plots[2] = smooth_average(values)
-        plots[3] = True # Mark the plot as having been initialised
-        plots[4] = size # treat as having rolled back size times
+    plots[0] = times
+    plots[1] = values
+    plots[2] = smooth_average(values)
+    plots[3] = True # Mark the plot as having been initialised
+    plots[4] = size # treat as having rolled back size times
 
 def clear_plot(key, reload=False, start=None, end=0):
     '''Initialises a clear plot for key, if reload is True, then we also try to populate it from the SQL tables'''
@@ -211,6 +275,10 @@ def get_values(first:bool, key:str):
 
     if first:
         register_tracked_key(key)
+        # Without the logs, we can still start with what the data server has in memory
+        valid, array = get_value_recent(key, _preload_hours, complete=False)
+        if valid:
+            fill_plot(key, array)
     # Now try filling new value in
     
     plots = _plots[key]
@@ -227,6 +295,42 @@ def get_values(first:bool, key:str):
     if timestamp != times[-1]:
         roll_plot_values(plots, [value], [timestamp])
 
+def tail_values(key, stopped):
+    '''Follows the values for key as the Logging computer pushes them, until stopped() is true,
+    or the connection ends. Returns False if the server did not accept the subscription, ie
+    it is an older one, so needs polling instead.'''
+    plots = _plots[key]
+    message = LogServer.make_subscribe_message([key], since=plots[0][-1])
+    subscribed = False
+    client_socket = socket.socket()
+    try:
+        client_socket.settimeout(3 * LogServer.KEEPALIVE)
+        client_socket.connect(BaseDataClient.DATA_LOG_HOST)
+        client_socket.send(message.encode())
+        # Short, so that stopped() is checked while the key is idle, read_tail still gives up 
+        # after 3 * KEEPALIVE without anything, as we get at least a keep-alive each KEEPALIVE
+        client_socket.settimeout(1)
+        for _key, times, values in LogServer.read_tail(client_socket, stopped):
+            subscribed = True
+            if stopped():
+                break
+            if _key != key or not len(times):
+                continue
+            plots = _plots[key]
+            if len(plots) > 5 and plots[5]:
+                continue
+            # The server can send some values twice when we subscribe
+            new = times > plots[0][-1]
+            if numpy.any(new):
+                roll_plot_values(plots, values[new], times[new])
+    except Exception as err:
+        print(f'Log Subscription Error for {key}: {err}')
+        # Not the server's fault, so try again later
+        subscribed = True
+    finally:
+        client_socket.close()
+    return subscribed
+
 __threads__ = {} # Cache of threads to prevent the GC from eating them
 __update_rate_ = 2.5e-1
 
@@ -244,19 +348,28 @@ def run_plot_thread(key):
 
         # We only want to automatically clear if we have access to historical logs
         auto_clears = can_access_logs()
+        # With the logs, new values are pushed to us rather than polled for
+        tails = auto_clears
+
+        def stopped():
+            # Check if we have not been used lately, and if so, terminate
+            last_access = cache[2]
+            if auto_clears and time.time() - last_access > 300:
+                cache[1] = False
+            return not cache[1]
 
         from time import perf_counter
         lastTime = perf_counter()
         n = 0
         while cache[1]:
+            if tails and not first:
+                # This returns once the subscription ends, then we poll once to catch up
+                tails = tail_values(key, stopped)
             get_values(first, key)
             first = False
             now = perf_counter()
             dt = now - lastTime
-            # Check if we have not been used lately, and if so, terminate
-            last_access = cache[2]
-            if auto_clears and time.time() - last_access > 300:
-                cache[1] = False
+            if stopped():
                 break
             if dt < __update_rate_:
                 time.sleep(__update_rate_ - dt)
@@ -410,7 +523,7 @@ class Settings(BaseSettings):
         super().make_option_dropdown(setting, key)
 
         def on_update():
-            client = make_client()
+            client = base_control_widgets.make_client()
             _map = client.get_all()
             option = setting._option
             old_selected = setting.get_value()
@@ -488,7 +601,7 @@ class Plot(QWidget):
 
         self.show_avg = True # Whether we include a smoothed plot
 
-        self.client = make_client()
+        self.client = base_control_widgets.make_client()
 
         self.settings = Settings() # Settings object we use
 
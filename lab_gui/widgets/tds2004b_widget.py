@@ -24,13 +24,14 @@ class TDS2004B(DeviceReader):
     
     This presently displays the 4 channels for the scope. It is not yet set to save logs of the output though.
     '''
-    def __init__(self, parent, addr, channels=['ch1', 'ch2', 'ch3', 'ch4']):
+    def __init__(self, parent, addr, channels=['ch1', 'ch2', 'ch3', 'ch4'], trace_key=None):
         """_summary_
 
         Args:
             parent (FigureModule): the module we are made from
             addr (str): pyvisa address of the scope
             channels (list, optional): channels to display. Defaults to ['ch1', 'ch2', 'ch3', 'ch4'].
+            trace_key (str, optional): if given, each channel's trace is published to the data server as trace_key_channel, as an array of [times, values]. Defaults to None.
         """
 
         # Set this first as it is needed in super().__init__
@@ -44,6 +45,7 @@ class TDS2004B(DeviceReader):
         super().__init__(parent, data_key=None, name=f"TDS2004B", axis_title=f"Signal (V)")
 
         self.plot_data = {key:[[0], [0], [0], False, 0] for key in channels}
+        self.trace_key = trace_key
 
         self.addr = addr
         # Update settings scales so that the pA title is correct
@@ -217,6 +219,7 @@ class TDS2004B(DeviceReader):
         return self.plot_data[key]
 
     def do_device_update(self):
+        traces = {}
         for channel in self.channels:
             vars, times = self.acquire(channel)
             if vars is None:
@@ -226,6 +229,10 @@ class TDS2004B(DeviceReader):
             plots[1] = vars
             plots[2] = vars
             plots[3] = True
+            if self.trace_key is not None:
+                traces[f'{self.trace_key}_{channel}'] = (None, numpy.array([times, vars]))
+        if len(traces):
+            self.client.set_many(traces)
 
     def close_device(self):
         if self.device is None:
@@ -1,6 +1,7 @@
 import serial
 import time
 import os
+from datetime import datetime
 
 from .device_widget import DeviceReader
 from .plot_widget import Settings
@@ -158,8 +159,6 @@ class TPG256(DeviceReader):
         if valid:
             value = float(response[1])
             timestamp = time.time()
-            if key is not None:
-                self.client.set_float(key, value)
         return valid, value, timestamp
 
     def read_device(self):
@@ -189,6 +188,15 @@ class TPG256(DeviceReader):
                 first_channel = False
                 valid, value, timestamp = _valid, _value, timestamp
         self.read_lock = False
+
+        # Send all of the sensors to the server together
+        to_set = {}
+        for read in read_values:
+            if read is not None:
+                _timestamp, _value, key = read
+                to_set[key] = (datetime.fromtimestamp(_timestamp), _value)
+        if len(to_set):
+            self.client.set_many(to_set)
         
         # Now check if we need to log things
         if self.do_log:
@@ -0,0 +1,34 @@
+import os
+
+import pytest
+
+from lab_gui.utils import data_server
+
+def start_server(port=0):
+    '''Starts a tcp data server on this machine, without a DataSaver, returns (server, thread)'''
+    server = data_server.BaseDataServer(tcp=True, addr=("127.0.0.1", port))
+    loop = data_server.ServerLoop()
+    loop.add_server(server)
+    thread = loop.make_thread()
+    thread.start()
+    return server, thread
+
+def stop_server(server, thread):
+    server._running_ = False
+    thread.join()
+    server.close()
+
+@pytest.fixture(scope='module')
+def server():
+    '''Address of a data server for the tests in the module'''
+    server, thread = start_server()
+    yield ("127.0.0.1", server.port)
+    stop_server(server, thread)
+
+@pytest.fixture
+def log_dirs(tmp_path, monkeypatch):
+    '''Runs the test in tmp_path, where the log folders are, as their paths are relative'''
+    monkeypatch.chdir(tmp_path)
+    for dir in (data_server.SAVE_DIR, data_server.BACK_DIR, data_server.LEVEL_DIR):
+        os.makedirs(dir)
+    return tmp_path
@@ -0,0 +1,141 @@
+import socket
+import threading
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from lab_gui.utils import data_client
+from lab_gui.utils.data_client import pack_frame, recv_frame, recv_exact, pack_size, unpack_size
+from lab_gui.utils.data_client import pack_set, unpack_values, split_values, unpack_value
+
+def test_frames():
+    a, b = socket.socketpair()
+    with a, b:
+        msgs = [b'get', b'', b'x' * 100000]
+        # Sent from another thread, as they don't all fit in the socket's buffer
+        thread = threading.Thread(target=a.sendall, args=(b''.join(pack_frame(msg) for msg in msgs),))
+        thread.start()
+        assert [recv_frame(b) for _ in msgs] == msgs
+        thread.join()
+
+def test_frame_closed_early():
+    a, b = socket.socketpair()
+    with b:
+        a.sendall(pack_frame(b'hello')[:-2])
+        a.close()
+        with pytest.raises(ConnectionError):
+            recv_frame(b)
+
+def test_recv_exact():
+    a, b = socket.socketpair()
+    with a, b:
+        a.sendall(b'abc')
+        a.sendall(b'def')
+        assert recv_exact(b, 5) == b'abcde'
+        assert recv_exact(b, 1) == b'f'
+
+def test_size_small():
+    for size in (0, 1, 31, 32, 1000, 1023):
+        packed = pack_size(size)
+        assert len(packed) == 2
+        assert unpack_size(packed) == (size, 2)
+
+def test_size_large():
+    for size in (1024, 1025, 65536, 2**32 - 1):
+        packed = pack_size(size)
+        assert packed[0] == data_client.LARGE_SIZE
+        assert unpack_size(packed) == (size, data_client.LARGE_HEADER.size)
+
+def test_size_offset():
+    data = b'xx' + pack_size(1023) + pack_size(1024)
+    assert unpack_size(data, 2) == (1023, 2)
+    assert unpack_size(data, 4) == (1024, data_client.LARGE_HEADER.size)
+
+def test_long_strings():
+    timestamp = datetime.fromtimestamp(1700000000.0)
+    longest = 'x' * data_client.StringValue.MAX_LENGTH
+    for value, tag in ((longest, 4), (longest + 'x', data_client.PICKLE_TAG), ('é' * 20000, data_client.PICKLE_TAG)):
+        packed = data_client.pack_set('key', timestamp, value)
+        assert packed[data_client.LARGE_HEADER.size + len(b'key') + len(data_client.DALIM)] == tag
+        assert data_client.unpack_value(packed) == (True, 'key', (timestamp, value))
+
+def test_arrays():
+    timestamp = datetime.fromtimestamp(1700000000.25)
+    arrays = [np.arange(12, dtype=np.float32).reshape(3, 4), np.arange(10, dtype='>i4'), np.zeros((2, 0, 3)),
+              np.array(5, dtype=np.uint8), np.arange(20.0).reshape(4, 5).T, np.array([1 + 2j, 3j])]
+    packed = [data_client.pack_data(timestamp, array) for array in arrays]
+    for array, _packed in zip(arrays, packed):
+        assert _packed[0] == data_client.ArrayValue().id
+        assert data_client.ArrayValue.packed_size(_packed) == len(_packed)
+        _timestamp, value = data_client.decode_value(_packed)
+        assert _timestamp == timestamp
+        assert value.dtype == array.dtype and value.shape == array.shape
+        np.testing.assert_array_equal(value, array)
+        # A view of the packed bytes, rather than a copy
+        assert not value.flags.owndata
+
+    times, values = data_client.unpack_arrays(b''.join(packed))
+    assert times == [timestamp.timestamp()] * len(arrays)
+    for array, value in zip(arrays, values):
+        np.testing.assert_array_equal(value, array)
+
+def test_array_types():
+    assert data_client.ArrayValue.valid_value(np.zeros(3))
+    assert not data_client.ArrayValue.valid_value(np.array(['a', 'b']))
+    assert not data_client.ArrayValue.valid_value(np.array([None, 1]))
+    assert not data_client.ArrayValue.valid_value([1.0, 2.0])
+    timestamp = datetime.fromtimestamp(1700000000.0)
+    # Others are still pickled
+    packed = data_client.pack_set('key', timestamp, np.array(['a', 'b']))
+    success, key, (_timestamp, value) = data_client.unpack_value(packed)
+    assert success and key == 'key' and list(value) == ['a', 'b']
+
+def mixed_values():
+    timestamp = datetime.fromtimestamp(1700000000.25)
+    return {
+        'double': (timestamp, 1.5),
+        'int': (timestamp, -7),
+        'bool': (timestamp, True),
+        'string': (timestamp, 'hello'),
+        # Needs the large size header
+        'long': (timestamp, 'x' * 2000),
+        'array': (timestamp, np.arange(12, dtype=np.float32).reshape(3, 4)),
+        'pickle': (timestamp, {'a': [1, 2]}),
+    }
+
+def check_values(values, unpacked):
+    assert [key for key, _ in unpacked] == list(values.keys())
+    for key, (timestamp, value) in unpacked:
+        assert timestamp == values[key][0]
+        if isinstance(value, np.ndarray):
+            assert value.dtype == values[key][1].dtype
+            np.testing.assert_array_equal(value, values[key][1])
+        else:
+            assert type(value) == type(values[key][1])
+            assert value == values[key][1]
+
+def test_unpack_values():
+    values = mixed_values()
+    msg = b''.join(pack_set(key, *value) for key, value in values.items())
+    check_values(values, unpack_values(msg))
+    # As at the end of get_all
+    check_values(values, unpack_values(msg + data_client.ALLSUCCESS))
+
+def test_split_values():
+    values = mixed_values()
+    msg = b''.join(pack_set(key, *value) for key, value in values.items())
+    unpacked = []
+    for value in split_values(msg + data_client.ALLSUCCESS):
+        success, key, unpacked_value = unpack_value(value)
+        assert success
+        unpacked.append((key, unpacked_value))
+    check_values(values, unpacked)
+
+def test_unpack_values_errors():
+    timestamp = datetime.fromtimestamp(1700000000.0)
+    key_err = b'gone' + data_client.DALIM + data_client.KEY_ERR
+    unknown = b'bad' + data_client.DALIM + bytes([99]) + b'\0' * 16
+    msg = (pack_set('a', timestamp, 1.0) + pack_size(len(key_err)) + key_err + 
+           pack_size(len(unknown)) + unknown + pack_set('b', timestamp, 2))
+    assert unpack_values(msg) == [('a', (timestamp, 1.0)), ('b', (timestamp, 2))]
@@ -0,0 +1,181 @@
+import time
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from lab_gui.utils import data_client, data_server
+
+from conftest import start_server, stop_server
+
+@pytest.mark.parametrize('session', [True, False])
+def test_client_values(server, session):
+    client = data_client.BaseDataClient(server, session=session)
+    prefix = f'test_{session}_'
+    timestamp = datetime.fromtimestamp(1700000000.5)
+    values = {
+        prefix + 'double': 2.5,
+        prefix + 'int': 3,
+        prefix + 'bool': False,
+        prefix + 'string': 'hello',
+        prefix + 'pickle': [1, 'two'],
+    }
+    for key, value in values.items():
+        assert client.set_value(key, value, timestamp)
+    assert client.in_session == session
+
+    for key, value in values.items():
+        assert client.get_value(key) == (timestamp, value)
+    assert client.get_value(prefix + 'missing') is None
+    client.close()
+
+@pytest.mark.parametrize('session', [True, False])
+def test_send_msgs(server, session):
+    client = data_client.BaseDataClient(server, session=session)
+    key = f'test_msgs_{session}'
+    timestamp = datetime.fromtimestamp(1700000000.0)
+    client.set_float(key, 1.0, timestamp)
+    resps = client.send_msgs([data_client.get_msg(key), data_client.get_msg(key + '_missing'), data_client.get_msg(key)])
+    assert data_client.unpack_value(resps[0]) == (True, key, (timestamp, 1.0))
+    assert data_client.unpack_value(resps[1])[2] == data_client.KEY_ERR
+    assert resps[2] == resps[0]
+    client.close()
+
+def test_session_reconnect():
+    server, thread = start_server()
+    port = server.port
+    client = data_client.BaseDataClient(("127.0.0.1", port), session=True)
+    assert client.set_float('test_reconnect', 1.0)
+    assert client.in_session
+    # The session is dropped when the server restarts
+    stop_server(server, thread)
+    server, thread = start_server(port)
+    try:
+        assert client.get_value('test_reconnect')[1] == 1.0
+        assert client.in_session
+    finally:
+        client.close()
+        stop_server(server, thread)
+
+@pytest.mark.parametrize('session', [True, False])
+def test_get_set_many(server, session):
+    client = data_client.BaseDataClient(server, session=session)
+    prefix = f'test_many_{session}_'
+    timestamp = datetime.fromtimestamp(1700000000.5)
+    values = {prefix + 'double': (timestamp, 2.5), prefix + 'int': (timestamp, 3), prefix + 'pickle': (timestamp, {'a': 1})}
+    assert client.set_many(values) == {key: True for key in values}
+    assert client.get_many(list(values) + [prefix + 'missing']) == {**values, prefix + 'missing': None}
+    assert client.get_many([]) == {}
+
+    # Without a timestamp it is set as of now
+    before = datetime.now()
+    assert client.set_many({prefix + 'now': (None, 1.0)}) == {prefix + 'now': True}
+    _timestamp, value = client.get_value(prefix + 'now')
+    assert value == 1.0 and _timestamp >= before
+    client.close()
+
+@pytest.mark.parametrize('session', [True, False])
+def test_get_all(server, session):
+    client = data_client.BaseDataClient(server, session=session)
+    prefix = f'test_all_{session}_'
+    timestamp = datetime.fromtimestamp(1700000000.5)
+    client.set_many({prefix + 'a': (timestamp, 1.0), prefix + 'b': (timestamp, 'b')})
+    values = client.get_all()
+    assert values[prefix + 'a'] == (timestamp, 1.0) and values[prefix + 'b'] == (timestamp, 'b')
+
+    mirror = client.get_mirror()
+    epoch, sequence = mirror.epoch, mirror.sequence
+    client.set_float(prefix + 'a', 2.0, timestamp)
+    client.set_float(prefix + 'c', 3.0, timestamp)
+    # Only those changed since are sent
+    resp = client.send_msg(data_client.changes_msg(epoch, sequence))[0]
+    assert dict(data_client.unpack_values(resp)) == {prefix + 'a': (timestamp, 2.0), prefix + 'c': (timestamp, 3.0)}
+    assert resp.endswith(data_client.DELTA)
+
+    values = client.get_all()
+    assert mirror.sequence > sequence
+    assert values[prefix + 'a'] == (timestamp, 2.0) and values[prefix + 'c'] == (timestamp, 3.0)
+    assert values == client.get_all_values()
+
+    # An unknown epoch, ie from before the server restarted, gets everything
+    resp = client.send_msg(data_client.changes_msg(b'0', 0))[0]
+    assert resp.endswith(data_client.FULL)
+    assert dict(data_client.unpack_values(resp)) == values
+    client.close()
+
+@pytest.mark.parametrize('session', [True, False])
+def test_large_values(server, session):
+    client = data_client.BaseDataClient(server, session=session)
+    prefix = f'test_large_{session}_'
+    timestamp = datetime.fromtimestamp(1700000000.5)
+    values = {prefix + 'edge': 'x' * 1000, prefix + 'string': 'y' * 2000, prefix + 'huge': 'z' * 4 * 1024**2, 
+              prefix + 'pickle': list(range(10000))}
+    for key, value in values.items():
+        assert client.set_value(key, value, timestamp)
+        assert client.get_value(key) == (timestamp, value)
+    assert client.get_many(values) == {key: (timestamp, value) for key, value in values.items()}
+    client.close()
+
+@pytest.mark.parametrize('session', [True, False])
+def test_array_values(server, session):
+    client = data_client.BaseDataClient(server, session=session)
+    prefix = f'test_array_{session}_'
+    timestamp = datetime.fromtimestamp(1700000000.5)
+    values = {prefix + 'small': np.arange(5, dtype=np.int16), prefix + 'image': np.random.default_rng(0).random((256, 256))}
+    assert all(client.set_many({key: (timestamp, value) for key, value in values.items()}).values())
+    for key, value in values.items():
+        _timestamp, _value = client.get_value(key)
+        assert _timestamp == timestamp
+        assert _value.dtype == value.dtype
+        np.testing.assert_array_equal(_value, value)
+    many = client.get_many(values)
+    for key, value in values.items():
+        np.testing.assert_array_equal(many[key][1], value)
+    client.close()
+
+@pytest.mark.parametrize('session', [True, False])
+def test_client_recent(server, session):
+    client = data_client.BaseDataClient(server, session=session)
+    key = f'test_recent_{session}'
+    start = time.time()
+    for i in range(10):
+        assert client.set_float(key, i, datetime.fromtimestamp(start + i))
+    window = client.get_recent(key)
+    np.testing.assert_array_equal(window[1], np.arange(10))
+    np.testing.assert_allclose(window[0], start + np.arange(10))
+    # The newest value before since is included, so it is known to be complete
+    window = client.get_recent(key, since=start + 4.5)
+    np.testing.assert_array_equal(window[1], np.arange(4, 10))
+    window = client.get_recent(key, count=3)
+    np.testing.assert_array_equal(window[1], np.arange(7, 10))
+    assert client.get_recent('test_recent_missing') is None
+    client.set_value(key + '_string', 'not a number')
+    assert client.get_recent(key + '_string') is None
+    client.close()
+
+def test_history_ring():
+    ring = data_server.HistoryRing(4)
+    for i in range(6):
+        ring.append(i, i * 10)
+    np.testing.assert_array_equal(ring.window(), [[2, 3, 4, 5], [20, 30, 40, 50]])
+    np.testing.assert_array_equal(ring.window(since=3.5)[0], [3, 4, 5])
+    np.testing.assert_array_equal(ring.window(count=2)[0], [4, 5])
+    np.testing.assert_array_equal(ring.window(seconds=1)[0], [4, 5])
+    ring.grow(8)
+    ring.append(6, 60)
+    np.testing.assert_array_equal(ring.window()[0], [2, 3, 4, 5, 6])
+
+def test_recent_history_budget():
+    packed = [data_client.pack_data(datetime.fromtimestamp(i), float(i)) for i in range(100)]
+    # Room for a ring of 8, and one grown to 16
+    history = data_server.RecentHistory(length=16, budget=24 * 16, initial=8)
+    for value in packed:
+        history.add('a', value)
+    np.testing.assert_array_equal(history.window('a')[1], np.arange(84, 100))
+    for value in packed:
+        history.add('b', value)
+    # Then b can't grow, so just wraps
+    np.testing.assert_array_equal(history.window('b')[1], np.arange(92, 100))
+    history.add('c', packed[0])
+    assert history.window('c') is None
+    assert history.used <= history.budget
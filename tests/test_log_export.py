@@ -0,0 +1,66 @@
+import os
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from lab_gui.utils import data_client, data_server, log_export
+
+START = 1700000000.0
+
+def write_log(filename, times, values):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'wb') as file:
+        for time, value in zip(times, values):
+            file.write(data_client.pack_data(datetime.fromtimestamp(time), value))
+
+@pytest.fixture
+def logs(log_dirs):
+    '''Writes the logs to export, returns the (times, values) of those which can be'''
+    old = START + np.arange(5000.0)
+    new = START + 5000 + np.arange(100.0)
+    write_log(data_server.BACK_DIR + 'temp_a/temp_a_1.dat', old, np.sin(old))
+    write_log(data_server.SAVE_DIR + 'temp_a.dat', new, np.sin(new))
+    write_log(data_server.SAVE_DIR + 'temp_b.dat', new, np.arange(100.0))
+    write_log(data_server.SAVE_DIR + 'other.dat', new, new)
+    write_log(data_server.SAVE_DIR + 'temp_arrays.dat', new[:2], [np.zeros(3), np.ones(3)])
+    # Not something which can be decoded
+    with open(data_server.SAVE_DIR + 'temp_bad.dat', 'wb') as file:
+        file.write(bytes([4]) + b'\0' * 8 + b'\x05\x00hello')
+    times = np.concatenate((old, new))
+    return {'temp_a': (times, np.sin(times)), 'temp_b': (new, np.arange(100.0))}
+
+def test_find_keys(logs):
+    assert log_export.find_keys(['temp_*']) == ['temp_a', 'temp_arrays', 'temp_b', 'temp_bad']
+    assert log_export.find_keys(['temp_b', 'other']) == ['other', 'temp_b']
+
+def test_export(logs):
+    counts = log_export.export_logs(['temp_*'], processes=2)
+    assert counts == {'temp_a': 5100, 'temp_b': 100, 'temp_arrays': None, 'temp_bad': None}
+    # Nothing is left of the temporary files
+    assert sorted(os.listdir('./export/')) == ['temp_a.npz', 'temp_b.npz']
+    for key, (times, values) in logs.items():
+        with np.load(f'./export/{key}.npz') as data:
+            np.testing.assert_array_equal(data['times'], times)
+            np.testing.assert_array_equal(data['values'], values)
+
+    counts = log_export.export_logs(['temp_a'], since=START + 1000, until=START + 2000, out_dir='./range/', processes=2)
+    assert counts == {'temp_a': 1000}
+    with np.load('./range/temp_a.npz') as data:
+        np.testing.assert_array_equal(data['times'], START + 1000 + np.arange(1000.0))
+
+def test_export_merged(logs):
+    counts = log_export.export_logs(['temp_*'], merge=True, processes=2)
+    assert counts == {'temp_a': 5100, 'temp_b': 100, 'temp_arrays': None, 'temp_bad': None}
+    assert os.listdir('./export/') == ['export.npz']
+    with np.load('./export/export.npz') as data:
+        assert sorted(data.files) == ['temp_a.times', 'temp_a.values', 'temp_b.times', 'temp_b.values']
+        for key, (times, values) in logs.items():
+            np.testing.assert_array_equal(data[key + '.times'], times)
+            np.testing.assert_array_equal(data[key + '.values'], values)
+
+def test_export_format(logs):
+    if 'parquet' in log_export.available_formats():
+        pytest.skip('pyarrow is installed')
+    with pytest.raises(ValueError):
+        log_export.export_logs(['temp_*'], format='parquet')
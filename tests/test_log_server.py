@@ -0,0 +1,330 @@
+import json
+import os
+import socket
+import threading
+import zlib
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from lab_gui.utils import data_client, data_server
+from lab_gui.utils.data_server import DataSaver, LogServer
+
+@pytest.fixture
+def log_server(log_dirs):
+    '''A LogServer for the logs in log_dirs'''
+    server = LogServer(("127.0.0.1", 0))
+    thread = server.make_thread()
+    thread.start()
+    yield server
+    server._running_ = False
+    for _thread in (thread, server.thread_2, server.thread_3):
+        _thread.join()
+    server.polls.shutdown()
+    server.scans.shutdown()
+    server.connection.close()
+
+def save_log(key, times, values):
+    saver = DataSaver()
+    saver.save({key.encode(): [data_client.pack_data(datetime.fromtimestamp(time), value) for time, value in zip(times, values)]})
+    saver.close()
+
+def read_sent(data):
+    '''Returns the response read from data, as if it was sent by the server'''
+    a, b = socket.socketpair()
+    with b:
+        # Sent from another thread, as it may not fit in the socket's buffer
+        def send():
+            with a:
+                a.sendall(data)
+        thread = threading.Thread(target=send)
+        thread.start()
+        try:
+            return LogServer.read_response(b)
+        finally:
+            thread.join()
+
+def request(server, message):
+    with socket.create_connection(("127.0.0.1", server.port)) as sock:
+        sock.sendall(message.encode())
+        return LogServer.read_response(sock)
+
+START = 1700000000.0
+
+def test_binary_response(log_server):
+    times = START + np.arange(1000) * 0.5
+    values = np.sin(np.arange(1000.0))
+    save_log('a', times, values)
+    for compress in (True, False):
+        message = LogServer.make_request_message('a', since=START - 1, until=START + 1000, binary=True, compress=compress)
+        valid, columns = request(log_server, message)
+        assert valid
+        assert columns.dtype == np.float64 and columns.shape == (2, 1000)
+        np.testing.assert_array_equal(columns, [times, values])
+
+    # The same values as json
+    valid, columns = request(log_server, LogServer.make_request_message('a', since=START - 1, until=START + 1000))
+    assert valid
+    np.testing.assert_array_equal(columns, [times, values])
+
+    # Only those in range
+    message = LogServer.make_request_message('a', since=START + 100, until=START + 200, binary=True)
+    valid, columns = request(log_server, message)
+    np.testing.assert_array_equal(columns[0], times[(times >= START + 100) & (times < START + 200)])
+
+    valid, columns = request(log_server, LogServer.make_request_message('a', since=START + 2000, binary=True))
+    assert not valid and columns.shape == (2, 0)
+
+def test_binary_response_fallback(log_server):
+    save_log('arr', [START, START + 1], [np.arange(3.0), np.arange(3.0, 6.0)])
+    # Arrays can't be sent as columns, so are sent as json
+    valid, columns = request(log_server, LogServer.make_request_message('arr', since=START - 1, binary=True))
+    assert valid and columns == [[START, START + 1], [[0, 1, 2], [3, 4, 5]]]
+    valid, columns = request(log_server, LogServer.make_request_message('missing', since=START - 1, binary=True))
+    assert not valid
+
+def test_stream_columns(monkeypatch):
+    monkeypatch.setattr(LogServer, 'STREAM_ROWS', 100)
+    columns = [START + np.arange(1000), np.random.default_rng(0).random(1000)]
+    for compress in (True, False):
+        chunks = list(LogServer.stream_columns(columns, compress))
+        # The size isn't known in advance
+        assert LogServer.BINARY.unpack(chunks[0]) == (LogServer.BINARY_MAGIC, compress, 2, 1000, 0)
+        if not compress:
+            assert len(chunks) == 1 + 2 * 10
+        valid, values = read_sent(b''.join(chunks))
+        assert valid
+        np.testing.assert_array_equal(values, columns)
+
+    valid, values = read_sent(b''.join(LogServer.stream_columns([np.array([]), np.array([])])))
+    assert not valid and values.shape == (2, 0)
+
+def test_stream_json(log_server, monkeypatch):
+    monkeypatch.setattr(LogServer, 'STREAM_ROWS', 3)
+    columns = [START + np.arange(10), np.arange(10.0)]
+    assert json.loads(b''.join(LogServer.stream_json(columns))) == [column.tolist() for column in columns]
+    valid, values = read_sent(b''.join(log_server.split(LogServer.stream_json(columns))))
+    assert valid and values == [column.tolist() for column in columns]
+
+    arrays = np.empty(4, dtype=object)
+    arrays[:] = [np.arange(2.0) + i for i in range(4)]
+    assert json.loads(b''.join(LogServer.stream_json([START + np.arange(4), arrays]))) == [
+        (START + np.arange(4)).tolist(), [[i, i + 1] for i in range(4)]]
+
+    rows = json.loads(b''.join(LogServer.stream_rows(columns[0], columns[1:])))
+    assert rows == [[datetime.fromtimestamp(START + i).isoformat(), i] for i in range(10)]
+
+def test_read_columns_errors():
+    values = np.arange(10.0).tobytes()
+    header = LogServer.BINARY.pack(LogServer.BINARY_MAGIC, False, 1, 10, 0)
+    with pytest.raises(RuntimeWarning, match='Incomplete'):
+        read_sent(header + values[:-8])
+    with pytest.raises(RuntimeWarning, match='Too much'):
+        read_sent(header + values + values[:8])
+    header = LogServer.BINARY.pack(LogServer.BINARY_MAGIC, True, 1, 5, 0)
+    with pytest.raises(RuntimeWarning, match='Too much'):
+        read_sent(header + zlib.compress(values))
+    # Errors in json responses are just invalid
+    assert read_sent(b'error!') == (False, [])
+
+def test_streamed_response(log_server, monkeypatch):
+    monkeypatch.setattr(LogServer, 'STREAM_ROWS', 64)
+    times = START + np.arange(1000) * 0.5
+    save_log('a', times, np.arange(1000.0))
+    for binary in (True, False):
+        valid, columns = request(log_server, LogServer.make_request_message('a', since=START - 1, until=START + 1000, binary=binary))
+        assert valid
+        np.testing.assert_array_equal(columns, [times, np.arange(1000.0)])
+
+def response_json(resp):
+    return json.loads(b''.join(resp))
+
+def save_aligned_logs():
+    # a every second, b every two seconds from 50 s in
+    save_log('a', START + np.arange(100), np.arange(100.0))
+    save_log('b', START + 50 + np.arange(25) * 2, 1000 + np.arange(25.0))
+
+def test_aligned_grid(log_server):
+    save_aligned_logs()
+    columns = response_json(log_server.update_aligned(['a', 'b'], start=START, end=START + 100, step=10))
+    np.testing.assert_array_equal(columns[0], START + np.arange(0, 100, 10))
+    np.testing.assert_array_equal(columns[1], np.arange(4.5, 100, 10))
+    # Missing values are NaN
+    np.testing.assert_array_equal(columns[2], [np.nan] * 5 + [1002, 1007, 1012, 1017, 1022])
+
+    columns = response_json(log_server.update_aligned(['a', 'b'], start=START, end=START + 100, step=10, stat='max'))
+    np.testing.assert_array_equal(columns[1], np.arange(9, 100, 10))
+
+    # b's values from 50 s later
+    columns = response_json(log_server.update_aligned(['a', 'b'], shifts=[0, 50], start=START, end=START + 50, step=10))
+    np.testing.assert_array_equal(columns[0], START + np.arange(0, 50, 10))
+    np.testing.assert_array_equal(columns[2], [1002, 1007, 1012, 1017, 1022])
+
+    # The default is 1000 bins
+    columns = response_json(log_server.update_aligned(['a'], start=START, end=START + 100))
+    assert len(columns[0]) == 1000
+
+def test_aligned_asof(log_server):
+    save_aligned_logs()
+    columns = response_json(log_server.update_aligned(['a', 'b'], start=START, end=START + 100, mode='asof'))
+    np.testing.assert_array_equal(columns[0], START + np.arange(100))
+    np.testing.assert_array_equal(columns[1], np.arange(100.0))
+    np.testing.assert_array_equal(columns[2], [np.nan] * 50 + [1000 + i // 2 for i in range(50)])
+
+    columns = response_json(log_server.update_aligned(['b', 'a'], shifts=[0, -0.5], start=START, end=START + 100, mode='asof'))
+    np.testing.assert_array_equal(columns[0], START + 50 + np.arange(25) * 2)
+    # The value of a half a second before
+    np.testing.assert_array_equal(columns[2], 49 + np.arange(25) * 2)
+
+def test_aligned_request(log_server):
+    save_aligned_logs()
+    expected = response_json(log_server.update_aligned(['a', 'b'], start=START, end=START + 100, step=5))
+    for compress in (True, False):
+        message = LogServer.make_aligned_message(['a', 'b'], START, START + 100, step=5, compress=compress)
+        valid, columns = request(log_server, message)
+        assert valid and columns.shape == (3, 20)
+        np.testing.assert_array_equal(columns, expected)
+
+    message = LogServer.make_aligned_message(['a', 'missing'], START, START + 100, step=5)
+    assert not request(log_server, message)[0]
+    message = LogServer.make_aligned_message(['a'], START, START + 100, step=100 / (LogServer.MAX_BINS + 1))
+    assert not request(log_server, message)[0]
+
+def test_aggregate_request(log_server):
+    times = START + np.arange(1000) * 0.5
+    values = np.sin(np.arange(1000.0))
+    save_log('a', times, values)
+    aggregate = {'width': 60, 'stats': ['mean', 'max', 'count']}
+    message = LogServer.make_request_message('a', since=START - 30, until=START + 1000, binary=True, aggregate=aggregate)
+    valid, columns = request(log_server, message)
+    assert valid
+    edges = START - 30 + 60 * np.arange(18)
+    expected = data_server.bin_statistics(times, values, edges, ('mean', 'max', 'count'))
+    # Only the bins with values
+    assert columns.shape == (4, 9)
+    np.testing.assert_array_equal(columns[0], edges[:9])
+    for column, stat in zip(columns[1:], ('mean', 'max', 'count')):
+        np.testing.assert_array_equal(column, expected[stat][:9])
+
+    valid, columns = request(log_server, LogServer.make_request_message('a', since=START, until=START + 1000, aggregate=aggregate))
+    assert valid and len(columns) == 4 and columns[3][0] == 120
+
+    for aggregate in ({'width': 60, 'stats': ['median']}, {'width': 0}):
+        message = LogServer.make_request_message('a', since=START, until=START + 1000, aggregate=aggregate)
+        assert not request(log_server, message)[0]
+
+def test_log_cache(log_dirs):
+    # Room for two loaders without any segments
+    cache = data_server.LogCache(budget=2500)
+    a, new = cache.get('a')
+    assert new
+    cache.get('b')
+    assert cache.get('a') == (a, False)
+    cache.get('c')
+    # b was the least recently used
+    assert list(cache.loaders) == ['a', 'c']
+    assert cache.stats() == {'loaders': 2, 'bytes': 2 * a.nbytes(), 'budget': 2500, 'hits': 1, 'misses': 3, 'evictions': 1}
+    # peek isn't a use, so a is still dropped first
+    assert cache.peek('a') is a
+    assert cache.peek('b') is None
+    cache.get('d')
+    assert list(cache.loaders) == ['c', 'd']
+    assert cache.stats()['hits'] == 1
+    cache.pop('c')
+    assert list(cache.loaders) == ['d']
+
+    # The newest is always kept, even if it is over budget by itself
+    cache = data_server.LogCache(budget=100)
+    cache.get('a')
+    cache.get('b')
+    assert list(cache.loaders) == ['b']
+    assert cache.stats()['evictions'] == 1
+
+def test_log_cache_stats(log_server):
+    save_log('a', START + np.arange(10), np.arange(10.0))
+    for _ in range(2):
+        assert request(log_server, LogServer.make_request_message('a', since=START - 1))[0]
+    valid, stats = request(log_server, json.dumps({'stats': True}))
+    assert valid
+    assert stats['loaders'] == 1 and stats['hits'] == 1 and stats['misses'] == 1
+    assert stats['budget'] == log_server.logs.budget
+
+def test_log_tail(log_dirs):
+    filename = data_server.SAVE_DIR + 'a.dat'
+    records = [data_client.pack_data(datetime.fromtimestamp(START + i), float(i)) for i in range(6)]
+    with open(filename, 'wb') as file:
+        file.write(records[0] + records[1])
+    # Only what is appended after it starts is read
+    tail = data_server.LogTail('a')
+    assert tail.read() == (None, None)
+    with open(filename, 'ab') as file:
+        file.write(records[2] + records[3][:5])
+    times, values = tail.read()
+    np.testing.assert_array_equal(values, [2.0])
+    with open(filename, 'ab') as file:
+        file.write(records[3][5:] + records[4])
+    times, values = tail.read()
+    np.testing.assert_array_equal(times, [START + 3, START + 4])
+    np.testing.assert_array_equal(values, [3.0, 4.0])
+
+    # Moved away, as when rotated, then the new file is read from the start
+    os.replace(filename, data_server.BACK_DIR + 'a.dat')
+    with open(filename, 'wb') as file:
+        file.write(records[5])
+    assert tail.read() == (None, None)
+    np.testing.assert_array_equal(tail.read()[1], [5.0])
+    tail.close()
+
+def test_log_subscriber(monkeypatch):
+    monkeypatch.setattr(data_server.LogSubscriber, 'MAX_BUFFER', 100)
+    a, b = socket.socketpair()
+    with b:
+        subscriber = data_server.LogSubscriber(a)
+        subscriber.push(b'x' * 60)
+        # Nothing is sent until it is started
+        subscriber.flush()
+        b.setblocking(False)
+        with pytest.raises(BlockingIOError):
+            b.recv(100)
+        subscriber.start()
+        subscriber.flush()
+        assert b.recv(100) == b'x' * 60
+
+        # Too far behind, so it is dropped
+        subscriber.push(b'y' * 60)
+        subscriber.push(b'y' * 60)
+        assert subscriber.closed
+        b.setblocking(True)
+        assert b.recv(100) == b''
+
+def test_subscribe(log_server):
+    save_log('a', START + np.arange(5), np.arange(5.0))
+    stopping = []
+    with socket.create_connection(("127.0.0.1", log_server.port)) as sock:
+        sock.settimeout(0.1)
+        sock.sendall(LogServer.make_subscribe_message(['a', 'b'], since=START + 2).encode())
+        frames = (frame for frame in LogServer.read_tail(sock, lambda: len(stopping)) if frame[0] is not None)
+        # First those already saved since
+        key, times, values = next(frames)
+        assert key == 'a'
+        np.testing.assert_array_equal(times, START + np.arange(2, 5))
+        np.testing.assert_array_equal(values, [2.0, 3.0, 4.0])
+
+        # Then they are pushed as they are saved, including to keys which had none
+        save_log('a', START + np.arange(5, 8), np.arange(5.0, 8.0))
+        key, times, values = next(frames)
+        assert key == 'a'
+        np.testing.assert_array_equal(values, [5.0, 6.0, 7.0])
+        save_log('b', [START + 10], [10.0])
+        key, times, values = next(frames)
+        assert key == 'b' and list(times) == [START + 10] and list(values) == [10.0]
+
+        stopping.append(True)
+        with pytest.raises(StopIteration):
+            next(frames)
+
+    # Not accepted, so there is nothing
+    with socket.create_connection(("127.0.0.1", log_server.port)) as sock:
+        sock.sendall(json.dumps({'subscribe': 5}).encode())
+        assert list(LogServer.read_tail(sock)) == []
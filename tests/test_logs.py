@@ -0,0 +1,360 @@
+import os
+import time
+import json
+import zlib
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from lab_gui.utils import data_client, data_server
+from lab_gui.utils.data_server import DataSaver, LogCompressor, LogLoader, SegmentCatalog, LevelBuilder, decode_records, aggregate
+from lab_gui.utils.data_server import bin_statistics, merge_buckets, retention_for, LogCompactor
+
+def pack_values(times, values):
+    return [data_client.pack_data(datetime.fromtimestamp(time), value) for time, value in zip(times, values)]
+
+def read_log(key, dir=data_server.SAVE_DIR):
+    with open(dir + key + '.dat', 'rb') as file:
+        return decode_records(file.read())
+
+def test_saver_batches(log_dirs):
+    saver = DataSaver()
+    times = 1700000000 + np.arange(10) * 0.01
+    saver.save({b'a': pack_values(times, np.arange(10.0)), b'b': pack_values(times[:3], [1, 2, 3])})
+    saver.save({b'a': pack_values(times + 0.5, np.arange(10.0, 20.0))})
+    _times, values = read_log('a')
+    np.testing.assert_array_equal(_times, np.concatenate((times, times + 0.5)))
+    np.testing.assert_array_equal(values, np.arange(20.0))
+    _times, values = read_log('b')
+    np.testing.assert_array_equal(values, [1, 2, 3])
+    assert saver.sizes['a'] == os.path.getsize(data_server.SAVE_DIR + 'a.dat')
+    saver.close()
+
+def test_saver_drops_bad_values(log_dirs):
+    saver = DataSaver()
+    values = pack_values([1700000000.0, 1700000000.1], [1.0, 2.0])
+    saver.save({b'a': [values[0], values[1][:-1], values[1]], b'p': [data_client.pack_value(datetime.now(), {'a': 1})]})
+    np.testing.assert_array_equal(read_log('a')[1], [1.0, 2.0])
+    assert not os.path.exists(data_server.SAVE_DIR + 'p.dat')
+    saver.close()
+
+def test_saver_lru(log_dirs):
+    saver = DataSaver(max_open=2)
+    # All in the same second, so no level files are opened
+    times = [1700000000.0, 1700000000.1]
+    for i, key in enumerate([b'a', b'b', b'c', b'a', b'd']):
+        saver.save({key: pack_values(times[:1] if i < 3 else times[1:], [float(i)])})
+        assert len(saver.files) <= 2
+    assert list(saver.files.keys()) == ['a', 'd']
+    # a was closed and opened again, so carries on from where it was
+    np.testing.assert_array_equal(read_log('a')[1], [0.0, 3.0])
+    saver.close()
+    assert len(saver.files) == 0
+
+def test_saver_flush(log_dirs):
+    filename = data_server.SAVE_DIR + 'a.dat'
+    saver = DataSaver(flush=False)
+    saver.save({b'a': pack_values([1700000000.0], [1.0])})
+    # Left in the file's buffer
+    assert os.path.getsize(filename) == 0
+    saver.close()
+    assert os.path.getsize(filename) == 17
+
+    saver = DataSaver(fsync_interval=0)
+    saver.save({b'a': pack_values([1700000000.1], [2.0])})
+    assert os.path.getsize(filename) == 34
+    saver.close()
+
+def test_take_pending(log_dirs, monkeypatch):
+    pending = {b'a': pack_values([1700000000.0], [1.0])}
+    monkeypatch.setattr(data_server.BaseDataServer, 'pending_save', pending)
+    saver = DataSaver()
+    assert saver.take_pending() is pending
+    assert data_server.BaseDataServer.pending_save == {}
+    saver.close()
+
+def write_segment(filename, times, values):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'wb') as file:
+        file.write(b''.join(pack_values(times, values)))
+
+def test_compress(log_dirs):
+    times = 1700000000 + np.arange(5000.0)
+    write_segment(data_server.BACK_DIR + 'a/a_1.dat', times, np.sin(times))
+    log = LogLoader('a')
+    log.process_old_dir()
+    before = log.load_range(-np.inf, np.inf)
+
+    compressor = LogCompressor()
+    assert compressor.submit_all() == 1
+    compressor.wait()
+    assert sorted(os.listdir(data_server.BACK_DIR + 'a')) == ['a_1' + data_server.LOG_CODEC, 'index.json']
+    assert compressor.saved > 0
+    assert compressor.submit_all() == 0
+    # Both with the catalog from before, and a new one
+    for log in (log, LogLoader('a')):
+        after = log.load_range(-np.inf, np.inf)
+        np.testing.assert_array_equal(after[0], before[0])
+        np.testing.assert_array_equal(after[1], before[1])
+
+def test_compress_many(log_dirs):
+    # Several at once on the pool, with each of the codecs
+    times = 1700000000 + np.arange(20000.0)
+    for suffix in data_server.LOG_CODECS:
+        for i in range(8):
+            write_segment(data_server.BACK_DIR + f'a/a_{i}.dat', times[i::8], times[i::8])
+        compressor = LogCompressor(suffix=suffix, workers=4)
+        assert compressor.submit_all() == 8
+        compressor.wait()
+        assert sorted(os.listdir(data_server.BACK_DIR + 'a')) == [f'a_{i}{suffix}' for i in range(8)]
+        _times, values = LogLoader('a').load_range(-np.inf, np.inf)
+        np.testing.assert_array_equal(np.sort(_times), times)
+        for file in os.listdir(data_server.BACK_DIR + 'a'):
+            os.remove(data_server.BACK_DIR + 'a/' + file)
+
+def test_compress_removed(log_dirs, monkeypatch):
+    filename = data_server.BACK_DIR + 'a/a_1.dat'
+    write_segment(filename, [1700000000.0], [1.0])
+
+    def compress(data):
+        # As if the LogCompactor dropped it meanwhile
+        os.remove(filename)
+        return zlib.compress(data)
+    monkeypatch.setitem(data_server.LOG_CODECS, '.dat_test', (compress, zlib.decompress))
+    assert LogCompressor(suffix='.dat_test').compress(filename) == 0
+    assert os.listdir(data_server.BACK_DIR + 'a') == []
+
+def test_compress_verified(log_dirs, monkeypatch):
+    filename = data_server.BACK_DIR + 'a/a_1.dat'
+    write_segment(filename, [1700000000.0], [1.0])
+    monkeypatch.setitem(data_server.LOG_CODECS, '.dat_test', (zlib.compress, lambda data: zlib.decompress(data)[1:]))
+    assert LogCompressor(suffix='.dat_test').compress(filename) == 0
+    assert os.listdir(data_server.BACK_DIR + 'a') == ['a_1.dat']
+
+def test_catalog_update(tmp_path):
+    save_dir = str(tmp_path)
+    times = np.arange(1000.0, 11000.0)
+    write_segment(os.path.join(save_dir, 'a.dat'), times, times * 2)
+
+    catalog = SegmentCatalog(save_dir)
+    catalog.update()
+    entries = catalog.read()
+    assert list(entries.keys()) == ['a']
+    entry = entries['a']
+    assert entry['first'] == 1000 and entry['last'] == 10999
+    assert entry['count'] == 10000 and entry['id'] == 1 and entry['size'] == 170000
+    # A block every 4096 records, of the time and byte offset of the first
+    assert entry['blocks'] == [[1000.0, 0], [5096.0, 4096 * 17], [9192.0, 8192 * 17]]
+    with open(os.path.join(save_dir, SegmentCatalog.FILENAME)) as file:
+        assert json.load(file) == entries
+
+    write_segment(os.path.join(save_dir, 'b.dat'), times + 20000, times)
+    # Nothing new until the folder changes, unless forced
+    catalog.update(force=True)
+    assert [name for name, _ in catalog.find(5000, 30000)] == ['a', 'b']
+    assert [name for name, _ in catalog.find(11000, 30000)] == ['b']
+    assert [name for name, _ in catalog.find(0, 1000)] == []
+
+    os.remove(os.path.join(save_dir, 'a.dat'))
+    catalog.update(force=True)
+    assert list(catalog.read().keys()) == ['b']
+    # And another reading the same folder sees the same
+    assert SegmentCatalog(save_dir).read() == catalog.read()
+
+def test_segments_in_range(log_dirs):
+    for i in range(5):
+        times = 1700000000 + i * 1000 + np.arange(1000.0)
+        write_segment(data_server.BACK_DIR + f'a/a_{i}.dat', times, times)
+    write_segment(data_server.SAVE_DIR + 'a.dat', [1700005000.0], [1.0])
+    log = LogLoader('a')
+    segments = log.segments(1700001500, 1700002500)
+    assert [os.path.basename(segment.filename) for segment in segments] == ['a_1.dat', 'a_2.dat', 'a.dat']
+    times, values = log.load_range(1700001500, 1700002500)
+    np.testing.assert_array_equal(times, 1700001500 + np.arange(1000.0))
+
+def test_rotate(log_dirs, monkeypatch):
+    monkeypatch.setattr(data_server, 'MAX_FILESIZE', 1000 * 17)
+    saver = DataSaver()
+    times = 1700000000 + np.arange(1500.0)
+    saver.save({b'a': pack_values(times[:1200], times[:1200])})
+    assert os.path.exists(data_server.BACK_DIR + 'a.dat')
+    saver.save({b'a': pack_values(times[1200:], times[1200:])})
+
+    log = LogLoader('a')
+    log.process_old_dir()
+    entries = log.catalog.read()
+    assert len(entries) == 1
+    entry = list(entries.values())[0]
+    assert entry['count'] == 1200 and entry['first'] == times[0] and entry['last'] == times[1199]
+    assert not os.path.exists(data_server.BACK_DIR + 'a.dat')
+    np.testing.assert_array_equal(log.load_range(-np.inf, np.inf)[0], times)
+    saver.close()
+
+def test_aggregate():
+    rng = np.random.default_rng(2)
+    times = np.sort(rng.uniform(0, 1000, 5000))
+    values = rng.normal(size=len(times))
+    buckets = aggregate(times, values, 60)
+    index = np.floor(times / 60)
+    assert list(buckets['time']) == [i * 60 for i in np.unique(index)]
+    for bucket in buckets:
+        _values = values[index == bucket['time'] / 60]
+        assert bucket['count'] == len(_values)
+        assert bucket['min'] == _values.min() and bucket['max'] == _values.max()
+        assert bucket['mean'] == pytest.approx(_values.mean())
+
+def test_level_builder():
+    rng = np.random.default_rng(3)
+    times = np.sort(rng.uniform(0, 5000, 20000))
+    values = rng.normal(size=len(times))
+    builder = LevelBuilder()
+    done = {width: [] for width in data_server.LEVELS}
+    # Added a bit at a time, as the DataSaver does
+    for i in range(0, len(times), 777):
+        for width, buckets in builder.add(times[i:i + 777], values[i:i + 777]).items():
+            done[width].append(buckets)
+    for width, buckets in builder.close().items():
+        done[width].append(buckets)
+    for width in data_server.LEVELS:
+        whole = aggregate(times, values, width)
+        buckets = np.concatenate(done[width])
+        np.testing.assert_array_equal(buckets['time'], whole['time'])
+        np.testing.assert_array_equal(buckets['count'], whole['count'])
+        np.testing.assert_array_equal(buckets['min'], whole['min'])
+        np.testing.assert_allclose(buckets['mean'], whole['mean'])
+
+def test_load_level(log_dirs):
+    saver = DataSaver()
+    times = 1700000000 + np.arange(0, 7200, 0.5)
+    values = np.sin(times / 100)
+    for i in range(0, len(times), 1000):
+        saver.save({b'a': pack_values(times[i:i + 1000], values[i:i + 1000])})
+    assert os.path.getsize(data_server.level_filename('a', 10)) > 0
+
+    log = LogLoader('a')
+    start, end = times[0] + 5, times[-1] + 1
+    # The coarsest which still gives the points
+    buckets = log.load_level(start, end, 100)
+    expected = aggregate(times, values, 60)
+    np.testing.assert_array_equal(buckets['time'], expected['time'])
+    np.testing.assert_array_equal(buckets['count'], expected['count'])
+    np.testing.assert_allclose(buckets['mean'], expected['mean'])
+    assert len(log.load_level(start, end, 1000)) == len(aggregate(times[times >= start], values[times >= start], 1))
+    # Too few for any of the levels, so the raw values are used
+    assert log.load_level(start, start + 100, 1000) is None
+    saver.close()
+
+def test_bin_statistics():
+    rng = np.random.default_rng(1)
+    times = np.sort(rng.uniform(-5, 105, 1000))
+    values = rng.normal(size=len(times))
+    # The bin from 50 to 60 is empty
+    values = values[(times < 50) | (times >= 60)]
+    times = times[(times < 50) | (times >= 60)]
+    edges = np.arange(0, 101, 10.0)
+    results = bin_statistics(times, values, edges, data_server.STATISTICS)
+
+    for i in range(len(edges) - 1):
+        _values = values[(times >= edges[i]) & (times < edges[i + 1])]
+        if not len(_values):
+            assert results['count'][i] == 0 and results['sum'][i] == 0
+            for stat in ('mean', 'min', 'max', 'std', 'first', 'last'):
+                assert np.isnan(results[stat][i])
+            continue
+        assert results['count'][i] == len(_values)
+        assert results['sum'][i] == pytest.approx(_values.sum())
+        assert results['mean'][i] == pytest.approx(_values.mean())
+        assert results['std'][i] == pytest.approx(_values.std())
+        assert results['min'][i] == _values.min()
+        assert results['max'][i] == _values.max()
+        assert results['first'][i] == _values[0]
+        assert results['last'][i] == _values[-1]
+
+    empty = bin_statistics(np.empty(0), np.empty(0), edges, data_server.STATISTICS)
+    assert np.all(empty['count'] == 0)
+    assert np.all(np.isnan(empty['last']))
+    with pytest.raises(ValueError):
+        bin_statistics(times, values, edges, ('median',))
+
+def test_merge_buckets():
+    times = np.arange(0, 100, 0.5)
+    values = np.sin(times)
+    whole = aggregate(times, values, 10)
+    # As if split between segments part way through a bucket
+    split = 95
+    parts = np.concatenate((aggregate(times[:split], values[:split], 10), aggregate(times[split:], values[split:], 10)))
+    assert len(parts) == len(whole) + 1
+    merged = merge_buckets(parts[::-1])
+    np.testing.assert_array_equal(merged['time'], whole['time'])
+    np.testing.assert_array_equal(merged['min'], whole['min'])
+    np.testing.assert_array_equal(merged['max'], whole['max'])
+    np.testing.assert_array_equal(merged['count'], whole['count'])
+    np.testing.assert_allclose(merged['mean'], whole['mean'])
+
+def test_retention_for():
+    day = 86400
+    policy = {'fast_*': [[10, 30], [0, 1]], 'fast_b': [[0, 5]], '*': [[0, None]]}
+    assert retention_for('fast_a', policy) == {0: day, 1: day, 10: 30 * day, 60: 30 * day, 600: 30 * day}
+    # The first pattern which matches is used
+    assert retention_for('fast_b', policy) == retention_for('fast_a', policy)
+    assert retention_for('slow', policy) == {width: None for width in (0,) + data_server.LEVELS}
+    assert retention_for('slow', {'fast_*': [[0, 1]]}) == {width: None for width in (0,) + data_server.LEVELS}
+    # Widths under the first tier are kept forever
+    assert retention_for('key', {'*': [[60, 7]]}) == {0: None, 1: None, 10: None, 60: 7 * day, 600: 7 * day}
+    assert retention_for('key') == {width: None for width in (0,) + data_server.LEVELS}
+
+def test_catalog_levels(tmp_path):
+    save_dir = str(tmp_path)
+    times = np.arange(1000.0, 1100.0)
+    write_segment(os.path.join(save_dir, 'a.dat'), times, times * 2)
+    aggregate(times, times * 2, 60).tofile(data_server.archive_filename(save_dir, 'a', 60))
+    # Only the levels of b are left
+    aggregate(times + 1000, times, 10).tofile(data_server.archive_filename(save_dir, 'b', 10))
+    aggregate(times + 1000, times, 60).tofile(data_server.archive_filename(save_dir, 'b', 60))
+
+    catalog = SegmentCatalog(save_dir)
+    catalog.update()
+    entries = catalog.read()
+    assert set(entries.keys()) == {'a', 'b'}
+    assert entries['a']['levels'] == [60] and entries['a']['raw']
+    assert entries['b']['first'] == 2000 and entries['b']['last'] == 2100
+    assert entries['b']['levels'] == [10, 60] and not entries['b']['raw']
+    assert [name for name, _ in catalog.find(1050, 2050)] == ['a', 'b']
+
+    # As the LogCompactor does
+    os.remove(os.path.join(save_dir, 'a.dat'))
+    catalog.update(force=True)
+    assert not catalog.read()['a']['raw']
+    assert catalog.read()['a']['levels'] == [60]
+    os.remove(data_server.archive_filename(save_dir, 'a', 60))
+    catalog.update(force=True)
+    assert set(catalog.read().keys()) == {'b'}
+
+def test_compact(log_dirs):
+    now = np.floor(time.time())
+    old = now - 10 * 86400 + np.arange(3600.0)
+    recent = now - 3600 + np.arange(100.0)
+    write_segment(data_server.BACK_DIR + 'a/a_1.dat', old, np.sin(old))
+    write_segment(data_server.BACK_DIR + 'a/a_2.dat', recent, recent)
+    write_segment(data_server.BACK_DIR + 'b/b_1.dat', old, old)
+    # Raw values for a day, and the coarser levels for 30, b is kept forever
+    compactor = LogCompactor(policy={'a': [[0, 1], [60, 30]]})
+    assert compactor.submit_all() == 2
+    compactor.wait()
+    assert compactor.removed == 1
+    assert sorted(os.listdir(data_server.BACK_DIR + 'a')) == ['a_1_60.lvl', 'a_1_600.lvl', 'a_2.dat', 'index.json']
+    assert os.listdir(data_server.BACK_DIR + 'b') == ['b_1.dat']
+
+    log = LogLoader('a')
+    np.testing.assert_array_equal(log.load_range(-np.inf, np.inf)[0], recent)
+    # The old values are still there as levels
+    buckets = log.load_level(old[0], old[-1] + 1, 30)
+    expected = aggregate(old, np.sin(old), 60)
+    np.testing.assert_array_equal(buckets['time'], expected['time'])
+    np.testing.assert_array_equal(buckets['count'], expected['count'])
+    np.testing.assert_allclose(buckets['mean'], expected['mean'])
+
+    # Then those go too
+    assert LogCompactor(policy={'a': [[0, 1], [60, 5]]}).compact('a') == 2
+    assert sorted(os.listdir(data_server.BACK_DIR + 'a')) == ['a_2.dat', 'index.json']